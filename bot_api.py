@@ -1,64 +1,344 @@
-from fastapi import FastAPI, HTTPException
+import asyncio
+import json
+import logging
+from contextlib import asynccontextmanager
+from datetime import date
+from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException, Query
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from conversation_handler import ConversationHandler
-from typing import Dict, Any
-import uuid
+from conversation_handler import ConversationHandler, create_llm_runner
+from src import config
+from src.idempotency import IdempotencyKeyConflict
+from src.keyed_executor import KeyQueueFull
+from src.admission import AdmissionController, Overloaded, INTERACTIVE
+from src.async_clinical_store import AsyncClinicalStore
+from src.clinical_store import ClinicalRecordError
+from src.metrics import REGISTRY
+from src.tracing import TracingMiddleware
+from typing import Dict, Any, Literal, Optional
+
+MAX_BULK_CONVERSATION_IDS = 1000
+MAX_FOLLOWUP_PAGE_SIZE = 1000
+# Conversation turns processed at once; further ones wait in their priority lane.
+MAX_CONCURRENT_CONVERSATIONS = 16
+# Turns allowed to wait in each lane before new ones are rejected with 429.
+MAX_QUEUED_CONVERSATIONS = 64
+# Concurrency limit per facility id, so one facility's bulk import can't take every slot.
+FACILITY_CONCURRENCY_LIMITS: Dict[str, int] = {}
+DEFAULT_FACILITY_CONCURRENCY_LIMIT = None
+# Seconds clients are told to wait before retrying while the model is still loading.
+STARTUP_RETRY_AFTER_SECONDS = 10
+# Return each request's trace id and stage durations in X-Trace-Id and Server-Timing headers.
+TRACE_HEADERS = config.TRACE_HEADERS
+
+HTTP_REQUEST_SECONDS = REGISTRY.histogram("http_request_seconds",
+                                          "Time to serve an API request, streamed response bodies included.")
+
+# Set once the model has loaded in the background; requests get 503 until then.
+conversation_handler: Optional[ConversationHandler] = None
+startup_error: Optional[BaseException] = None
+
+
+async def start_conversation_handler():
+    """Load the model off the event loop, then build the handler and prepare its Mongo collections."""
+    global conversation_handler, startup_error
+    try:
+        bot = await asyncio.get_running_loop().run_in_executor(None, create_llm_runner)
+        handler = ConversationHandler(bot=bot)
+        await handler.start()
+        conversation_handler = handler
+    except Exception as e:
+        startup_error = e
+        logging.getLogger(__name__).exception("Startup failed")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The server binds immediately; /readyz reports when the handler is usable.
+    startup = asyncio.create_task(start_conversation_handler())
+    yield
+    startup.cancel()
+    if conversation_handler is not None:
+        await conversation_handler.close()
+
+
+def get_conversation_handler() -> ConversationHandler:
+    """
+    Return the conversation handler once startup has finished.
+
+    Raises:
+        HTTPException: HTTP 503 while the model is loading (with Retry-After) or if startup failed.
+    """
+    if conversation_handler is None:
+        if startup_error is not None:
+            raise HTTPException(status_code=503, detail=f"Startup failed: {startup_error}")
+        raise HTTPException(status_code=503, detail="The model is still loading.",
+                            headers={"Retry-After": str(STARTUP_RETRY_AFTER_SECONDS)})
+    return conversation_handler
+
+
+def get_clinical_store(conversation_handler: ConversationHandler = Depends(get_conversation_handler)
+                       ) -> AsyncClinicalStore:
+    """
+    Return the clinical record store.
+
+    Raises:
+        HTTPException: HTTP 404 if clinical records are disabled.
+    """
+    if conversation_handler.async_clinical_store is None:
+        raise HTTPException(status_code=404, detail="Clinical records are disabled.")
+    return conversation_handler.async_clinical_store
+
 
 app = FastAPI(
     title="Management Bot API",
     description="API for handling medical facility management conversations",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
+app.add_middleware(TracingMiddleware, histogram=HTTP_REQUEST_SECONDS, response_headers=TRACE_HEADERS)
 
 class ConversationRequest(BaseModel):
     conversation_id: str
     user_input: str
+    # Retries that reuse the key get the first attempt's response instead of a second turn.
+    idempotency_key: Optional[str] = None
+    facility_id: Optional[str] = None
+    # "interactive" for turns typed by a nurse, "bulk" for imports and other batch clients.
+    priority: Literal["interactive", "bulk"] = INTERACTIVE
 
 
-conversation_handler = ConversationHandler()
+admission = AdmissionController(max_concurrency=MAX_CONCURRENT_CONVERSATIONS, max_queue=MAX_QUEUED_CONVERSATIONS,
+                                facility_limits=FACILITY_CONCURRENCY_LIMITS,
+                                default_facility_limit=DEFAULT_FACILITY_CONCURRENCY_LIMIT)
 
 @app.post("/conversation")
-async def handle_conversation(request: ConversationRequest):
+async def handle_conversation(request: ConversationRequest, background_tasks: BackgroundTasks,
+                              conversation_handler: ConversationHandler = Depends(get_conversation_handler)):
     """
     Handles a conversation request by processing user input and returning the bot's response.
+
+    When history summarization is enabled, older turns are folded into the conversation's
+    rolling summary after the response has been sent. Requests carrying an idempotency
+    key that is already in flight or recently completed for the conversation return
+    that request's response without calling the model or storing the turn again.
+
+    Requests are admitted through a bounded queue with interactive and bulk lanes; when
+    the request's lane is full it is rejected at once instead of waiting indefinitely.
+    The admission slot is only taken once the conversation's earlier turns have finished,
+    so turns queued behind them do not hold slots other conversations could use.
+
     Args:
         request (ConversationRequest): The conversation request containing the conversation ID and user input.
+        background_tasks (BackgroundTasks): Tasks run after the response is returned.
     Returns:
         The bot's response to the user input.
     Raises:
-        HTTPException: If an error occurs while processing the conversation, an HTTP 500 error is raised with the error details.
+        HTTPException: If the model is still loading, an HTTP 503 error is raised with a Retry-After header.
+            If the admission queue is full, an HTTP 429 error is raised with a Retry-After header.
+            If the idempotency key was already used with a different input, an HTTP 409 error is raised.
+            If too many requests are already queued for the conversation, an HTTP 429 error is raised.
+            If an error occurs while processing the conversation, an HTTP 500 error is raised with the error details.
     """
     try:
-        bot_response = conversation_handler.handle_conversation(
+        admission.check(request.priority)
+        bot_response = await conversation_handler.handle_conversation_async(
             request.conversation_id,
-            request.user_input
+            request.user_input,
+            request.idempotency_key,
+            admit=lambda: admission.admit(request.facility_id, request.priority)
         )
-        
+        if conversation_handler.summarizer:
+            background_tasks.add_task(conversation_handler.summarizer.summarize_in_background, request.conversation_id)
+
         return bot_response
+    except Overloaded as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except IdempotencyKeyConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except KeyQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"Error processing conversation: {str(e)}"
         )
     
+@app.post("/conversation/stream")
+async def stream_conversation(request: ConversationRequest, background_tasks: BackgroundTasks,
+                              conversation_handler: ConversationHandler = Depends(get_conversation_handler)):
+    """
+    Streaming variant of /conversation using server-sent events.
+
+    Generated text is sent as `token` events while the model runs, so the nurse station
+    can show progress immediately. The last event is `result`, carrying the validated
+    JSON response once it has been stored, or `error` if the turn failed. Idempotency
+    keys are not applied to streamed requests.
+
+    Args:
+        request (ConversationRequest): The conversation request containing the conversation ID and user input.
+        background_tasks (BackgroundTasks): Tasks run after the stream has finished.
+    Returns:
+        StreamingResponse: A `text/event-stream` response.
+    Raises:
+        HTTPException: If the admission queue is full, an HTTP 429 error is raised with a Retry-After header.
+    """
+    # Overload is checked before the stream starts so it still maps to a 429 status; the
+    # slot itself is taken inside the stream once the conversation's earlier turns have
+    # finished, and released however the stream ends.
+    try:
+        admission.check(request.priority)
+    except Overloaded as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+    async def events():
+        try:
+            async for kind, value in conversation_handler.stream_conversation(
+                    request.conversation_id, request.user_input,
+                    admit=lambda: admission.admit(request.facility_id, request.priority)):
+                if kind == "token":
+                    yield server_sent_event("token", {"text": value})
+                else:
+                    yield server_sent_event("result", {"response": value, "persisted": True})
+        except Exception as e:
+            yield server_sent_event("error", {"detail": f"Error processing conversation: {str(e)}"})
+
+    if conversation_handler.summarizer:
+        background_tasks.add_task(conversation_handler.summarizer.summarize_in_background, request.conversation_id)
+    return StreamingResponse(events(), media_type="text/event-stream", background=background_tasks)
+
+
+def server_sent_event(event: str, data: dict) -> str:
+    """Format one server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
 @app.get("/generate_conversation_id")
-async def generate_conversation_id():
+async def generate_conversation_id(conversation_handler: ConversationHandler = Depends(get_conversation_handler)):
     """
     Asynchronously generates a unique conversation ID.
 
-    This function continuously generates a UUID until it finds one that does not
-    already exist in the conversation handler's database. Once a unique UUID is
-    found, it creates a new conversation with that ID and returns it.
+    The conversation is created with a single insert; uniqueness is guaranteed by
+    the unique index on conversation_id rather than a check-then-insert loop.
 
     Returns:
         dict: A dictionary containing the generated unique conversation ID.
     """
-    while True:
-        conversation_id = str(uuid.uuid4())
-        if not conversation_handler.crud.get_conversation(conversation_id):
-            conversation_handler.crud.create_conversation(conversation_id)
-            return {"conversation_id": conversation_id}
-        
+    conversation_id = await conversation_handler.async_crud.allocate_conversation_id()
+    return {"conversation_id": conversation_id}
+
+
+@app.get("/generate_conversation_ids")
+async def generate_conversation_ids(count: int = Query(..., ge=1, le=MAX_BULK_CONVERSATION_IDS),
+                                    conversation_handler: ConversationHandler = Depends(get_conversation_handler)):
+    """
+    Pre-allocates a batch of conversation IDs, e.g. at the start of a shift.
+
+    Args:
+        count (int): Number of conversations to create.
+
+    Returns:
+        dict: A dictionary containing the list of generated conversation IDs.
+    """
+    conversation_ids = await conversation_handler.async_crud.allocate_conversation_ids(count)
+    return {"conversation_ids": conversation_ids}
+
+
+@app.get("/followups")
+async def list_followups(start: Optional[date] = None, end: Optional[date] = None,
+                         patient_name: Optional[str] = None, ward: Optional[str] = None,
+                         limit: int = Query(100, ge=1, le=MAX_FOLLOWUP_PAGE_SIZE), cursor: Optional[str] = None,
+                         clinical_store: AsyncClinicalStore = Depends(get_clinical_store)):
+    """
+    Lists scheduled follow-ups, ordered by date, one page at a time.
+
+    E.g. `/followups?start=2024-12-20&end=2024-12-26&ward=3B` is the week's rounds for
+    ward 3B. Pass the returned `next_cursor` as `cursor` to get the next page.
+
+    Args:
+        start (date, optional): First day, inclusive (YYYY-MM-DD).
+        end (date, optional): Last day, inclusive (YYYY-MM-DD).
+        patient_name (str, optional): Only this patient's follow-ups.
+        ward (str, optional): Only follow-ups of patients in this ward; the ward is the one the
+            patient was in when the follow-up was scheduled.
+        limit (int): Page size.
+        cursor (str, optional): The `next_cursor` of the previous page.
+
+    Returns:
+        dict: The follow-ups and `next_cursor`, which is null on the last page.
+
+    Raises:
+        HTTPException: HTTP 404 if the patient does not exist, HTTP 400 if the cursor is invalid.
+    """
+    try:
+        followups, next_cursor = await clinical_store.find_followups(start, end, patient_name, ward, limit, cursor)
+    except ClinicalRecordError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"followups": followups, "next_cursor": next_cursor}
+
+
+@app.get("/followups/stream")
+async def stream_followups(start: Optional[date] = None, end: Optional[date] = None,
+                           patient_name: Optional[str] = None, ward: Optional[str] = None,
+                           clinical_store: AsyncClinicalStore = Depends(get_clinical_store)):
+    """
+    Streams every matching follow-up as newline-delimited JSON, ordered by date.
+
+    Takes the same filters as /followups. Results are read from Mongo in batches and
+    sent as they arrive, so large exports never sit in memory.
+
+    Returns:
+        StreamingResponse: An `application/x-ndjson` response with one follow-up per line.
+
+    Raises:
+        HTTPException: HTTP 404 if the patient does not exist.
+    """
+    try:
+        query = await clinical_store.followup_query(start, end, patient_name, ward)
+    except ClinicalRecordError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    async def lines():
+        async for followup in clinical_store.iter_followups(query):
+            yield json.dumps(followup) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness probe: the process is up and serving HTTP, whether or not the model has loaded."""
+    return {"status": "ok"}
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Every metric of this worker in the Prometheus text format, available while the model loads.
+
+    Each API worker process has its own metrics, so scrape every worker. With the remote
+    backend, generation metrics (llm_*) are recorded in the model server process instead.
+    """
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/readyz")
+async def readyz():
+    """
+    Readiness probe: 200 once the model is loaded and Mongo indexes are in place.
+
+    Returns:
+        JSONResponse: {"status": "ready"}, or HTTP 503 with status "loading" or "failed".
+    """
+    if conversation_handler is not None:
+        return {"status": "ready"}
+    if startup_error is not None:
+        return JSONResponse(status_code=503, content={"status": "failed", "error": str(startup_error)})
+    return JSONResponse(status_code=503, content={"status": "loading"})
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -1,11 +1,196 @@
-from src.management_bot import LLMRunner
-from src.crud_handler import MessageCrudHandler
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing, nullcontext
+from time import perf_counter
+
+from src import config
+from src.crud_handler import MessageCrudHandler, EMBEDDED_STORAGE
+from src.async_crud_handler import AsyncMessageCrudHandler
+from src.message_journal import MessageJournal, WriteBehindCrudHandler
+from src.history_cache import CachedCrudHandler, HistoryCache
+from src.clinical_store import ClinicalRecordError, ClinicalStore
+from src.async_clinical_store import AsyncClinicalStore
+from src.context_builder import ContextBuilder
+from src.summarizer import ConversationSummarizer
+from src.fast_path import FastPathParser
+from src.response_cache import CachedLLMRunner, InMemoryCacheBackend
+from src.idempotency import IdempotencyRegistry
+from src.keyed_executor import KeyedExecutor
+from src.json_stream import JsonObjectExtractor
+from src.llm_backend import LLM_PARSE_FAILURES, create_llm_runner, iterate_in_executor
+from src.metrics import REGISTRY
+from src.tracing import observe_stage, stage
+
+MONGO_CONNECTION_STRING = config.MONGO_CONNECTION_STRING
+MONGO_DATABASE_NAME = config.MONGO_DATABASE_NAME
+MESSAGE_JOURNAL_DIR = config.MESSAGE_JOURNAL_DIR
+# Switch to COLLECTION_STORAGE after running `python -m src.migrate_messages`.
+MESSAGE_STORAGE = EMBEDDED_STORAGE
+# Fold turns that no longer fit the history window into a rolling summary after each response.
+SUMMARIZE_HISTORY = False
+# Answer plainly phrased commands with the rule-based parser instead of the model.
+FAST_PATH = True
+# Bot responses are cached in process memory for a few minutes, keyed on the input and
+# history window. Pass a RedisCacheBackend to share the cache between API workers.
+RESPONSE_CACHE_SIZE = 1024
+RESPONSE_CACHE_TTL_SECONDS = 300
+# Turns of one conversation run one after another; this many may wait before new ones are rejected.
+MAX_PENDING_TURNS_PER_CONVERSATION = 8
+STORE_PROMPT_TOKEN_IDS = config.STORE_PROMPT_TOKEN_IDS
+CLINICAL_RECORDS = config.CLINICAL_RECORDS
+# Recent histories are kept in process memory, up to about this many bytes, and served
+# after checking their version with one small read; 0 reads every history from Mongo.
+HISTORY_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+TURN_QUEUE_SECONDS = REGISTRY.histogram("turn_queue_seconds",
+                                        "Time a turn waited for earlier turns of its conversation.")
+TURN_HISTORY_SECONDS = REGISTRY.histogram("turn_history_seconds", "Time to read a turn's history window.")
+TURN_CONTEXT_SECONDS = REGISTRY.histogram("turn_context_seconds",
+                                          "Time to select the history that fits the prompt's token budget.")
+TURN_GENERATE_SECONDS = REGISTRY.histogram("turn_generate_seconds",
+                                           "Time to get the model's response, waiting for a worker or batch included.")
+TURN_INTENT_SECONDS = REGISTRY.histogram("turn_intent_seconds", "Time to apply a response's intent to the records.")
+TURN_STORE_SECONDS = REGISTRY.histogram("turn_store_seconds", "Time to store a turn's message pair.")
+LLM_POOL_WAITING = REGISTRY.gauge("llm_pool_waiting", "Blocking model calls waiting for a generation thread.")
 
 
 class ConversationHandler:
-    def __init__(self):
-        self.bot = LLMRunner()
-        self.crud = MessageCrudHandler(connection_string="mongodb://localhost:27017", database_name="medical_conversations")
+    def __init__(self, bot=None, llm_workers: int = 16, history_limit: int = 50,
+                 summarize_history: bool = SUMMARIZE_HISTORY, fast_path: bool = FAST_PATH, response_cache=None,
+                 store_token_ids: bool = STORE_PROMPT_TOKEN_IDS, clinical_records: bool = CLINICAL_RECORDS,
+                 journal_dir: str = MESSAGE_JOURNAL_DIR, history_cache_bytes: int = HISTORY_CACHE_MAX_BYTES):
+        """
+        Parameters:
+        bot: An already loaded LLMRunner; built from the LLM_BACKEND setting if None.
+        llm_workers (int): Threads available for blocking model calls.
+        history_limit (int): Most recent turns read from Mongo for the prompt.
+        summarize_history (bool): Fold turns outside the history window into a rolling summary.
+        fast_path (bool): Answer plainly phrased commands without the model.
+        response_cache: Cache backend for bot responses; an in-memory cache if None.
+        store_token_ids (bool): Persist the prompt token ids of every new pair alongside it.
+        clinical_records (bool): Apply parsed intents to the clinical record store.
+        journal_dir (str, optional): Journal turns here and write them to Mongo in the background
+            (async path only); every turn is written to Mongo directly if None.
+        history_cache_bytes (int): Memory for cached conversation histories (async path and embedded
+            message storage only); 0 disables the cache.
+        """
+        if bot is None:
+            bot = create_llm_runner()
+        if response_cache is None and RESPONSE_CACHE_SIZE:
+            response_cache = InMemoryCacheBackend(max_entries=RESPONSE_CACHE_SIZE, ttl_seconds=RESPONSE_CACHE_TTL_SECONDS)
+        self.bot = CachedLLMRunner(bot, response_cache) if response_cache is not None else bot
+        self.fast_path = FastPathParser() if fast_path else None
+        self.store_token_ids = store_token_ids
+        # Only the last `history_limit` pairs are read from Mongo; the builder then keeps
+        # the most recent ones that fit the model's history token budget.
+        self.context_builder = ContextBuilder(self.bot.count_tokens, token_budget=self.bot.history_token_budget,
+                                              max_turns=history_limit, acount_tokens=self.bot.acount_tokens)
+        # Indexes are ensured once at API startup through the async handler.
+        self.crud = MessageCrudHandler(connection_string=MONGO_CONNECTION_STRING, database_name=MONGO_DATABASE_NAME,
+                                       ensure_indexes=False, message_storage=MESSAGE_STORAGE)
+        self.async_crud = AsyncMessageCrudHandler(connection_string=MONGO_CONNECTION_STRING, database_name=MONGO_DATABASE_NAME,
+                                                  message_storage=MESSAGE_STORAGE)
+        self.clinical_store = None
+        self.async_clinical_store = None
+        if clinical_records:
+            self.clinical_store = ClinicalStore(self.crud.db, ensure_indexes=False)
+            self.async_clinical_store = AsyncClinicalStore(self.async_crud.db)
+        if history_cache_bytes and MESSAGE_STORAGE == EMBEDDED_STORAGE:
+            self.async_crud = CachedCrudHandler(self.async_crud, HistoryCache(history_cache_bytes),
+                                               history_limit=self.context_builder.max_turns)
+        if journal_dir:
+            self.async_crud = WriteBehindCrudHandler(self.async_crud, MessageJournal(journal_dir))
+        # Generation is CPU/GPU bound and synchronous, so it runs on a dedicated
+        # pool instead of the event loop. The pool should be at least as large as the
+        # runner's batch size so enough prompts can wait to be batched together.
+        self.llm_executor = ThreadPoolExecutor(max_workers=llm_workers, thread_name_prefix="llm")
+        self.idempotency = IdempotencyRegistry()
+        # Serializes turns per conversation so each one reads the history the previous
+        # one wrote; different conversations still run concurrently on the pool above.
+        self.conversation_executor = KeyedExecutor(max_pending_per_key=MAX_PENDING_TURNS_PER_CONVERSATION)
+        self.summarizer = None
+        if summarize_history:
+            self.summarizer = ConversationSummarizer(
+                self.async_crud, self.context_builder,
+                summarize=self.summarize_turns)
+
+    async def start(self):
+        """Ensure the indexes and, in write-behind mode, replay leftover journals and start the flusher."""
+        await self.ensure_indexes()
+        if isinstance(self.async_crud, WriteBehindCrudHandler):
+            await self.async_crud.start()
+
+    async def ensure_indexes(self):
+        """Create and verify the indexes of every collection the handler writes to."""
+        await self.async_crud.ensure_indexes()
+        if self.async_clinical_store:
+            await self.async_clinical_store.ensure_indexes()
+
+    def _prompt_context(self, conversation):
+        """Return the history window and summary text the prompt is built from."""
+        summary = (conversation.get('summary') or {}) if self.summarizer else {}
+        token_budget = self.summarizer.history_budget(summary) if self.summarizer else None
+        history = self.context_builder.select(conversation.get('messages', []), token_budget)
+        return history, summary.get('text', '')
+
+    async def _prompt_context_async(self, conversation):
+        """Coroutine variant of _prompt_context; tokens are counted without blocking the event loop."""
+        summary = (conversation.get('summary') or {}) if self.summarizer else {}
+        token_budget = self.summarizer.history_budget(summary) if self.summarizer else None
+        history = await self.context_builder.aselect(conversation.get('messages', []), token_budget)
+        return history, summary.get('text', '')
+
+    def _stored_pair(self, user_input, bot_message):
+        """Return the token fields stored with a new pair: its token count and, if enabled, its prompt token ids."""
+        fields = {'token_count': self.context_builder.pair_tokens(user_input, bot_message)}
+        if self.store_token_ids:
+            fields['token_ids'] = self.bot.encode_message(user_input, bot_message)
+        return fields
+
+    async def _stored_pair_async(self, user_input, bot_message):
+        """Coroutine variant of _stored_pair."""
+        fields = {'token_count': await self.context_builder.apair_tokens(user_input, bot_message)}
+        if self.store_token_ids:
+            fields['token_ids'] = await self.bot.aencode_message(user_input, bot_message)
+        return fields
+
+    @staticmethod
+    def _rejected_intent(bot_response, error):
+        """Turn a response whose intent could not be applied into an error response."""
+        return {"error": True, "intent": bot_response.get('intent'), "entities": bot_response.get('entities', {}),
+                "message": str(error)}
+
+    def _apply_intent(self, conversation_id, bot_response):
+        """Write the response's intent to the clinical records; return the response to store and send."""
+        if self.clinical_store is None:
+            return bot_response
+        try:
+            self.clinical_store.apply_intent(bot_response, conversation_id)
+        except ClinicalRecordError as e:
+            return self._rejected_intent(bot_response, e)
+        return bot_response
+
+    async def _apply_intent_async(self, conversation_id, bot_response):
+        if self.async_clinical_store is None:
+            return bot_response
+        try:
+            await self.async_clinical_store.apply_intent(bot_response, conversation_id)
+        except ClinicalRecordError as e:
+            return self._rejected_intent(bot_response, e)
+        return bot_response
+
+    def _check_fast_path_conversation(self, conversation_id):
+        """Fast-path turns skip the history read, so check the conversation exists before an intent is applied."""
+        if self.clinical_store is not None and not self.crud.conversation_exists(conversation_id):
+            raise ValueError(f"Conversation ID {conversation_id} not found.")
+
+    async def _check_fast_path_conversation_async(self, conversation_id):
+        if self.async_clinical_store is not None and not await self.async_crud.conversation_exists(conversation_id):
+            raise ValueError(f"Conversation ID {conversation_id} not found.")
+
+    def _fast_path_response(self, user_input):
+        """Return the rule-based response for `user_input`, or None when the model is needed."""
+        return self.fast_path.parse(user_input) if self.fast_path else None
 
     def handle_conversation(self, conversation_id, user_input):
         """
@@ -23,13 +208,191 @@ class ConversationHandler:
             - Updates conversation with both user input and bot response
             - Relies on bot instance to generate responses based on conversation context
         """
-        
-        # Read the current state of the conversation
-        conversation = self.crud.get_conversation(conversation_id)
 
-        bot_response = self.bot.run(prompt=user_input, messages=conversation.get('messages', []))
+        # Commands the fast path understands don't need history or the model. Unknown
+        # conversation ids are rejected before the intent touches the clinical records.
+        bot_response = self._fast_path_response(user_input)
+        if bot_response is not None:
+            self._check_fast_path_conversation(conversation_id)
+            bot_response = self._apply_intent(conversation_id, bot_response)
+            self.crud.add_message(conversation_id, user_input, bot_response['message'],
+                                  **self._stored_pair(user_input, bot_response['message']))
+            return bot_response
+
+        # Read the current state of the conversation, limited to the history the prompt uses
+        conversation = self.crud.get_conversation(conversation_id, self.context_builder.max_turns)
+        if conversation is None:
+            raise ValueError(f"Conversation ID {conversation_id} not found.")
+
+        history, summary = self._prompt_context(conversation)
+        bot_response = self.bot.run(prompt=user_input, messages=history, summary=summary)
+        if bot_response is None:
+            raise ValueError("The model did not return a valid JSON response.")
+        bot_response = self._apply_intent(conversation_id, bot_response)
 
         # Update the conversation with the new user input and bot response
-        self.crud.add_message(conversation_id, user_input, bot_response['message'])
+        self.crud.add_message(conversation_id, user_input, bot_response['message'],
+                              **self._stored_pair(user_input, bot_response['message']))
 
         return bot_response
+
+    async def handle_conversation_async(self, conversation_id, user_input, idempotency_key=None, admit=None):
+        """
+        Non-blocking variant of handle_conversation for the async API endpoints.
+
+        Database round trips go through the asyncio CRUD handler and generation runs
+        on the LLM thread pool, so the event loop stays free to serve other requests.
+        Turns of the same conversation are processed in arrival order, one at a time.
+
+        Args:
+            conversation_id (str): Unique identifier for the conversation.
+            user_input (str): The message input from the user.
+            idempotency_key (str, optional): Client-chosen key for retries. Requests repeating a
+                key for the same conversation share one model call and one stored turn.
+            admit (callable, optional): Returns an async context manager the turn runs in, e.g. an
+                AdmissionController slot. It is entered once the conversation's earlier turns have
+                finished, so a turn waiting for its conversation does not hold a slot.
+
+        Returns:
+            dict: Bot response containing the message and any additional metadata.
+
+        Raises:
+            IdempotencyKeyConflict: If the key was already used with a different user input.
+            KeyQueueFull: If too many turns are already queued for the conversation.
+        """
+        def handle():
+            queued = perf_counter()
+
+            async def turn():
+                observe_stage("queue", TURN_QUEUE_SECONDS, perf_counter() - queued)
+                async with admit() if admit else nullcontext():
+                    return await self._handle_conversation_async(conversation_id, user_input)
+            return self.conversation_executor.run(conversation_id, turn)
+
+        if idempotency_key is None:
+            return await handle()
+        return await self.idempotency.run((conversation_id, idempotency_key), user_input, handle)
+
+    async def _handle_conversation_async(self, conversation_id, user_input):
+        bot_response = self._fast_path_response(user_input)
+        if bot_response is not None:
+            await self._check_fast_path_conversation_async(conversation_id)
+            return await self._store_turn_async(conversation_id, user_input, bot_response)
+
+        with stage("history", TURN_HISTORY_SECONDS):
+            conversation = await self.async_crud.get_conversation(conversation_id, self.context_builder.max_turns)
+        if conversation is None:
+            raise ValueError(f"Conversation ID {conversation_id} not found.")
+
+        with stage("context", TURN_CONTEXT_SECONDS):
+            history, summary = await self._prompt_context_async(conversation)
+        with stage("generate", TURN_GENERATE_SECONDS):
+            bot_response = await self.run_bot(prompt=user_input, messages=history, summary=summary)
+        if bot_response is None:
+            raise ValueError("The model did not return a valid JSON response.")
+        return await self._store_turn_async(conversation_id, user_input, bot_response)
+
+    async def _store_turn_async(self, conversation_id, user_input, bot_response):
+        """Apply the response's intent, store the pair and return the response to send."""
+        with stage("intent", TURN_INTENT_SECONDS):
+            bot_response = await self._apply_intent_async(conversation_id, bot_response)
+        with stage("store", TURN_STORE_SECONDS):
+            await self.async_crud.add_message(conversation_id, user_input, bot_response['message'],
+                                              **await self._stored_pair_async(user_input, bot_response['message']))
+        return bot_response
+
+    async def stream_conversation(self, conversation_id, user_input, admit=None):
+        """
+        Streaming variant of handle_conversation_async.
+
+        Yields the response text as the model generates it, then the validated response
+        once it has been stored. Turns of the same conversation are still processed one
+        at a time.
+
+        Args:
+            conversation_id (str): Unique identifier for the conversation.
+            user_input (str): The message input from the user.
+            admit (callable, optional): Returns an async context manager entered once the
+                conversation's earlier turns have finished; see handle_conversation_async.
+
+        Yields:
+            tuple: ("token", str) for each generated text chunk, then ("result", dict) with
+                the bot response after it has been persisted. The result is an error response
+                if its intent could not be applied to the clinical records, e.g. an unknown patient.
+
+        Raises:
+            KeyQueueFull: If too many turns are already queued for the conversation.
+            ValueError: If the conversation does not exist or the model output is not valid JSON.
+        """
+        queued = perf_counter()
+        async with self.conversation_executor.hold(conversation_id):
+            observe_stage("queue", TURN_QUEUE_SECONDS, perf_counter() - queued)
+            async with admit() if admit else nullcontext():
+                bot_response = self._fast_path_response(user_input)
+                if bot_response is not None:
+                    await self._check_fast_path_conversation_async(conversation_id)
+                else:
+                    with stage("history", TURN_HISTORY_SECONDS):
+                        conversation = await self.async_crud.get_conversation(conversation_id,
+                                                                              self.context_builder.max_turns)
+                    if conversation is None:
+                        raise ValueError(f"Conversation ID {conversation_id} not found.")
+
+                    with stage("context", TURN_CONTEXT_SECONDS):
+                        history, summary = await self._prompt_context_async(conversation)
+                    extractor = JsonObjectExtractor()
+                    # Includes the time the client takes to read each chunk. The stream is closed
+                    # explicitly so a client that disconnects stops the generation at once.
+                    with stage("generate", TURN_GENERATE_SECONDS):
+                        async with aclosing(self.stream_bot(prompt=user_input, messages=history,
+                                                            summary=summary)) as stream:
+                            async for chunk in stream:
+                                extractor.feed(chunk)
+                                yield "token", chunk
+                    bot_response = extractor.parse()
+                    if bot_response is None:
+                        LLM_PARSE_FAILURES.inc()
+                        raise ValueError("The model did not return a valid JSON response.")
+
+                bot_response = await self._store_turn_async(conversation_id, user_input, bot_response)
+        yield "result", bot_response
+
+    async def run_bot(self, **kwargs):
+        """Await the bot's response: natively for async backends, on the generation thread pool otherwise."""
+        if self.bot.is_async:
+            return await self.bot.arun(**kwargs)
+        return await self.run_in_llm_pool(self.bot.run, **kwargs)
+
+    def stream_bot(self, **kwargs):
+        """Return an async iterator over the bot's streamed response text."""
+        if self.bot.is_async:
+            return self.bot.astream(**kwargs)
+        return self.iterate_in_llm_pool(self.bot.stream, **kwargs)
+
+    async def summarize_turns(self, summary, messages):
+        """Fold `messages` into `summary` with the bot, without blocking the event loop."""
+        if self.bot.is_async:
+            return await self.bot.asummarize(summary, messages)
+        return await self.run_in_llm_pool(self.bot.summarize, summary, messages)
+
+    async def run_in_llm_pool(self, fn, *args, **kwargs):
+        """Run a blocking model call on the generation thread pool and await its result."""
+        def call():
+            LLM_POOL_WAITING.dec()
+            return fn(*args, **kwargs)
+
+        LLM_POOL_WAITING.inc()
+        future = self.llm_executor.submit(call)
+        # A call cancelled before a thread picked it up never runs.
+        future.add_done_callback(lambda done: LLM_POOL_WAITING.dec() if done.cancelled() else None)
+        return await asyncio.wrap_future(future)
+
+    def iterate_in_llm_pool(self, fn, *args, **kwargs):
+        """Run a blocking generator on the generation thread pool and yield its items as they arrive."""
+        return iterate_in_executor(self.llm_executor, fn, *args, **kwargs)
+
+    async def close(self):
+        """Release database connections and the generation thread pool."""
+        self.crud.close_connection()
+        await self.async_crud.close_connection()
+        self.llm_executor.shutdown(wait=False)
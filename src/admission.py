@@ -0,0 +1,171 @@
+import asyncio
+import math
+import time
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+from src.metrics import REGISTRY
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+# Lanes in the order they are served: a waiting interactive turn always starts before a bulk one.
+LANES = (INTERACTIVE, BULK)
+
+QUEUE_DEPTH = {lane: REGISTRY.gauge(f"admission_queue_depth_{lane}", f"Requests waiting in the {lane} lane.")
+               for lane in LANES}
+RUNNING = REGISTRY.gauge("admission_running", "Requests admitted and currently being processed.")
+WAIT_SECONDS = REGISTRY.histogram("admission_wait_seconds", "Time requests waited for admission.")
+SERVICE_SECONDS = REGISTRY.histogram("admission_service_seconds", "Time admitted requests took to process.")
+REJECTED = REGISTRY.counter("admission_rejected_total", "Requests rejected because their lane's queue was full.")
+
+
+class Overloaded(Exception):
+    """The admission queue is full; the client should retry after `retry_after` seconds."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Server is overloaded, retry in {retry_after} seconds.")
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("future", "facility", "queued_at")
+
+    def __init__(self, future, facility, queued_at):
+        self.future = future
+        self.facility = facility
+        self.queued_at = queued_at
+
+
+class AdmissionController:
+    """Bounded admission queue with priority lanes and per-facility concurrency limits.
+
+    At most `max_concurrency` requests are processed at once. Others wait in their
+    lane, interactive before bulk, in arrival order; a waiting request whose facility
+    is at its limit is skipped until one of that facility's requests finishes. When a
+    lane already holds `max_queue` requests, new ones are rejected immediately with a
+    Retry-After estimate derived from the moving average of observed service times.
+    """
+
+    def __init__(self, max_concurrency: int = 16, max_queue: int = 64,
+                 facility_limits: Optional[Dict[str, int]] = None, default_facility_limit: Optional[int] = None,
+                 initial_service_seconds: float = 1.0, smoothing: float = 0.2):
+        """
+        Parameters:
+        max_concurrency (int): Requests processed at once across all facilities.
+        max_queue (int): Requests allowed to wait in each lane before new ones are rejected.
+        facility_limits (Dict[str, int], optional): Concurrency limit per facility id.
+        default_facility_limit (int, optional): Limit for facilities not in `facility_limits`; unlimited if None.
+        initial_service_seconds (float): Service time assumed before any request has completed.
+        smoothing (float): Weight of the newest observation in the service time moving average.
+        """
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.facility_limits = facility_limits or {}
+        self.default_facility_limit = default_facility_limit
+        self.service_seconds = initial_service_seconds
+        self.smoothing = smoothing
+        self.running = 0
+        self._facility_running: Dict[Optional[str], int] = defaultdict(int)
+        self._lanes = {lane: deque() for lane in LANES}
+
+    def queue_depth(self, lane: Optional[str] = None) -> int:
+        """Number of requests waiting in `lane`, or in all lanes."""
+        return len(self._lanes[lane]) if lane else sum(len(queue) for queue in self._lanes.values())
+
+    def retry_after(self) -> int:
+        """Seconds until the current backlog is expected to have drained, at least 1."""
+        backlog = self.queue_depth() + self.running
+        return max(1, math.ceil(self.service_seconds * backlog / self.max_concurrency))
+
+    def check(self, lane: str = INTERACTIVE):
+        """Raise Overloaded if `lane` has no room for another request.
+
+        Raises:
+            Overloaded: If the lane's queue is full.
+            ValueError: If `lane` is not a known lane.
+        """
+        if lane not in self._lanes:
+            raise ValueError(f"Unknown priority lane {lane}.")
+        if len(self._lanes[lane]) >= self.max_queue:
+            REJECTED.inc()
+            raise Overloaded(self.retry_after())
+
+    @asynccontextmanager
+    async def admit(self, facility: Optional[str] = None, lane: str = INTERACTIVE):
+        """Wait for a processing slot and hold it for the duration of the `async with` block.
+
+        Args:
+            facility (str, optional): Facility the request belongs to, for per-facility limits.
+            lane (str): INTERACTIVE or BULK.
+
+        Raises:
+            Overloaded: If the lane's queue is full.
+            ValueError: If `lane` is not a known lane.
+        """
+        self.check(lane)
+        queue = self._lanes[lane]
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), facility, time.monotonic())
+        queue.append(waiter)
+        QUEUE_DEPTH[lane].inc()
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter in queue:
+                queue.remove(waiter)
+                QUEUE_DEPTH[lane].dec()
+            elif waiter.future.done() and not waiter.future.cancelled():
+                # Admitted in the same step as the cancellation; give the slot back.
+                self._release(facility)
+            raise
+
+        started = time.monotonic()
+        WAIT_SECONDS.observe(started - waiter.queued_at)
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            SERVICE_SECONDS.observe(elapsed)
+            self.service_seconds += self.smoothing * (elapsed - self.service_seconds)
+            self._release(facility)
+
+    def _facility_limit(self, facility: Optional[str]) -> Optional[int]:
+        return self.facility_limits.get(facility, self.default_facility_limit) if facility is not None else None
+
+    def _has_capacity(self, facility: Optional[str]) -> bool:
+        limit = self._facility_limit(facility)
+        return limit is None or self._facility_running.get(facility, 0) < limit
+
+    def _release(self, facility: Optional[str]):
+        self.running -= 1
+        RUNNING.dec()
+        self._facility_running[facility] -= 1
+        if not self._facility_running[facility]:
+            del self._facility_running[facility]
+        self._dispatch()
+
+    def _dispatch(self):
+        """Start waiting requests while there are free slots, highest lane first."""
+        while self.running < self.max_concurrency:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+            self.running += 1
+            RUNNING.inc()
+            self._facility_running[waiter.facility] += 1
+            waiter.future.set_result(None)
+
+    def _next_waiter(self) -> Optional[_Waiter]:
+        for lane in LANES:
+            queue = self._lanes[lane]
+            for waiter in list(queue):
+                if waiter.future.done():
+                    # Cancelled while queued: drop it so it never takes a slot.
+                    queue.remove(waiter)
+                    QUEUE_DEPTH[lane].dec()
+                elif self._has_capacity(waiter.facility):
+                    queue.remove(waiter)
+                    QUEUE_DEPTH[lane].dec()
+                    return waiter
+        return None
@@ -0,0 +1,132 @@
+from datetime import date
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from src.clinical_store import (ADD_PATIENT, ASSIGN_MEDICATION, FOLLOWUP_INDEXES, FOLLOWUP_PROJECTION,
+                                FOLLOWUP_SORT, MEDICATION_INDEXES, OBSOLETE_PATIENT_INDEXES, PATIENT_INDEXES,
+                                PATIENT_PROJECTION, duplicate_patient_error, followup_document,
+                                followup_filter, followup_page, medication_document, patient_document,
+                                patient_filter, single_patient, unknown_patient_error, validate_intent)
+from src.crud_handler import verify_indexes
+
+
+class AsyncClinicalStore:
+    """Asyncio-native counterpart of ClinicalStore, for the async conversation path and API."""
+
+    def __init__(self, db):
+        """
+        Parameters:
+        db: The async Database holding the clinical record collections, e.g. AsyncMessageCrudHandler.db.
+        """
+        self.db = db
+        self.patients = db.patients
+        self.medications = db.medications
+        self.followups = db.followups
+
+    async def ensure_indexes(self):
+        """
+        Create the clinical record indexes if needed and verify they match the expected definition.
+
+        Raises:
+        RuntimeError: If an existing index conflicts with the required definition.
+        """
+        for name in OBSOLETE_PATIENT_INDEXES:
+            if name in await self.patients.index_information():
+                await self.patients.drop_index(name)
+        for collection, indexes in ((self.patients, PATIENT_INDEXES), (self.medications, MEDICATION_INDEXES),
+                                    (self.followups, FOLLOWUP_INDEXES)):
+            for keys, options in indexes:
+                await collection.create_index(keys, **options)
+            verify_indexes(await collection.index_information(), indexes, collection.name)
+
+    async def find_patient(self, name: str, ward: Optional[str] = None) -> Optional[Dict]:
+        """Return the patient whose name matches `name` up to case and spacing, or None.
+
+        Raises:
+            ClinicalRecordError: If no ward is given and patients in several wards have that name.
+        """
+        patients = await self.patients.find(patient_filter(name, ward), PATIENT_PROJECTION).limit(2).to_list(None)
+        return single_patient(patients, name)
+
+    async def apply_intent(self, response: Dict, conversation_id: str) -> Optional[Dict]:
+        """Write the record a bot response describes; see ClinicalStore.apply_intent.
+
+        Raises:
+            ClinicalRecordError: If entities are missing, the patient is unknown or ambiguous,
+                or a patient with the same name already exists in the ward.
+        """
+        validated = validate_intent(response)
+        if validated is None:
+            return None
+        intent, entities = validated
+        if intent == ADD_PATIENT:
+            document = patient_document(entities, conversation_id)
+            try:
+                await self.patients.insert_one(document)
+            except DuplicateKeyError:
+                raise duplicate_patient_error(document)
+            return document
+        patient = await self.find_patient(str(entities['patient_name']), entities.get('ward'))
+        if patient is None:
+            raise unknown_patient_error(entities['patient_name'])
+        if intent == ASSIGN_MEDICATION:
+            document = medication_document(patient, entities, conversation_id)
+            await self.medications.insert_one(document)
+            return document
+        document = followup_document(patient, entities, conversation_id)
+        try:
+            await self.followups.insert_one(document)
+        except DuplicateKeyError:
+            pass
+        return document
+
+    async def get_medications(self, patient_name: str, ward: Optional[str] = None) -> List[Dict]:
+        """Return a patient's medications, oldest first.
+
+        Raises:
+            ClinicalRecordError: If no patient has that name, or several do and no ward is given.
+        """
+        patient = await self.find_patient(patient_name, ward)
+        if patient is None:
+            raise unknown_patient_error(patient_name)
+        cursor = self.medications.find({'patient_id': patient['patient_id']}, {'_id': 0}).sort('assigned_at', ASCENDING)
+        return await cursor.to_list(None)
+
+    async def followup_query(self, start: Optional[date] = None, end: Optional[date] = None,
+                             patient_name: Optional[str] = None, ward: Optional[str] = None,
+                             cursor: Optional[str] = None) -> Dict:
+        """Build the filter for follow-up queries, resolving `patient_name` to its patient.
+
+        Raises:
+            ClinicalRecordError: If no patient has that name, or several do and no ward is given.
+            ValueError: If the cursor is invalid.
+        """
+        patient_id = None
+        if patient_name is not None:
+            patient = await self.find_patient(patient_name, ward)
+            if patient is None:
+                raise unknown_patient_error(patient_name)
+            patient_id = patient['patient_id']
+        return followup_filter(start, end, patient_id, ward, cursor)
+
+    async def find_followups(self, start: Optional[date] = None, end: Optional[date] = None,
+                             patient_name: Optional[str] = None, ward: Optional[str] = None, limit: int = 100,
+                             cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """Return one page of follow-ups, ordered by date, and the cursor of the next page.
+
+        See ClinicalStore.find_followups.
+
+        Raises:
+            ClinicalRecordError: If no patient has that name, or several do and no ward is given.
+            ValueError: If the cursor is invalid.
+        """
+        query = await self.followup_query(start, end, patient_name, ward, cursor)
+        results = self.followups.find(query, FOLLOWUP_PROJECTION).sort(FOLLOWUP_SORT).limit(limit + 1)
+        return followup_page(await results.to_list(None), limit)
+
+    async def iter_followups(self, query: Dict, batch_size: int = 1000) -> AsyncIterator[Dict]:
+        """Yield every follow-up matching a followup_query filter, ordered by date, fetched in batches."""
+        results = self.followups.find(query, FOLLOWUP_PROJECTION).sort(FOLLOWUP_SORT).batch_size(batch_size)
+        async for followup in results:
+            yield followup
@@ -0,0 +1,363 @@
+from pymongo import AsyncMongoClient, ReturnDocument, ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from typing import List, Dict, Optional, Tuple
+import uuid
+
+from src.crud_handler import (COLLECTION_STORAGE, CONVERSATION_INDEXES, EMBEDDED_STORAGE, MESSAGE_INDEXES,
+                              MESSAGE_PROJECTION, MESSAGE_STORAGE_MODES, MONGO_HISTORY_READ_SECONDS,
+                              MONGO_MESSAGE_WRITE_SECONDS, failed_duplicate_indexes,
+                              history_projection, message_document, message_push_update,
+                              new_conversation_document, page_projection, sequence_increment_update,
+                              summary_state_pipeline, summary_update, verify_indexes)
+from src.metrics import timed
+
+
+class AsyncMessageCrudHandler:
+    """Asyncio-native counterpart of MessageCrudHandler.
+
+    Exposes the same create/add/get/delete API as MessageCrudHandler, but every
+    database round trip is awaited so the FastAPI event loop is never blocked.
+    Handlers created with the same connection string share one AsyncMongoClient,
+    and therefore one connection pool, for the lifetime of the process.
+    """
+
+    _clients: Dict[str, AsyncMongoClient] = {}
+
+    def __init__(self, connection_string: str, database_name: str, client=None, max_pool_size: int = 100,
+                 message_storage: str = EMBEDDED_STORAGE):
+        """
+        Initialize the shared MongoDB client and database.
+
+        Parameters:
+        connection_string (str): MongoDB connection string.
+        database_name (str): Name of the database to connect to.
+        client: Optional pre-built async client (e.g. an in-memory stand-in used in tests).
+        max_pool_size (int): Maximum number of pooled connections when a new client is created.
+        message_storage (str): EMBEDDED_STORAGE or COLLECTION_STORAGE, see MessageCrudHandler.
+        """
+        if message_storage not in MESSAGE_STORAGE_MODES:
+            raise ValueError(f"Unknown message storage mode {message_storage}.")
+        self.message_storage = message_storage
+        self.connection_string = connection_string
+        self.client = client if client is not None else self._get_shared_client(connection_string, max_pool_size)
+        self.db = self.client[database_name]
+        self.conversations = self.db.conversations
+        self.messages = self.db.messages
+
+    @classmethod
+    def _get_shared_client(cls, connection_string: str, max_pool_size: int) -> AsyncMongoClient:
+        client = cls._clients.get(connection_string)
+        if client is None:
+            client = AsyncMongoClient(connection_string, maxPoolSize=max_pool_size)
+            cls._clients[connection_string] = client
+        return client
+
+    async def ensure_indexes(self):
+        """
+        Create the conversation indexes if needed and verify they match the expected definition.
+
+        Raises:
+        RuntimeError: If an existing index conflicts with the required definition.
+        """
+        for keys, options in CONVERSATION_INDEXES:
+            await self.conversations.create_index(keys, **options)
+        verify_indexes(await self.conversations.index_information())
+        if self.message_storage == COLLECTION_STORAGE:
+            for keys, options in MESSAGE_INDEXES:
+                await self.messages.create_index(keys, **options)
+            verify_indexes(await self.messages.index_information(), MESSAGE_INDEXES, 'messages')
+
+    async def create_conversation(self, conversation_id: str) -> str:
+        """Create a new conversation with empty messages.
+
+        Args:
+            conversation_id (str): Unique identifier for the conversation
+
+        Returns:
+            str: The ObjectId of the inserted conversation document as a string
+
+        Raises:
+            ValueError: If a conversation with this ID already exists.
+        """
+        try:
+            result = await self.conversations.insert_one(new_conversation_document(conversation_id, self.message_storage))
+        except DuplicateKeyError:
+            raise ValueError(f"Conversation ID {conversation_id} already exists.")
+        return str(result.inserted_id)
+
+    async def allocate_conversation_id(self) -> str:
+        """Create a conversation under a freshly generated UUID and return that ID.
+
+        Returns:
+            str: The new conversation ID.
+        """
+        while True:
+            conversation_id = str(uuid.uuid4())
+            try:
+                await self.conversations.insert_one(new_conversation_document(conversation_id, self.message_storage))
+                return conversation_id
+            except DuplicateKeyError:
+                continue
+
+    async def allocate_conversation_ids(self, count: int) -> List[str]:
+        """Pre-allocate `count` new conversations with a single unordered insert_many.
+
+        Args:
+            count (int): Number of conversations to create.
+
+        Returns:
+            List[str]: The new conversation IDs.
+        """
+        allocated = []
+        pending = [str(uuid.uuid4()) for _ in range(count)]
+        while pending:
+            try:
+                await self.conversations.insert_many(
+                    [new_conversation_document(conversation_id, self.message_storage) for conversation_id in pending], ordered=False)
+                failed = []
+            except BulkWriteError as e:
+                failed = failed_duplicate_indexes(e)
+            allocated.extend(conversation_id for i, conversation_id in enumerate(pending) if i not in failed)
+            pending = [str(uuid.uuid4()) for _ in failed]
+        return allocated
+
+    @timed(MONGO_MESSAGE_WRITE_SECONDS)
+    async def add_message(self, conversation_id: str, nurse_message: str, bot_message: str,
+                          token_count: Optional[int] = None, token_ids: Optional[Dict] = None) -> bool:
+        """Add a new message pair to existing conversation.
+
+        Args:
+            conversation_id (str): The unique identifier of the conversation.
+            nurse_message (str): The message sent by the nurse.
+            bot_message (str): The response generated by the bot.
+            token_count (Optional[int]): Prompt token count of the pair, stored so it is never re-tokenized.
+            token_ids (Optional[Dict]): Prompt token ids of the pair from LLMBackend.encode_message.
+
+        Returns:
+            bool: True if the message pair was successfully added, False otherwise.
+
+        Raises:
+            ValueError: If the conversation_id does not exist in the database.
+        """
+        if self.message_storage == COLLECTION_STORAGE:
+            await self._insert_message(conversation_id, nurse_message, bot_message, token_count, token_ids)
+            return True
+        result = await self.conversations.update_one(
+            {'conversation_id': conversation_id},
+            message_push_update(nurse_message, bot_message, token_count, token_ids)
+        )
+        if result.matched_count == 0:
+            raise ValueError(f"Conversation ID {conversation_id} not found.")
+        return result.modified_count > 0
+
+    @timed(MONGO_MESSAGE_WRITE_SECONDS)
+    async def push_message(self, conversation_id: str, nurse_message: str, bot_message: str,
+                           token_count: Optional[int] = None, token_ids: Optional[Dict] = None) -> int:
+        """Add a message pair and return the conversation's new history_version.
+
+        Lets a cache of the history apply the write itself instead of reading the history again.
+
+        Raises:
+            ValueError: If the conversation_id does not exist in the database.
+        """
+        if self.message_storage == COLLECTION_STORAGE:
+            _, history_version = await self._insert_message(conversation_id, nurse_message, bot_message,
+                                                            token_count, token_ids)
+            return history_version
+        conversation = await self.conversations.find_one_and_update(
+            {'conversation_id': conversation_id},
+            message_push_update(nurse_message, bot_message, token_count, token_ids),
+            projection={'history_version': 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if conversation is None:
+            raise ValueError(f"Conversation ID {conversation_id} not found.")
+        return conversation['history_version']
+
+    @timed(MONGO_MESSAGE_WRITE_SECONDS)
+    async def append_message(self, conversation_id: str, nurse_message: str, bot_message: str,
+                             history_limit: Optional[int] = None, token_count: Optional[int] = None,
+                             token_ids: Optional[Dict] = None) -> Optional[Dict]:
+        """Add a message pair and read back the updated conversation.
+
+        With embedded storage the push and the read are one atomic round trip; with the
+        messages collection the pair is inserted first and the history read afterwards.
+
+        Args:
+            conversation_id (str): The unique identifier of the conversation.
+            nurse_message (str): The message sent by the nurse.
+            bot_message (str): The response generated by the bot.
+            history_limit (Optional[int]): Number of most recent message pairs to return.
+                Returns the full history when None.
+            token_count (Optional[int]): Prompt token count of the pair, stored alongside it.
+            token_ids (Optional[Dict]): Prompt token ids of the pair from LLMBackend.encode_message.
+
+        Returns:
+            Optional[Dict]: The conversation after the append, as get_conversation returns it,
+            or None if the conversation does not exist.
+        """
+        if self.message_storage == COLLECTION_STORAGE:
+            try:
+                await self._insert_message(conversation_id, nurse_message, bot_message, token_count, token_ids)
+            except ValueError:
+                return None
+            return await self.get_conversation(conversation_id, history_limit)
+        return await self.conversations.find_one_and_update(
+            {'conversation_id': conversation_id},
+            message_push_update(nurse_message, bot_message, token_count, token_ids),
+            projection=history_projection(history_limit),
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def conversation_exists(self, conversation_id: str) -> bool:
+        """Check whether a conversation exists, using only the conversation_id index."""
+        return await self.conversations.count_documents({'conversation_id': conversation_id}, limit=1) > 0
+
+    @timed(MONGO_HISTORY_READ_SECONDS)
+    async def get_conversation(self, conversation_id: str, history_limit: Optional[int] = None) -> Optional[Dict]:
+        """Retrieve a conversation by its ID.
+
+        Args:
+            conversation_id (str): The unique identifier of the conversation to retrieve.
+            history_limit (Optional[int]): If given, only the last `history_limit` message
+                pairs are transferred from the database.
+
+        Returns:
+            Optional[Dict]: A dictionary containing the conversation data if found, None otherwise.
+        """
+        if self.message_storage == COLLECTION_STORAGE:
+            conversation = await self.conversations.find_one({'conversation_id': conversation_id})
+            if not conversation:
+                return None
+            conversation['messages'] = await self._tail_messages(conversation_id, history_limit)
+            return conversation
+        conversation = await self.conversations.find_one(
+            {'conversation_id': conversation_id}, history_projection(history_limit))
+        if not conversation:
+            return None
+        return conversation
+
+    async def get_messages(self, conversation_id: str, history_limit: Optional[int] = None) -> List[Dict]:
+        """Get all messages from a conversation.
+
+        Args:
+            conversation_id (str): The unique identifier of the conversation
+            history_limit (Optional[int]): If given, only the last `history_limit` messages are returned.
+
+        Returns:
+            List[Dict]: A list of message dictionaries.
+            Returns empty list if conversation not found or has no messages.
+        """
+        if self.message_storage == COLLECTION_STORAGE:
+            return await self._tail_messages(conversation_id, history_limit)
+        conversation = await self.get_conversation(conversation_id, history_limit)
+        return conversation.get('messages', []) if conversation else []
+
+    async def get_messages_page(self, conversation_id: str, start: int = 0, limit: int = 50) -> List[Dict]:
+        """Get one page of messages in chronological order.
+
+        Args:
+            conversation_id (str): The unique identifier of the conversation
+            start (int): Sequence number of the first message to return.
+            limit (int): Maximum number of messages to return.
+
+        Returns:
+            List[Dict]: Up to `limit` message dictionaries carrying their 'seq'.
+            Empty if the conversation is not found.
+        """
+        if self.message_storage == COLLECTION_STORAGE:
+            cursor = self.messages.find(
+                {'conversation_id': conversation_id, 'seq': {'$gte': start}}, MESSAGE_PROJECTION
+            ).sort('seq', ASCENDING).limit(limit)
+            return await cursor.to_list(None)
+        conversation = await self.conversations.find_one(
+            {'conversation_id': conversation_id}, page_projection(start, limit))
+        if not conversation:
+            return []
+        return [dict(message, seq=start + i) for i, message in enumerate(conversation.get('messages', []))]
+
+    async def _insert_message(self, conversation_id: str, nurse_message: str, bot_message: str,
+                               token_count: Optional[int] = None, token_ids: Optional[Dict] = None) -> Tuple[int, int]:
+        """Reserve the next sequence number and store the pair in the messages collection.
+
+        Returns:
+            Tuple[int, int]: The pair's sequence number and the conversation's new history_version.
+        """
+        conversation = await self.conversations.find_one_and_update(
+            {'conversation_id': conversation_id},
+            sequence_increment_update(),
+            projection={'message_count': 1, 'history_version': 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if conversation is None:
+            raise ValueError(f"Conversation ID {conversation_id} not found.")
+        seq = conversation['message_count'] - 1
+        await self.messages.insert_one(
+            message_document(conversation_id, seq, nurse_message, bot_message, token_count, token_ids))
+        return seq, conversation['history_version']
+
+    async def _tail_messages(self, conversation_id: str, history_limit: Optional[int] = None) -> List[Dict]:
+        """Read the last `history_limit` pairs (or all of them) from the messages collection, oldest first."""
+        if history_limit is None:
+            cursor = self.messages.find(
+                {'conversation_id': conversation_id}, MESSAGE_PROJECTION).sort('seq', ASCENDING)
+            return await cursor.to_list(None)
+        if history_limit <= 0:
+            return []
+        cursor = self.messages.find(
+            {'conversation_id': conversation_id}, MESSAGE_PROJECTION).sort('seq', DESCENDING).limit(history_limit)
+        return (await cursor.to_list(None))[::-1]
+
+    async def get_summary_state(self, conversation_id: str) -> Optional[Dict]:
+        """Get a conversation's rolling summary and its total number of message pairs.
+
+        Returns:
+            Optional[Dict]: {'summary': {...} (absent if never summarized), 'message_count': int},
+            or None if the conversation is not found.
+        """
+        cursor = await self.conversations.aggregate(summary_state_pipeline(conversation_id))
+        states = await cursor.to_list(1)
+        return states[0] if states else None
+
+    async def update_summary(self, conversation_id: str, text: str, covered: int, expected_version: int,
+                             token_count: Optional[int] = None) -> bool:
+        """Store a new version of the conversation's rolling summary.
+
+        Returns:
+            bool: True if stored, False if another writer updated the summary first.
+        """
+        query, update = summary_update(conversation_id, text, covered, expected_version, token_count)
+        result = await self.conversations.update_one(query, update)
+        return result.modified_count > 0
+
+    async def delete_conversation(self, conversation_id: str) -> bool:
+        """
+        Delete a conversation by its ID.
+
+        Parameters:
+        conversation_id (str): The ID of the conversation to delete.
+
+        Returns:
+        bool: True if the conversation was deleted, False otherwise.
+
+        Raises:
+        ValueError: If the conversation_id does not exist in the database.
+        """
+        result = await self.conversations.delete_one(
+            {'conversation_id': conversation_id})
+        if result.deleted_count == 0:
+            raise ValueError(f"Conversation ID {conversation_id} not found.")
+        if self.message_storage == COLLECTION_STORAGE:
+            await self.messages.delete_many({'conversation_id': conversation_id})
+        return True
+
+    async def close_connection(self):
+        """
+        Close the shared MongoDB client.
+
+        Every handler sharing this connection string loses its pool, so this should
+        only be called on application shutdown.
+        """
+        if self._clients.get(self.connection_string) is self.client:
+            del self._clients[self.connection_string]
+        await self.client.close()
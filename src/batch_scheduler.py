@@ -0,0 +1,103 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List
+
+from src.metrics import REGISTRY
+
+_STOP = object()
+
+BATCH_SIZE = REGISTRY.histogram("llm_batch_size", "Number of prompts generated together in one batch.",
+                                buckets=(1, 2, 4, 8, 16, 32, 64))
+BATCH_WAIT_SECONDS = REGISTRY.histogram("llm_batch_wait_seconds", "Time a prompt waited before its batch started.")
+BATCH_QUEUE_DEPTH = REGISTRY.gauge("llm_batch_queue_depth", "Prompts waiting for the batch scheduler.")
+
+
+class BatchScheduler:
+    """Gathers concurrent generation requests into padded batches for a single model.
+
+    Callers submit requests from any thread and receive a Future. A dedicated worker
+    thread takes the first waiting request, keeps collecting more for up to
+    `max_wait_ms` or until `max_batch_size` is reached, runs them together through
+    `generate_batch` and routes each result (or the batch's exception) back to its
+    caller's future. Requests left without a result fail with a RuntimeError.
+    """
+
+    def __init__(self, generate_batch: Callable[[List[Any]], List[Any]], max_batch_size: int = 8,
+                 max_wait_ms: float = 10):
+        """
+        Parameters:
+        generate_batch (Callable): Takes a list of requests and returns their results in the same order.
+        max_batch_size (int): Maximum number of requests run in one batch.
+        max_wait_ms (float): How long the first request of a batch waits for others to join it.
+        """
+        self.generate_batch = generate_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+        self._worker.start()
+
+    def submit(self, request) -> Future:
+        """Queue a request and return a Future resolved with its result."""
+        future = Future()
+        self._queue.put((request, future, time.monotonic()))
+        BATCH_QUEUE_DEPTH.inc()
+        return future
+
+    def run(self, request):
+        """Submit a request and block until its result is available."""
+        return self.submit(request).result()
+
+    def close(self):
+        """Stop the worker after the requests already queued have been served."""
+        self._queue.put(_STOP)
+        self._worker.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._execute(batch)
+
+    def _execute(self, batch):
+        BATCH_QUEUE_DEPTH.dec(len(batch))
+        started = time.monotonic()
+        running = []
+        for request, future, queued_at in batch:
+            # Callers may have cancelled their future while it was queued.
+            if future.set_running_or_notify_cancel():
+                BATCH_WAIT_SECONDS.observe(started - queued_at)
+                running.append((request, future))
+        batch = running
+        if not batch:
+            return
+        BATCH_SIZE.observe(len(batch))
+        try:
+            results = list(self.generate_batch([request for request, _ in batch]))
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+        # A short result list must not leave callers waiting forever.
+        if len(results) < len(batch):
+            error = RuntimeError(f"generate_batch returned {len(results)} results for {len(batch)} requests.")
+            for _, future in batch[len(results):]:
+                future.set_exception(error)
@@ -0,0 +1,371 @@
+import base64
+import json
+import re
+import uuid
+from datetime import date, datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+from src.crud_handler import verify_indexes
+
+ADD_PATIENT = 'add_patient'
+ASSIGN_MEDICATION = 'assign_medication'
+SCHEDULE_FOLLOWUP = 'schedule_followup'
+
+# Entities every intent must carry before it is written to the clinical records.
+REQUIRED_ENTITIES = {
+    ADD_PATIENT: ('name', 'gender', 'age', 'condition'),
+    ASSIGN_MEDICATION: ('patient_name', 'medication', 'dosage', 'frequency'),
+    SCHEDULE_FOLLOWUP: ('patient_name', 'date'),
+}
+
+# Patients are identified by name within their ward: a normalized name maps to one
+# patient per ward, and commands name the ward when several wards have one.
+PATIENT_INDEXES = [
+    ([('name_key', ASCENDING), ('ward', ASCENDING)], {'name': 'name_key_ward_unique', 'unique': True}),
+    ([('patient_id', ASCENDING)], {'name': 'patient_id_unique', 'unique': True}),
+]
+# Indexes of earlier versions that would still reject valid records; dropped on startup.
+OBSOLETE_PATIENT_INDEXES = ('name_key_unique',)
+
+MEDICATION_INDEXES = [
+    ([('patient_id', ASCENDING), ('assigned_at', ASCENDING)], {'name': 'patient_id_assigned_at'}),
+]
+
+# The first is unique so a patient is never booked twice on one day and retried turns
+# don't duplicate a follow-up. Every follow-up query is sorted by (date, patient_id);
+# the other two serve the per-patient and per-ward views.
+FOLLOWUP_INDEXES = [
+    ([('date', ASCENDING), ('patient_id', ASCENDING)], {'name': 'date_patient_id_unique', 'unique': True}),
+    ([('patient_id', ASCENDING), ('date', ASCENDING)], {'name': 'patient_id_date'}),
+    ([('ward', ASCENDING), ('date', ASCENDING), ('patient_id', ASCENDING)], {'name': 'ward_date_patient_id'}),
+]
+
+PATIENT_PROJECTION = {'_id': 0}
+FOLLOWUP_PROJECTION = {'_id': 0, 'date': 1, 'patient_id': 1, 'patient_name': 1, 'ward': 1}
+FOLLOWUP_SORT = [('date', ASCENDING), ('patient_id', ASCENDING)]
+
+WHITESPACE = re.compile(r"\s+")
+
+
+class ClinicalRecordError(ValueError):
+    """A parsed intent cannot be applied, e.g. it names a patient that does not exist."""
+
+
+def normalize_name(name: str) -> str:
+    """Return the lookup key of a patient name: whitespace collapsed and case folded."""
+    return WHITESPACE.sub(' ', name).strip().casefold()
+
+
+def validate_intent(response: Dict) -> Optional[Tuple[str, Dict]]:
+    """Return the (intent, entities) of a bot response that should change the clinical records.
+
+    Error responses and intents other than add_patient, assign_medication and
+    schedule_followup change nothing and return None.
+
+    Raises:
+        ClinicalRecordError: If a required entity is missing or malformed.
+    """
+    intent = response.get('intent')
+    if response.get('error') or intent not in REQUIRED_ENTITIES:
+        return None
+    entities = response.get('entities') or {}
+    missing = [name for name in REQUIRED_ENTITIES[intent] if entities.get(name) in (None, '')]
+    if missing:
+        raise ClinicalRecordError(f"Please provide the following information: {', '.join(missing)}.")
+    if intent == ADD_PATIENT:
+        try:
+            age = int(entities['age'])
+        except (TypeError, ValueError):
+            raise ClinicalRecordError(f"Age {entities['age']} is not a number.")
+        if not 0 <= age <= 150:
+            raise ClinicalRecordError(f"Age {age} is out of range.")
+        if not normalize_name(str(entities['name'])):
+            raise ClinicalRecordError("The patient name is empty.")
+    if intent == SCHEDULE_FOLLOWUP:
+        try:
+            date.fromisoformat(str(entities['date']))
+        except ValueError:
+            raise ClinicalRecordError(f"Date {entities['date']} is not in YYYY-MM-DD format.")
+    return intent, entities
+
+
+def patient_document(entities: Dict, conversation_id: str) -> Dict:
+    """Build the patients document for a validated add_patient intent."""
+    name = WHITESPACE.sub(' ', str(entities['name'])).strip()
+    return {
+        'patient_id': str(uuid.uuid4()),
+        'name': name,
+        'name_key': normalize_name(name),
+        'gender': str(entities['gender']).lower(),
+        'age': int(entities['age']),
+        'condition': entities['condition'],
+        'ward': entities.get('ward') or None,
+        'conversation_id': conversation_id,
+        'created_at': datetime.now()
+    }
+
+
+def medication_document(patient: Dict, entities: Dict, conversation_id: str) -> Dict:
+    """Build the medications document for a validated assign_medication intent."""
+    return {
+        'patient_id': patient['patient_id'],
+        'patient_name': patient['name'],
+        'medication': entities['medication'],
+        'dosage': entities['dosage'],
+        'frequency': entities['frequency'],
+        'conversation_id': conversation_id,
+        'assigned_at': datetime.now()
+    }
+
+
+def followup_document(patient: Dict, entities: Dict, conversation_id: str) -> Dict:
+    """Build the followups document for a validated schedule_followup intent.
+
+    The date is stored as an ISO string, which sorts and range-queries like the date itself.
+    The patient's ward is copied so ward views are one index range scan. It is the ward at
+    scheduling time: no intent moves a patient, so whoever edits a patient's ward directly
+    must update the ward of that patient's follow-ups too.
+    """
+    return {
+        'date': date.fromisoformat(str(entities['date'])).isoformat(),
+        'patient_id': patient['patient_id'],
+        'patient_name': patient['name'],
+        'ward': patient.get('ward'),
+        'conversation_id': conversation_id,
+        'created_at': datetime.now()
+    }
+
+
+def encode_cursor(followup: Dict) -> str:
+    """Return the opaque pagination cursor pointing just past `followup`."""
+    return base64.urlsafe_b64encode(json.dumps([followup['date'], followup['patient_id']]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    """Return the (date, patient_id) a cursor points past.
+
+    Raises:
+        ValueError: If the cursor was not produced by encode_cursor.
+    """
+    try:
+        followup_date, patient_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor.")
+    if not isinstance(followup_date, str) or not isinstance(patient_id, str):
+        raise ValueError("Invalid cursor.")
+    return followup_date, patient_id
+
+
+def followup_filter(start: Optional[date] = None, end: Optional[date] = None, patient_id: Optional[str] = None,
+                    ward: Optional[str] = None, cursor: Optional[str] = None) -> Dict:
+    """Build the followups filter for an inclusive date range, optionally narrowed to one patient or ward.
+
+    With a cursor, only follow-ups sorted after it by (date, patient_id) match, so each
+    page is an index range scan however deep the client has paged.
+
+    Raises:
+        ValueError: If the cursor is invalid.
+    """
+    query = {}
+    if start is not None or end is not None:
+        query['date'] = {}
+        if start is not None:
+            query['date']['$gte'] = start.isoformat()
+        if end is not None:
+            query['date']['$lte'] = end.isoformat()
+    if patient_id is not None:
+        query['patient_id'] = patient_id
+    if ward is not None:
+        query['ward'] = ward
+    if cursor is not None:
+        after_date, after_patient_id = decode_cursor(cursor)
+        query = {'$and': [query, {'$or': [
+            {'date': {'$gt': after_date}},
+            {'date': after_date, 'patient_id': {'$gt': after_patient_id}}
+        ]}]}
+    return query
+
+
+def followup_page(followups: List[Dict], limit: int) -> Tuple[List[Dict], Optional[str]]:
+    """Split `limit + 1` fetched follow-ups into the page and the cursor of the next one (None on the last page)."""
+    if len(followups) <= limit:
+        return followups, None
+    followups = followups[:limit]
+    return followups, encode_cursor(followups[-1])
+
+
+def patient_filter(name: str, ward: Optional[str] = None) -> Dict:
+    """Build the patients filter for a name, narrowed to one ward if given."""
+    query = {'name_key': normalize_name(name)}
+    if ward:
+        query['ward'] = ward
+    return query
+
+
+def single_patient(patients: List[Dict], name: str) -> Optional[Dict]:
+    """Return the only patient of a name lookup, or None if there is none.
+
+    Raises:
+        ClinicalRecordError: If patients in several wards have that name.
+    """
+    if len(patients) > 1:
+        raise ClinicalRecordError(f"More than one patient is named {name}. Please name the patient's ward.")
+    return patients[0] if patients else None
+
+
+def unknown_patient_error(name: str) -> ClinicalRecordError:
+    return ClinicalRecordError(f"No patient named {name} was found. Please add the patient first.")
+
+
+def duplicate_patient_error(document: Dict) -> ClinicalRecordError:
+    if document['ward']:
+        return ClinicalRecordError(f"A patient named {document['name']} already exists in ward {document['ward']}.")
+    return ClinicalRecordError(f"A patient named {document['name']} already exists.")
+
+
+class ClinicalStore:
+    """Patient, medication and follow-up records built from the bot's parsed intents.
+
+    Lives in the same database as the conversations. Patient names are resolved with
+    an indexed lookup on their normalized form, so a medication or follow-up for a
+    patient that was never added is rejected instead of being taken on trust. Names are
+    unique per ward; a command for a name that several wards share must name the ward.
+    """
+
+    def __init__(self, db, ensure_indexes: bool = True):
+        """
+        Parameters:
+        db: The pymongo Database holding the patients, medications and followups collections,
+            e.g. MessageCrudHandler.db.
+        ensure_indexes (bool): Create and verify the collection indexes on startup.
+        """
+        self.db = db
+        self.patients = db.patients
+        self.medications = db.medications
+        self.followups = db.followups
+        if ensure_indexes:
+            self.ensure_indexes()
+
+    def ensure_indexes(self):
+        """
+        Create the clinical record indexes if needed and verify they match the expected definition.
+
+        Raises:
+        RuntimeError: If an existing index conflicts with the required definition.
+        """
+        for name in OBSOLETE_PATIENT_INDEXES:
+            if name in self.patients.index_information():
+                self.patients.drop_index(name)
+        for collection, indexes in ((self.patients, PATIENT_INDEXES), (self.medications, MEDICATION_INDEXES),
+                                    (self.followups, FOLLOWUP_INDEXES)):
+            for keys, options in indexes:
+                collection.create_index(keys, **options)
+            verify_indexes(collection.index_information(), indexes, collection.name)
+
+    def find_patient(self, name: str, ward: Optional[str] = None) -> Optional[Dict]:
+        """Return the patient whose name matches `name` up to case and spacing, or None.
+
+        Raises:
+            ClinicalRecordError: If no ward is given and patients in several wards have that name.
+        """
+        return single_patient(list(self.patients.find(patient_filter(name, ward), PATIENT_PROJECTION).limit(2)), name)
+
+    def apply_intent(self, response: Dict, conversation_id: str) -> Optional[Dict]:
+        """Write the record a bot response describes.
+
+        Args:
+            response (Dict): Parsed bot response with 'intent' and 'entities'.
+            conversation_id (str): Conversation the command came from, kept on the record.
+
+        Returns:
+            Optional[Dict]: The stored record, or None if the response changes nothing.
+
+        Raises:
+            ClinicalRecordError: If entities are missing, the patient is unknown or ambiguous,
+                or a patient with the same name already exists in the ward.
+        """
+        validated = validate_intent(response)
+        if validated is None:
+            return None
+        intent, entities = validated
+        if intent == ADD_PATIENT:
+            document = patient_document(entities, conversation_id)
+            try:
+                self.patients.insert_one(document)
+            except DuplicateKeyError:
+                raise duplicate_patient_error(document)
+            return document
+        patient = self.find_patient(str(entities['patient_name']), entities.get('ward'))
+        if patient is None:
+            raise unknown_patient_error(entities['patient_name'])
+        if intent == ASSIGN_MEDICATION:
+            document = medication_document(patient, entities, conversation_id)
+            self.medications.insert_one(document)
+            return document
+        document = followup_document(patient, entities, conversation_id)
+        try:
+            self.followups.insert_one(document)
+        except DuplicateKeyError:
+            # Already booked for that day, e.g. by a retried turn.
+            pass
+        return document
+
+    def get_medications(self, patient_name: str, ward: Optional[str] = None) -> List[Dict]:
+        """Return a patient's medications, oldest first.
+
+        Raises:
+            ClinicalRecordError: If no patient has that name, or several do and no ward is given.
+        """
+        patient = self.find_patient(patient_name, ward)
+        if patient is None:
+            raise unknown_patient_error(patient_name)
+        return list(self.medications.find({'patient_id': patient['patient_id']}, {'_id': 0})
+                    .sort('assigned_at', ASCENDING))
+
+    def followup_query(self, start: Optional[date] = None, end: Optional[date] = None,
+                       patient_name: Optional[str] = None, ward: Optional[str] = None,
+                       cursor: Optional[str] = None) -> Dict:
+        """Build the filter for follow-up queries, resolving `patient_name` to its patient.
+
+        Raises:
+            ClinicalRecordError: If no patient has that name, or several do and no ward is given.
+            ValueError: If the cursor is invalid.
+        """
+        patient_id = None
+        if patient_name is not None:
+            patient = self.find_patient(patient_name, ward)
+            if patient is None:
+                raise unknown_patient_error(patient_name)
+            patient_id = patient['patient_id']
+        return followup_filter(start, end, patient_id, ward, cursor)
+
+    def find_followups(self, start: Optional[date] = None, end: Optional[date] = None,
+                       patient_name: Optional[str] = None, ward: Optional[str] = None, limit: int = 100,
+                       cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """Return one page of follow-ups, ordered by date, and the cursor of the next page.
+
+        Args:
+            start (Optional[date]): First day of the range, inclusive.
+            end (Optional[date]): Last day of the range, inclusive.
+            patient_name (Optional[str]): Only this patient's follow-ups.
+            ward (Optional[str]): Only follow-ups of patients in this ward.
+            limit (int): Maximum number of follow-ups returned.
+            cursor (Optional[str]): The cursor returned with the previous page.
+
+        Returns:
+            Tuple[List[Dict], Optional[str]]: The follow-ups and the next page's cursor, None on the last page.
+
+        Raises:
+            ClinicalRecordError: If no patient has that name, or several do and no ward is given.
+            ValueError: If the cursor is invalid.
+        """
+        query = self.followup_query(start, end, patient_name, ward, cursor)
+        followups = list(self.followups.find(query, FOLLOWUP_PROJECTION).sort(FOLLOWUP_SORT).limit(limit + 1))
+        return followup_page(followups, limit)
+
+    def iter_followups(self, query: Dict, batch_size: int = 1000) -> Iterator[Dict]:
+        """Yield every follow-up matching a followup_query filter, ordered by date, fetched in batches."""
+        return self.followups.find(query, FOLLOWUP_PROJECTION).sort(FOLLOWUP_SORT).batch_size(batch_size)
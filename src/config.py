@@ -0,0 +1,71 @@
+import os
+
+
+def env_bool(name: str, default: bool) -> bool:
+    """Read a boolean environment variable ("1", "true", "yes" and "on" are true)."""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+LOCAL_BACKEND = "local"
+OPENAI_BACKEND = "openai"
+FAKE_BACKEND = "fake"
+REMOTE_BACKEND = "remote"
+# Backends a model server process can load.
+SERVABLE_BACKENDS = (LOCAL_BACKEND, OPENAI_BACKEND, FAKE_BACKEND)
+LLM_BACKENDS = SERVABLE_BACKENDS + (REMOTE_BACKEND,)
+
+# Which LLMRunner answers conversations: the local Llama model, the OpenAI API, an
+# offline fake with simulated latency (for load tests), or a model server process
+# shared by several API workers (`python -m src.model_server`).
+LLM_BACKEND = os.getenv("LLM_BACKEND", LOCAL_BACKEND)
+
+# Local model
+MODEL_NAME = os.getenv("MODEL_NAME", "unsloth/Meta-Llama-3.1-8B")
+MODEL_DEVICE = os.getenv("MODEL_DEVICE", "cuda")
+MODEL_MAX_SEQ_LENGTH = int(os.getenv("MODEL_MAX_SEQ_LENGTH", "2048"))
+MODEL_LOAD_IN_4BIT = env_bool("MODEL_LOAD_IN_4BIT", True)
+# Wrap the model in trainable LoRA adapters; only needed for fine-tuning, never for serving.
+MODEL_APPLY_PEFT = env_bool("MODEL_APPLY_PEFT", False)
+# Decode every response through the intent/error grammar so it always parses.
+MODEL_CONSTRAINED_DECODING = env_bool("MODEL_CONSTRAINED_DECODING", False)
+
+# OpenAI API
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4")
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "30"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+# Send a duplicate request when the first one is slower than this; unset disables hedging.
+OPENAI_HEDGE_AFTER_SECONDS = float(os.environ["OPENAI_HEDGE_AFTER_SECONDS"]) if os.getenv("OPENAI_HEDGE_AFTER_SECONDS") else None
+
+# Fake backend
+FAKE_LATENCY_MEDIAN_SECONDS = float(os.getenv("FAKE_LATENCY_MEDIAN_SECONDS", "0.5"))
+
+# Model server
+MODEL_SERVER_SOCKET = os.getenv("MODEL_SERVER_SOCKET", "/tmp/management-bot-model.sock")
+MODEL_SERVER_BACKEND = os.getenv("MODEL_SERVER_BACKEND", LOCAL_BACKEND)
+# API workers wait this long for the model server, which may still be loading the model.
+MODEL_SERVER_CONNECT_TIMEOUT_SECONDS = float(os.getenv("MODEL_SERVER_CONNECT_TIMEOUT_SECONDS", "600"))
+
+# MongoDB
+MONGO_CONNECTION_STRING = os.getenv("MONGO_CONNECTION_STRING", "mongodb://localhost:27017")
+MONGO_DATABASE_NAME = os.getenv("MONGO_DATABASE_NAME", "medical_conversations")
+# When set, turns are acknowledged once fsync'd to a journal in this directory and
+# written to Mongo in batches by a background flusher (write-behind).
+MESSAGE_JOURNAL_DIR = os.getenv("MESSAGE_JOURNAL_DIR") or None
+# Store each pair's prompt token ids next to it so no worker or restart re-encodes it.
+# Only the local model uses them; they are kept in memory either way.
+STORE_PROMPT_TOKEN_IDS = env_bool("STORE_PROMPT_TOKEN_IDS", False)
+
+# Clinical records
+# Write add_patient, assign_medication and schedule_followup responses to the patients,
+# medications and followups collections, rejecting commands for unknown patients. Off by
+# default: stored turns keep only the reply text, not the parsed intent, so patients added
+# before it was enabled cannot be backfilled and every later command for them is rejected.
+CLINICAL_RECORDS = env_bool("CLINICAL_RECORDS", False)
+
+# Observability
+# Add X-Trace-Id and Server-Timing (per-stage durations) headers to API responses.
+TRACE_HEADERS = env_bool("TRACE_HEADERS", False)
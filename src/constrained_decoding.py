@@ -0,0 +1,299 @@
+import json
+from typing import Dict, List, Optional
+
+import torch
+
+from src.metrics import REGISTRY
+
+CONSTRAINED_TRUNCATIONS = REGISTRY.counter(
+    "constrained_decoding_truncations_total",
+    "Constrained responses abandoned because a value reached its token limit before the model closed it.")
+
+# Grammar nodes. A response template is a list of nodes; the root of the grammar is a
+# Choice between the three intent templates and the error template.
+
+
+class Literal:
+    """Fixed text (JSON punctuation and key names); fed to the model without decoding steps."""
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class String:
+    """Free JSON string contents, generated until the model closes the quote."""
+
+    def __init__(self, max_tokens: int = 32):
+        self.max_tokens = max_tokens
+
+
+class Date:
+    """ISO date (YYYY-MM-DD) inside a JSON string, one digit token per position."""
+
+    pattern = "dddd-dd-dd"
+
+
+class Integer:
+    """Non-negative JSON integer made of digit tokens."""
+
+    def __init__(self, max_tokens: int = 3):
+        self.max_tokens = max_tokens
+
+
+class EnumList:
+    """Non-empty list of distinct strings taken from a fixed set, followed by ']'."""
+
+    def __init__(self, values: List[str]):
+        self.values = values
+
+
+class Choice:
+    """One of several templates; each must start with a Literal that tells them apart."""
+
+    def __init__(self, options: List[List]):
+        self.options = options
+
+
+class TruncatedResponseError(ValueError):
+    """A value slot reached its max_tokens without the model closing it.
+
+    Keeping the tokens decoded so far would store a silently cut-off value, so the
+    response is abandoned and the caller decides how to generate it instead.
+    """
+
+    def __init__(self, max_tokens: int):
+        super().__init__(f"A constrained value reached its {max_tokens}-token limit.")
+        self.max_tokens = max_tokens
+
+
+def is_quoted(node) -> bool:
+    return isinstance(node, (String, Date))
+
+
+def intent_template(intent: str, entities: List[tuple]) -> List:
+    """Build the node list for {"intent": ..., "entities": {...}, "message": ...}."""
+    nodes = []
+    opening = f'{{"intent": "{intent}", "entities": {{'
+    for i, (name, node) in enumerate(entities):
+        separator = opening if i == 0 else ('", ' if is_quoted(entities[i - 1][1]) else ', ')
+        quote = '"' if is_quoted(node) else ''
+        nodes.extend([Literal(f'{separator}"{name}": {quote}'), node])
+    closing = '"' if is_quoted(entities[-1][1]) else ''
+    nodes.extend([Literal(f'{closing}}}, "message": "'), String(max_tokens=96), Literal('"}')])
+    return nodes
+
+
+ENTITY_NAMES = ["name", "gender", "age", "condition", "patient_name", "medication", "dosage", "frequency", "date"]
+
+# The add_patient / assign_medication / schedule_followup entity schemas and the error
+# schema described in llm_instruction_template_2.
+RESPONSE_GRAMMAR = Choice([
+    intent_template("add_patient", [
+        ("name", String()), ("gender", String(max_tokens=4)), ("age", Integer()), ("condition", String())]),
+    intent_template("assign_medication", [
+        ("patient_name", String()), ("medication", String()), ("dosage", String(max_tokens=8)),
+        ("frequency", String(max_tokens=12))]),
+    intent_template("schedule_followup", [
+        ("patient_name", String()), ("date", Date())]),
+    [Literal('{"error": true, "missing_entities": ['), EnumList(ENTITY_NAMES),
+     Literal(', "message": "'), String(max_tokens=96), Literal('"}')],
+])
+
+
+class ConstrainedDecoder:
+    """Greedy decoder that can only produce responses matching RESPONSE_GRAMMAR.
+
+    Instead of sampling every character, the decoder walks the grammar: literal text
+    (braces, key names, separators) is appended to the sequence directly and prefilled
+    in a single forward pass, choices are resolved by restricting the logits to the
+    tokens that continue one of the options, and value slots are decoded with the
+    vocabulary masked down to tokens that keep the JSON valid. The result always
+    parses, so there are no retries on malformed output. A value that reaches its
+    max_tokens before the model closes it raises TruncatedResponseError rather than
+    being cut off.
+    """
+
+    def __init__(self, model, tokenizer, grammar: Choice = RESPONSE_GRAMMAR):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.grammar = grammar
+        self._literal_ids: Dict[str, List[int]] = {}
+        self._build_vocabulary_masks()
+
+    def _build_vocabulary_masks(self):
+        """Classify every token once: safe inside a JSON string, digits only, or closing a string/number."""
+        vocab_size = self.model.get_output_embeddings().weight.shape[0]
+        special_ids = set(self.tokenizer.all_special_ids)
+        string_safe = torch.zeros(vocab_size, dtype=torch.bool)
+        digits = torch.zeros(vocab_size, dtype=torch.bool)
+        single_digit = torch.zeros(vocab_size, dtype=torch.bool)
+        quote_start = torch.zeros(vocab_size, dtype=torch.bool)
+        comma_start = torch.zeros(vocab_size, dtype=torch.bool)
+        for token_id in range(vocab_size):
+            if token_id in special_ids:
+                continue
+            try:
+                text = self.tokenizer.decode([token_id])
+            except (IndexError, KeyError, TypeError, ValueError):
+                continue
+            if not text:
+                continue
+            string_safe[token_id] = not any(char in '"\\' or ord(char) < 32 for char in text)
+            digits[token_id] = text.isascii() and text.isdigit()
+            single_digit[token_id] = len(text) == 1 and text.isascii() and text.isdigit()
+            quote_start[token_id] = text.startswith('"')
+            comma_start[token_id] = text.startswith(',')
+        device = self.model.get_output_embeddings().weight.device
+        self.string_mask = (string_safe | quote_start).to(device)
+        self.quote_start = quote_start.to(device)
+        self.integer_mask = (digits | comma_start).to(device)
+        self.digits = digits.to(device)
+        self.single_digit = single_digit.to(device)
+
+    def _tokens(self, text: str) -> List[int]:
+        ids = self._literal_ids.get(text)
+        if ids is None:
+            ids = self._literal_ids[text] = self.tokenizer.encode(text, add_special_tokens=False)
+        return ids
+
+    def decode(self, prefix_cache, suffix_ids: torch.Tensor) -> Optional[dict]:
+        """Generate one schema-valid response.
+
+        Args:
+            prefix_cache (PrefixKVCache): Cached static prompt prefix.
+            suffix_ids (torch.Tensor): Token ids of the prompt after the prefix, shape (1, length).
+
+        Returns:
+            dict: The parsed response.
+
+        Raises:
+            TruncatedResponseError: If a value reached its token limit before the model closed it.
+        """
+        state = _DecodingState(self.model, prefix_cache.past_key_values, suffix_ids.reshape(-1).tolist())
+        parts = []
+        self._decode_nodes([self.grammar], state, parts)
+        return json.loads(''.join(parts))
+
+    def _decode_nodes(self, nodes: List, state: "_DecodingState", parts: List[str]):
+        for node in nodes:
+            if isinstance(node, Literal):
+                state.feed(self._tokens(node.text))
+                parts.append(node.text)
+            elif isinstance(node, Choice):
+                index = self._choose([option[0].text for option in node.options], state)
+                parts.append(node.options[index][0].text)
+                self._decode_nodes(node.options[index][1:], state, parts)
+            elif isinstance(node, String):
+                token_ids = self._decode_masked(state, self.string_mask, self.quote_start, node.max_tokens)
+                parts.append(self.tokenizer.decode(token_ids))
+            elif isinstance(node, Integer):
+                token_ids = self._decode_masked(state, self.integer_mask, ~self.digits, node.max_tokens,
+                                                first_mask=self.digits)
+                parts.append(str(int(self.tokenizer.decode(token_ids))))
+            elif isinstance(node, Date):
+                parts.append(self._decode_date(node, state))
+            elif isinstance(node, EnumList):
+                parts.append(self._decode_enum_list(node, state))
+
+    def _decode_masked(self, state, mask, stop_mask, max_tokens, first_mask=None) -> List[int]:
+        """Greedily decode tokens from `mask` until a token in `stop_mask` wins.
+
+        The stopping token is not kept: the literal that follows (which starts with the
+        same closing character) is fed in its place.
+
+        Raises:
+            TruncatedResponseError: If the model still continues the value after max_tokens tokens.
+        """
+        token_ids = []
+        while True:
+            allowed = first_mask if first_mask is not None and not token_ids else mask
+            token_id = int(state.logits().masked_fill(~allowed, float('-inf')).argmax())
+            if stop_mask[token_id]:
+                return token_ids
+            if len(token_ids) == max_tokens:
+                CONSTRAINED_TRUNCATIONS.inc()
+                raise TruncatedResponseError(max_tokens)
+            state.feed([token_id])
+            token_ids.append(token_id)
+
+    def _decode_date(self, node: Date, state: "_DecodingState") -> str:
+        """Decode a digit for each 'd' of the pattern and feed the separators as literals."""
+        text = ''
+        for char in node.pattern:
+            if char == 'd':
+                token_id = int(state.logits().masked_fill(~self.single_digit, float('-inf')).argmax())
+                state.feed([token_id])
+                text += self.tokenizer.decode([token_id])
+            else:
+                state.feed(self._tokens(char))
+                text += char
+        return text
+
+    def _choose(self, options: List[str], state: "_DecodingState") -> int:
+        """Pick one of several literal continuations, letting the model decide only where they diverge."""
+        token_lists = [self._tokens(option) for option in options]
+        candidates = list(range(len(options)))
+        position = 0
+        while len(candidates) > 1:
+            finished = [c for c in candidates if position == len(token_lists[c])]
+            if finished:
+                candidates = finished[:1]
+                break
+            next_tokens = {token_lists[c][position] for c in candidates}
+            if len(next_tokens) == 1:
+                token_id = next_tokens.pop()
+            else:
+                allowed = torch.tensor(sorted(next_tokens), device=self.digits.device)
+                token_id = int(allowed[state.logits()[allowed].argmax()])
+            state.feed([token_id])
+            candidates = [c for c in candidates if token_lists[c][position] == token_id]
+            position += 1
+        chosen = candidates[0]
+        state.feed(token_lists[chosen][position:])
+        return chosen
+
+    def _decode_enum_list(self, node: EnumList, state: "_DecodingState") -> str:
+        remaining = list(node.values)
+        text = ''
+        while remaining:
+            separator = ', ' if text else ''
+            options = [f'{separator}"{value}"' for value in remaining]
+            if text:
+                options.append(']')
+            index = self._choose(options, state)
+            text += options[index]
+            if options[index] == ']':
+                return text
+            remaining.pop(index)
+        state.feed(self._tokens(']'))
+        return text + ']'
+
+
+class _DecodingState:
+    """Token sequence and KV cache of one constrained generation.
+
+    Tokens fed in a row are buffered and prefilled in one forward pass the next time
+    logits are needed, which is what lets literals cost a single model call.
+    """
+
+    def __init__(self, model, past_key_values, pending: List[int]):
+        self.model = model
+        self.past_key_values = past_key_values
+        self.pending = list(pending)
+        self._logits = None
+
+    def feed(self, token_ids: List[int]):
+        if token_ids:
+            self.pending.extend(token_ids)
+            self._logits = None
+
+    def logits(self) -> torch.Tensor:
+        if self._logits is None:
+            device = self.model.get_output_embeddings().weight.device
+            with torch.no_grad():
+                output = self.model(input_ids=torch.tensor([self.pending], device=device),
+                                    past_key_values=self.past_key_values, use_cache=True)
+            self.past_key_values = output.past_key_values
+            self.pending = []
+            self._logits = output.logits[0, -1]
+        return self._logits
@@ -0,0 +1,113 @@
+import asyncio
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+
+
+def format_message_pair(message: Dict) -> str:
+    """Render one stored nurse/bot pair the way it appears in the prompt history."""
+    return f"NURSE: {message['nurse']}\nBOT: {message['bot']}"
+
+
+def format_history(messages: List[Dict]) -> str:
+    """Render a list of stored nurse/bot pairs as the prompt's thread history."""
+    return '\n'.join(format_message_pair(message) for message in messages)
+
+
+class ContextBuilder:
+    """Selects the most recent conversation turns that fit a token budget.
+
+    Token counts come from the model's own tokenizer. A count is computed at most
+    once per message pair: it is read from the stored message ('tokens') when
+    available and otherwise kept in a bounded in-memory LRU cache. On the event loop,
+    use the a-prefixed methods: they count missing pairs with `acount_tokens`, which
+    may be a round trip to a model server.
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int], token_budget: int = 384, max_turns: int = 50,
+                 cache_size: int = 10000, acount_tokens: Optional[Callable[[str], Awaitable[int]]] = None):
+        """
+        Parameters:
+        count_tokens (Callable[[str], int]): Returns the number of tokens in a text.
+        token_budget (int): Maximum number of history tokens placed in the prompt.
+        max_turns (int): Maximum number of recent pairs fetched from the database; used as the $slice window.
+        cache_size (int): Maximum number of message pairs whose token counts are cached.
+        acount_tokens (Callable[[str], Awaitable[int]], optional): Coroutine variant of `count_tokens`,
+            e.g. LLMBackend.acount_tokens; `count_tokens` is used if None.
+        """
+        self.count_tokens = count_tokens
+        self.acount_tokens = acount_tokens
+        self.token_budget = token_budget
+        self.max_turns = max_turns
+        self.cache_size = cache_size
+        self._token_counts = OrderedDict()
+
+    def message_tokens(self, message: Dict) -> int:
+        """Return the token count of a stored message pair, tokenizing it only on a cache miss."""
+        if message.get('tokens') is not None:
+            return message['tokens']
+        key = (message['nurse'], message['bot'])
+        count = self._token_counts.get(key)
+        if count is not None:
+            self._token_counts.move_to_end(key)
+            return count
+        # +1 accounts for the newline joining this pair to the next one.
+        count = self.count_tokens(format_message_pair(message)) + 1
+        self._remember(key, count)
+        return count
+
+    def _remember(self, key, count: int):
+        self._token_counts[key] = count
+        if len(self._token_counts) > self.cache_size:
+            self._token_counts.popitem(last=False)
+
+    async def acount(self, text: str) -> int:
+        """Return the number of tokens in `text`, with `acount_tokens` when set."""
+        if self.acount_tokens is None:
+            return self.count_tokens(text)
+        return await self.acount_tokens(text)
+
+    async def count_missing(self, messages: List[Dict]):
+        """Count, concurrently, the pairs of `messages` whose token count is neither stored nor cached."""
+        missing = {}
+        for message in messages:
+            key = (message['nurse'], message['bot'])
+            if message.get('tokens') is None and key not in self._token_counts:
+                missing[key] = format_message_pair(message)
+        counts = await asyncio.gather(*(self.acount(text) for text in missing.values()))
+        for key, count in zip(missing, counts):
+            self._remember(key, count + 1)
+
+    def pair_tokens(self, nurse_message: str, bot_message: str) -> int:
+        """Return the token count of a new pair, e.g. to store alongside it in the database."""
+        return self.message_tokens({'nurse': nurse_message, 'bot': bot_message})
+
+    async def apair_tokens(self, nurse_message: str, bot_message: str) -> int:
+        """Coroutine variant of pair_tokens."""
+        message = {'nurse': nurse_message, 'bot': bot_message}
+        await self.count_missing([message])
+        return self.message_tokens(message)
+
+    def select(self, messages: List[Dict], token_budget: Optional[int] = None) -> List[Dict]:
+        """Return the longest suffix of `messages` whose total token count fits the budget.
+
+        Args:
+            messages (List[Dict]): Stored message pairs, oldest first.
+            token_budget (Optional[int]): Overrides the builder's default budget.
+
+        Returns:
+            List[Dict]: The most recent pairs that fit, oldest first.
+        """
+        budget = self.token_budget if token_budget is None else token_budget
+        used = 0
+        start = len(messages)
+        for i in range(len(messages) - 1, -1, -1):
+            used += self.message_tokens(messages[i])
+            if used > budget:
+                break
+            start = i
+        return messages[start:]
+
+    async def aselect(self, messages: List[Dict], token_budget: Optional[int] = None) -> List[Dict]:
+        """Coroutine variant of select: missing counts are fetched first, then select reads them from the cache."""
+        await self.count_missing(messages)
+        return self.select(messages, token_budget)
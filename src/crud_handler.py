@@ -1,20 +1,223 @@
-from pymongo import MongoClient
-from typing import List, Dict, Optional
+from pymongo import MongoClient, ReturnDocument, ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from typing import List, Dict, Optional, Tuple
 from datetime import datetime
+import uuid
+
+from src.metrics import REGISTRY, timed
+
+# Message storage modes. "embedded" keeps every pair in the conversation's messages
+# array; "collection" stores one document per pair in a separate messages collection
+# keyed by (conversation_id, seq), so conversation documents stay small.
+EMBEDDED_STORAGE = 'embedded'
+COLLECTION_STORAGE = 'collection'
+MESSAGE_STORAGE_MODES = (EMBEDDED_STORAGE, COLLECTION_STORAGE)
+
+# Indexes required on the conversations collection: (keys, options).
+CONVERSATION_INDEXES = [
+    ([('conversation_id', ASCENDING)], {'name': 'conversation_id_unique', 'unique': True}),
+    ([('updated_at', ASCENDING)], {'name': 'updated_at'}),
+]
+
+# Indexes required on the messages collection when COLLECTION_STORAGE is used.
+MESSAGE_INDEXES = [
+    ([('conversation_id', ASCENDING), ('seq', ASCENDING)], {'name': 'conversation_id_seq_unique', 'unique': True}),
+]
+
+MESSAGE_PROJECTION = {'_id': 0, 'seq': 1, 'nurse': 1, 'bot': 1, 'tokens': 1, 'token_ids': 1}
+
+# Every write to a conversation's messages or summary increments its 'history_version',
+# so a cached copy of the history can be validated by reading that one field. With
+# COLLECTION_STORAGE the version is bumped when a pair's seq is reserved, before the
+# pair is inserted, so it cannot validate a cached copy there.
+HISTORY_VERSION_PROJECTION = {'_id': 0, 'history_version': 1}
+
+MONGO_HISTORY_READ_SECONDS = REGISTRY.histogram("mongo_history_read_seconds",
+                                                "Time to read a conversation and its history window from Mongo.")
+MONGO_MESSAGE_WRITE_SECONDS = REGISTRY.histogram("mongo_message_write_seconds",
+                                                 "Time to store one message pair in Mongo.")
+
+# Duplicate-key server error code, used to pick retryable failures out of bulk inserts.
+DUPLICATE_KEY_ERROR = 11000
+
+
+def new_conversation_document(conversation_id: str, message_storage: str = EMBEDDED_STORAGE) -> Dict:
+    """Build the initial document stored for a new, empty conversation."""
+    now = datetime.now()
+    conversation = {
+        'conversation_id': conversation_id,
+        'created_at': now,
+        'updated_at': now,
+        'history_version': 0
+    }
+    if message_storage == COLLECTION_STORAGE:
+        conversation['message_count'] = 0
+    else:
+        conversation['messages'] = []
+    return conversation
+
+
+def message_document(conversation_id: str, seq: int, nurse_message: str, bot_message: str,
+                     token_count: Optional[int] = None, token_ids: Optional[Dict] = None) -> Dict:
+    """Build a document for the messages collection holding one nurse/bot pair."""
+    document = {
+        'conversation_id': conversation_id,
+        'seq': seq,
+        'nurse': nurse_message,
+        'bot': bot_message,
+        'created_at': datetime.now()
+    }
+    if token_count is not None:
+        document['tokens'] = token_count
+    if token_ids is not None:
+        document['token_ids'] = token_ids
+    return document
+
+
+def sequence_increment_update() -> Dict:
+    """Build the update that reserves the next message sequence number of a conversation."""
+    return {
+        '$inc': {'message_count': 1, 'history_version': 1},
+        '$set': {'updated_at': datetime.now()}
+    }
+
+
+def page_projection(start: int, limit: int) -> Dict:
+    """Build a projection that returns `limit` embedded messages starting at index `start`."""
+    return {'messages': {'$slice': [start, limit]}}
+
+
+def summary_state_pipeline(conversation_id: str) -> List[Dict]:
+    """Build an aggregation returning a conversation's rolling summary and total message count.
+
+    Works for both storage modes: message_count is maintained in COLLECTION_STORAGE,
+    while embedded conversations are measured with $size on the server.
+    """
+    return [
+        {'$match': {'conversation_id': conversation_id}},
+        {'$project': {
+            '_id': 0,
+            'summary': 1,
+            'message_count': {'$ifNull': ['$message_count', {'$size': {'$ifNull': ['$messages', []]}}]}
+        }}
+    ]
+
+
+def summary_update(conversation_id: str, text: str, covered: int, expected_version: int,
+                   token_count: Optional[int] = None) -> Tuple[Dict, Dict]:
+    """Build the (filter, update) pair that replaces a summary only if it is still at `expected_version`.
+
+    The version check makes concurrent summarizers safe: the loser's update simply matches nothing.
+    """
+    if expected_version:
+        query = {'conversation_id': conversation_id, 'summary.version': expected_version}
+    else:
+        query = {'conversation_id': conversation_id, 'summary': {'$exists': False}}
+    update = {'$set': {'summary': {
+        'text': text,
+        'version': expected_version + 1,
+        'covered': covered,
+        'tokens': token_count,
+        'updated_at': datetime.now()
+    }}, '$inc': {'history_version': 1}}
+    return query, update
+
+
+def verify_indexes(index_information: Dict, indexes: List = CONVERSATION_INDEXES,
+                   collection_name: str = 'conversations') -> None:
+    """Check that every required index exists with the expected options.
+
+    Raises:
+        RuntimeError: If an index is missing or was created with different options
+            (e.g. a pre-existing non-unique index on conversation_id).
+    """
+    for keys, options in indexes:
+        index = index_information.get(options['name'])
+        if index is None or list(index['key']) != keys:
+            raise RuntimeError(f"Index {options['name']} is missing on the {collection_name} collection.")
+        if options.get('unique') and not index.get('unique'):
+            raise RuntimeError(f"Index {options['name']} must be unique; drop it and restart to rebuild.")
+
+
+def failed_duplicate_indexes(error: BulkWriteError) -> List[int]:
+    """Return the positions of documents rejected by an unordered insert_many for duplicate keys.
+
+    Raises:
+        BulkWriteError: Re-raised if any document failed for a reason other than a duplicate key.
+    """
+    write_errors = error.details.get('writeErrors', [])
+    if any(write_error['code'] != DUPLICATE_KEY_ERROR for write_error in write_errors):
+        raise error
+    return [write_error['index'] for write_error in write_errors]
+
+
+def history_projection(history_limit: Optional[int] = None) -> Optional[Dict]:
+    """Build a projection that trims the messages array to its last `history_limit` pairs.
+
+    Returns None (i.e. the full document) when no limit is requested.
+    """
+    if history_limit is None:
+        return None
+    return {'messages': {'$slice': -history_limit}}
+
+
+def message_push_update(nurse_message: str, bot_message: str, token_count: Optional[int] = None,
+                        token_ids: Optional[Dict] = None) -> Dict:
+    """Build the update document that appends one nurse/bot pair to a conversation."""
+    message_pair = {
+        'nurse': nurse_message,
+        'bot': bot_message
+    }
+    if token_count is not None:
+        message_pair['tokens'] = token_count
+    if token_ids is not None:
+        message_pair['token_ids'] = token_ids
+    return {
+        '$push': {'messages': message_pair},
+        '$inc': {'history_version': 1},
+        '$set': {'updated_at': datetime.now()}
+    }
 
 
 class MessageCrudHandler:
-    def __init__(self, connection_string: str, database_name: str):
+    def __init__(self, connection_string: str, database_name: str, ensure_indexes: bool = True,
+                 message_storage: str = EMBEDDED_STORAGE):
         """
         Initialize MongoDB connection and database.
 
         Parameters:
         connection_string (str): MongoDB connection string.
         database_name (str): Name of the database to connect to.
+        ensure_indexes (bool): Create and verify the collection indexes on startup.
+        message_storage (str): EMBEDDED_STORAGE (messages array per conversation) or
+            COLLECTION_STORAGE (one document per message pair in the messages collection).
         """
+        if message_storage not in MESSAGE_STORAGE_MODES:
+            raise ValueError(f"Unknown message storage mode {message_storage}.")
+        self.message_storage = message_storage
         self.client = MongoClient(connection_string)
         self.db = self.client[database_name]
         self.conversations = self.db.conversations
+        self.messages = self.db.messages
+        if ensure_indexes:
+            self.ensure_indexes()
+
+    def ensure_indexes(self):
+        """
+        Create the conversation indexes if needed and verify they match the expected definition.
+
+        create_index is a no-op for indexes that already exist, so this is safe to call on every startup.
+
+        Raises:
+        RuntimeError: If an existing index conflicts with the required definition.
+        """
+        for keys, options in CONVERSATION_INDEXES:
+            self.conversations.create_index(keys, **options)
+        verify_indexes(self.conversations.index_information())
+        if self.message_storage == COLLECTION_STORAGE:
+            for keys, options in MESSAGE_INDEXES:
+                self.messages.create_index(keys, **options)
+            verify_indexes(self.messages.index_information(), MESSAGE_INDEXES, 'messages')
 
     def create_conversation(self, conversation_id: str) -> str:
         """Create a new conversation with empty messages.
@@ -28,20 +231,65 @@ class MessageCrudHandler:
         Returns:
             str: The ObjectId of the inserted conversation document as a string
 
+        Raises:
+            ValueError: If a conversation with this ID already exists.
+
         Example:
             >>> handler.create_conversation("12345")
             '507f1f77bcf86cd799439011'
         """
-        conversation = {
-            'conversation_id': conversation_id,
-            'messages': [],
-            'created_at': datetime.now(),
-            'updated_at': datetime.now()
-        }
-        result = self.conversations.insert_one(conversation)
+        try:
+            result = self.conversations.insert_one(new_conversation_document(conversation_id, self.message_storage))
+        except DuplicateKeyError:
+            raise ValueError(f"Conversation ID {conversation_id} already exists.")
         return str(result.inserted_id)
 
-    def add_message(self, conversation_id: str, nurse_message: str, bot_message: str) -> bool:
+    def allocate_conversation_id(self) -> str:
+        """Create a conversation under a freshly generated UUID and return that ID.
+
+        Uniqueness is enforced by the unique index, so allocation is a single insert
+        that is only retried in the (practically impossible) event of a UUID collision.
+
+        Returns:
+            str: The new conversation ID.
+        """
+        while True:
+            conversation_id = str(uuid.uuid4())
+            try:
+                self.conversations.insert_one(new_conversation_document(conversation_id, self.message_storage))
+                return conversation_id
+            except DuplicateKeyError:
+                continue
+
+    def allocate_conversation_ids(self, count: int) -> List[str]:
+        """Pre-allocate `count` new conversations with a single unordered insert_many.
+
+        Args:
+            count (int): Number of conversations to create.
+
+        Returns:
+            List[str]: The new conversation IDs.
+
+        Example:
+            >>> len(handler.allocate_conversation_ids(50))
+            50
+        """
+        allocated = []
+        pending = [str(uuid.uuid4()) for _ in range(count)]
+        while pending:
+            try:
+                self.conversations.insert_many(
+                    [new_conversation_document(conversation_id, self.message_storage) for conversation_id in pending], ordered=False)
+                failed = []
+            except BulkWriteError as e:
+                failed = failed_duplicate_indexes(e)
+            allocated.extend(conversation_id for i, conversation_id in enumerate(pending) if i not in failed)
+            pending = [str(uuid.uuid4()) for _ in failed]
+        return allocated
+
+    @timed(MONGO_MESSAGE_WRITE_SECONDS)
+    def add_message(self, conversation_id: str, nurse_message: str, bot_message: str,
+                    token_count: Optional[int] = None, token_ids: Optional[Dict] = None) -> bool:
         """Add a new message pair to existing conversation.
 
         This method adds a nurse message and corresponding bot response to an existing conversation
@@ -51,6 +299,8 @@ class MessageCrudHandler:
             conversation_id (str): The unique identifier of the conversation.
             nurse_message (str): The message sent by the nurse.
             bot_message (str): The response generated by the bot.
+            token_count (Optional[int]): Prompt token count of the pair, stored so it is never re-tokenized.
+            token_ids (Optional[Dict]): Prompt token ids of the pair from LLMBackend.encode_message.
 
         Returns:
             bool: True if the message pair was successfully added, False otherwise.
@@ -62,26 +312,75 @@ class MessageCrudHandler:
             >>> crud.add_message("conv123", "How are you?", "I'm doing well, thanks!")
             True
         """
-        if not self.get_conversation(conversation_id):
-            raise ValueError(f"Conversation ID {conversation_id} not found.")
-        message_pair = {
-            'nurse': nurse_message,
-            'bot': bot_message
-        }
+        if self.message_storage == COLLECTION_STORAGE:
+            self._insert_message(conversation_id, nurse_message, bot_message, token_count, token_ids)
+            return True
         result = self.conversations.update_one(
             {'conversation_id': conversation_id},
-            {
-                '$push': {'messages': message_pair},
-                '$set': {'updated_at': datetime.now()}
-            }
+            message_push_update(nurse_message, bot_message, token_count, token_ids)
         )
+        if result.matched_count == 0:
+            raise ValueError(f"Conversation ID {conversation_id} not found.")
         return result.modified_count > 0
 
-    def get_conversation(self, conversation_id: str) -> Optional[Dict]:
+    @timed(MONGO_MESSAGE_WRITE_SECONDS)
+    def append_message(self, conversation_id: str, nurse_message: str, bot_message: str,
+                       history_limit: Optional[int] = None, token_count: Optional[int] = None,
+                       token_ids: Optional[Dict] = None) -> Optional[Dict]:
+        """Add a message pair and read back the updated conversation.
+
+        With embedded storage the push and the read are one atomic round trip; with the
+        messages collection the pair is inserted first and the history read afterwards.
+
+        Args:
+            conversation_id (str): The unique identifier of the conversation.
+            nurse_message (str): The message sent by the nurse.
+            bot_message (str): The response generated by the bot.
+            history_limit (Optional[int]): Number of most recent message pairs to return.
+                Returns the full history when None.
+            token_count (Optional[int]): Prompt token count of the pair, stored alongside it.
+            token_ids (Optional[Dict]): Prompt token ids of the pair from LLMBackend.encode_message.
+
+        Returns:
+            Optional[Dict]: The conversation after the append, as get_conversation returns it,
+            or None if the conversation does not exist.
+
+        Example:
+            >>> crud.append_message("conv123", "How are you?", "I'm doing well, thanks!", history_limit=1)['messages']
+            [{'nurse': 'How are you?', 'bot': "I'm doing well, thanks!"}]
+        """
+        if self.message_storage == COLLECTION_STORAGE:
+            try:
+                self._insert_message(conversation_id, nurse_message, bot_message, token_count, token_ids)
+            except ValueError:
+                return None
+            return self.get_conversation(conversation_id, history_limit)
+        return self.conversations.find_one_and_update(
+            {'conversation_id': conversation_id},
+            message_push_update(nurse_message, bot_message, token_count, token_ids),
+            projection=history_projection(history_limit),
+            return_document=ReturnDocument.AFTER
+        )
+
+    def conversation_exists(self, conversation_id: str) -> bool:
+        """Check whether a conversation exists, using only the conversation_id index.
+
+        Args:
+            conversation_id (str): The unique identifier of the conversation.
+
+        Returns:
+            bool: True if the conversation exists.
+        """
+        return self.conversations.count_documents({'conversation_id': conversation_id}, limit=1) > 0
+
+    @timed(MONGO_HISTORY_READ_SECONDS)
+    def get_conversation(self, conversation_id: str, history_limit: Optional[int] = None) -> Optional[Dict]:
         """Retrieve a conversation by its ID.
 
         Args:
             conversation_id (str): The unique identifier of the conversation to retrieve.
+            history_limit (Optional[int]): If given, only the last `history_limit` message
+                pairs are transferred from the database.
 
         Returns:
             Optional[Dict]: A dictionary containing the conversation data if found.
@@ -95,13 +394,19 @@ class MessageCrudHandler:
             >>> print(conversation)
             {'conversation_id': '12345', 'messages': [...]}
         """
+        if self.message_storage == COLLECTION_STORAGE:
+            conversation = self.conversations.find_one({'conversation_id': conversation_id})
+            if not conversation:
+                return None
+            conversation['messages'] = self._tail_messages(conversation_id, history_limit)
+            return conversation
         conversation = self.conversations.find_one(
-            {'conversation_id': conversation_id})
+            {'conversation_id': conversation_id}, history_projection(history_limit))
         if not conversation:
             return None
         return conversation
 
-    def get_messages(self, conversation_id: str) -> List[Dict]:
+    def get_messages(self, conversation_id: str, history_limit: Optional[int] = None) -> List[Dict]:
         """Get all messages from a conversation.
 
         This method retrieves all messages associated with a specific conversation ID.
@@ -110,6 +415,7 @@ class MessageCrudHandler:
 
         Args:
             conversation_id (str): The unique identifier of the conversation
+            history_limit (Optional[int]): If given, only the last `history_limit` messages are returned.
 
         Returns:
             List[Dict]: A list of message dictionaries. Each dictionary contains message details.
@@ -120,9 +426,98 @@ class MessageCrudHandler:
             >>> print(messages)
             [{'message_id': '1', 'content': 'Hello'}, {'message_id': '2', 'content': 'Hi'}]
         """
-        conversation = self.get_conversation(conversation_id)
+        if self.message_storage == COLLECTION_STORAGE:
+            return self._tail_messages(conversation_id, history_limit)
+        conversation = self.get_conversation(conversation_id, history_limit)
         return conversation.get('messages', []) if conversation else []
 
+    def get_messages_page(self, conversation_id: str, start: int = 0, limit: int = 50) -> List[Dict]:
+        """Get one page of messages in chronological order.
+
+        Every returned message carries its sequence number under 'seq'; pass
+        `last['seq'] + 1` as `start` to fetch the following page.
+
+        Args:
+            conversation_id (str): The unique identifier of the conversation
+            start (int): Sequence number of the first message to return.
+            limit (int): Maximum number of messages to return.
+
+        Returns:
+            List[Dict]: Up to `limit` message dictionaries. Empty if the conversation is not found.
+
+        Example:
+            >>> crud_handler.get_messages_page("conv123", start=0, limit=2)
+            [{'seq': 0, 'nurse': 'Hello', 'bot': 'Hi'}, {'seq': 1, 'nurse': '...', 'bot': '...'}]
+        """
+        if self.message_storage == COLLECTION_STORAGE:
+            cursor = self.messages.find(
+                {'conversation_id': conversation_id, 'seq': {'$gte': start}}, MESSAGE_PROJECTION
+            ).sort('seq', ASCENDING).limit(limit)
+            return list(cursor)
+        conversation = self.conversations.find_one(
+            {'conversation_id': conversation_id}, page_projection(start, limit))
+        if not conversation:
+            return []
+        return [dict(message, seq=start + i) for i, message in enumerate(conversation.get('messages', []))]
+
+    def _insert_message(self, conversation_id: str, nurse_message: str, bot_message: str,
+                         token_count: Optional[int] = None, token_ids: Optional[Dict] = None) -> int:
+        """Reserve the next sequence number and store the pair in the messages collection."""
+        conversation = self.conversations.find_one_and_update(
+            {'conversation_id': conversation_id},
+            sequence_increment_update(),
+            projection={'message_count': 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if conversation is None:
+            raise ValueError(f"Conversation ID {conversation_id} not found.")
+        seq = conversation['message_count'] - 1
+        self.messages.insert_one(
+            message_document(conversation_id, seq, nurse_message, bot_message, token_count, token_ids))
+        return seq
+
+    def _tail_messages(self, conversation_id: str, history_limit: Optional[int] = None) -> List[Dict]:
+        """Read the last `history_limit` pairs (or all of them) from the messages collection, oldest first."""
+        if history_limit is None:
+            cursor = self.messages.find(
+                {'conversation_id': conversation_id}, MESSAGE_PROJECTION).sort('seq', ASCENDING)
+            return list(cursor)
+        if history_limit <= 0:
+            return []
+        cursor = self.messages.find(
+            {'conversation_id': conversation_id}, MESSAGE_PROJECTION).sort('seq', DESCENDING).limit(history_limit)
+        return list(cursor)[::-1]
+
+    def get_summary_state(self, conversation_id: str) -> Optional[Dict]:
+        """Get a conversation's rolling summary and its total number of message pairs.
+
+        Args:
+            conversation_id (str): The unique identifier of the conversation
+
+        Returns:
+            Optional[Dict]: {'summary': {...} (absent if never summarized), 'message_count': int},
+            or None if the conversation is not found.
+        """
+        states = list(self.conversations.aggregate(summary_state_pipeline(conversation_id)))
+        return states[0] if states else None
+
+    def update_summary(self, conversation_id: str, text: str, covered: int, expected_version: int,
+                       token_count: Optional[int] = None) -> bool:
+        """Store a new version of the conversation's rolling summary.
+
+        Args:
+            conversation_id (str): The unique identifier of the conversation
+            text (str): The summary of the first `covered` message pairs.
+            covered (int): Number of oldest message pairs folded into the summary.
+            expected_version (int): Version the summary was computed from (0 if there was none).
+            token_count (Optional[int]): Prompt token count of the summary text.
+
+        Returns:
+            bool: True if stored, False if another writer updated the summary first.
+        """
+        query, update = summary_update(conversation_id, text, covered, expected_version, token_count)
+        return self.conversations.update_one(query, update).modified_count > 0
+
     def delete_conversation(self, conversation_id: str) -> bool:
         """
         Delete a conversation by its ID. If the conversation does not exist, return False.
@@ -132,12 +527,17 @@ class MessageCrudHandler:
 
         Returns:
         bool: True if the conversation was deleted, False otherwise.
+
+        Raises:
+        ValueError: If the conversation_id does not exist in the database.
         """
-        if not self.get_conversation(conversation_id):
-            raise ValueError(f"Conversation ID {conversation_id} not found.")
         result = self.conversations.delete_one(
             {'conversation_id': conversation_id})
-        return result.deleted_count > 0
+        if result.deleted_count == 0:
+            raise ValueError(f"Conversation ID {conversation_id} not found.")
+        if self.message_storage == COLLECTION_STORAGE:
+            self.messages.delete_many({'conversation_id': conversation_id})
+        return True
 
     def close_connection(self):
         """
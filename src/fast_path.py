@@ -0,0 +1,156 @@
+import re
+from datetime import date
+from typing import Callable, Optional
+
+from src.metrics import REGISTRY
+
+FAST_PATH_HITS = REGISTRY.counter("fast_path_hits_total", "Commands answered by the rule-based parser.")
+FAST_PATH_MISSES = REGISTRY.counter("fast_path_misses_total", "Commands passed on to the language model.")
+
+MONTHS = {name: number for number, name in enumerate(
+    ["january", "february", "march", "april", "may", "june", "july", "august", "september", "october",
+     "november", "december"], start=1)}
+MONTHS.update({name[:3]: number for name, number in list(MONTHS.items())})
+MONTHS["sept"] = 9
+
+NAME = r"(?P<{}>[A-Za-z][A-Za-z'\-]*(?: [A-Za-z][A-Za-z'\-]*){{0,3}})"
+END = r"\s*\.?\s*$"
+
+ADD_PATIENT = re.compile(
+    r"^\s*add (?:a )?(?:new )?patient " + NAME.format("name") + r"\s*,\s*(?P<gender>male|female)\s*,\s*"
+    r"(?P<age>\d{1,3})\s*(?:years?|yrs?)(?:[\s-]+old)?\s*,?\s*(?:with|diagnosed with) "
+    r"(?P<condition>[A-Za-z][A-Za-z0-9' \-]*?)" + END,
+    re.IGNORECASE)
+
+ASSIGN_MEDICATION = re.compile(
+    r"^\s*assign (?:the )?medication (?P<medication>[A-Za-z][A-Za-z\-]*(?: [A-Za-z][A-Za-z\-]*)?) "
+    r"(?P<dosage>\d+(?:\.\d+)?\s?(?:mg|mcg|g|ml|iu|units?))\s+"
+    r"(?P<frequency>(?:once|twice|thrice|three times|four times|\d+ times) (?:a|per) (?:day|week)"
+    r"|every \d+ hours|daily|nightly|weekly|at bedtime) (?:for|to) " + NAME.format("patient_name") + END,
+    re.IGNORECASE)
+
+SCHEDULE_FOLLOWUP = re.compile(
+    r"^\s*schedule (?:a )?follow[- ]?up(?: appointment)? (?:for|with) " + NAME.format("patient_name") +
+    r" on (?P<date>[A-Za-z0-9 ,/\-]+?)" + END,
+    re.IGNORECASE)
+
+MONTH_FIRST = re.compile(r"^(?P<month>[A-Za-z]+)\.? (?P<day>\d{1,2})(?:st|nd|rd|th)?(?:,? (?P<year>\d{4}))?$")
+DAY_FIRST = re.compile(r"^(?P<day>\d{1,2})(?:st|nd|rd|th)? (?:of )?(?P<month>[A-Za-z]+)\.?(?:,? (?P<year>\d{4}))?$")
+ISO_DATE = re.compile(r"^(?P<year>\d{4})-(?P<month>\d{1,2})-(?P<day>\d{1,2})$")
+
+
+def ordinal(day: int) -> str:
+    """Return the day with its English ordinal suffix, e.g. 1st, 2nd, 20th."""
+    if 11 <= day % 100 <= 13:
+        return f"{day}th"
+    suffix = {1: 'st', 2: 'nd', 3: 'rd'}.get(day % 10, 'th')
+    return f"{day}{suffix}"
+
+
+def normalize_date(text: str, today: date) -> Optional[date]:
+    """Convert a date as nurses write it ("December 20th", "20 Dec 2024", "2024-12-20") to a date.
+
+    Dates without a year resolve to their next occurrence on or after `today`.
+    Returns None for anything that is not unambiguously a calendar date.
+    """
+    text = text.strip()
+    match = ISO_DATE.match(text)
+    if match:
+        year, month, day = int(match['year']), int(match['month']), int(match['day'])
+    else:
+        match = MONTH_FIRST.match(text) or DAY_FIRST.match(text)
+        if not match or match['month'].lower() not in MONTHS:
+            return None
+        month, day = MONTHS[match['month'].lower()], int(match['day'])
+        year = int(match['year']) if match['year'] else today.year
+    try:
+        result = date(year, month, day)
+    except ValueError:
+        return None
+    if not match['year'] and result < today:
+        try:
+            result = date(year + 1, month, day)
+        except ValueError:
+            return None
+    return result
+
+
+class FastPathParser:
+    """Rule-based parser for the common, unambiguous forms of the three supported commands.
+
+    It produces exactly the JSON the LLMRunner returns for the examples in the prompt,
+    so such commands are answered without running the model. Anything that does not
+    match a pattern in full (extra clauses, missing entities, unusual phrasing) returns
+    None and is left to the model.
+    """
+
+    def __init__(self, today: Callable[[], date] = date.today):
+        """
+        Parameters:
+        today (Callable[[], date]): Returns the current date, used to resolve dates without a year.
+        """
+        self.today = today
+
+    def parse(self, user_input: str) -> Optional[dict]:
+        """Return the bot response for `user_input`, or None if the model has to handle it."""
+        response = self._parse(user_input)
+        if response is None:
+            FAST_PATH_MISSES.inc()
+        else:
+            FAST_PATH_HITS.inc()
+        return response
+
+    @property
+    def hit_rate(self) -> float:
+        """Fraction of parsed commands that were answered without the model."""
+        total = FAST_PATH_HITS.value + FAST_PATH_MISSES.value
+        return FAST_PATH_HITS.value / total if total else 0.0
+
+    def _parse(self, user_input: str) -> Optional[dict]:
+        match = ADD_PATIENT.match(user_input)
+        if match:
+            name = match['name']
+            return {
+                "intent": "add_patient",
+                "entities": {
+                    "name": name,
+                    "gender": match['gender'].lower(),
+                    "age": int(match['age']),
+                    "condition": match['condition'].strip()
+                },
+                "message": f"Successfully added new patient {name} to the system. "
+                           f"Patient profile created with provided details."
+            }
+
+        match = ASSIGN_MEDICATION.match(user_input)
+        if match:
+            medication, dosage = match['medication'], match['dosage'].strip()
+            frequency, patient_name = match['frequency'], match['patient_name']
+            return {
+                "intent": "assign_medication",
+                "entities": {
+                    "patient_name": patient_name,
+                    "medication": medication,
+                    "dosage": dosage,
+                    "frequency": frequency
+                },
+                "message": f"Medication {medication} has been assigned to {patient_name}. "
+                           f"Dosage: {dosage} to be taken {frequency}."
+            }
+
+        match = SCHEDULE_FOLLOWUP.match(user_input)
+        if match:
+            followup_date = normalize_date(match['date'], self.today())
+            if followup_date is None:
+                return None
+            patient_name = match['patient_name']
+            return {
+                "intent": "schedule_followup",
+                "entities": {
+                    "patient_name": patient_name,
+                    "date": followup_date.isoformat()
+                },
+                "message": f"Follow-up appointment scheduled for {patient_name} on "
+                           f"{followup_date.strftime('%B')} {ordinal(followup_date.day)}, {followup_date.year}."
+            }
+        return None
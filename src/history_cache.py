@@ -0,0 +1,259 @@
+import sys
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from src.crud_handler import EMBEDDED_STORAGE, HISTORY_VERSION_PROJECTION
+from src.metrics import REGISTRY
+
+HISTORY_HITS = REGISTRY.counter("history_cache_hits_total", "Conversation histories served from process memory.")
+HISTORY_MISSES = REGISTRY.counter("history_cache_misses_total",
+                                  "Conversation histories read from Mongo because no valid copy was cached.")
+HISTORY_STALE = REGISTRY.counter("history_cache_stale_total",
+                                 "Cached histories dropped because another writer changed the conversation.")
+HISTORY_EVICTIONS = REGISTRY.counter("history_cache_evictions_total",
+                                     "Cached histories dropped to stay within the memory limit.")
+HISTORY_BYTES = REGISTRY.gauge("history_cache_bytes", "Approximate memory held by cached histories.")
+HISTORY_ENTRIES = REGISTRY.gauge("history_cache_entries", "Conversations whose history is cached.")
+
+# Approximate cost of an entry and of each pair beyond their strings: the tuples,
+# the OrderedDict slot and, per token id, a list pointer plus an int object.
+ENTRY_OVERHEAD_BYTES = 200
+MESSAGE_OVERHEAD_BYTES = 120
+TOKEN_ID_BYTES = 36
+
+# A cached pair: (nurse, bot, tokens, token_ids, journal_id); the last three may be None.
+# journal_id is kept so write-behind reads can tell which journaled turns a copy holds.
+CachedMessage = Tuple[str, str, Optional[int], Optional[Dict], Optional[str]]
+
+
+def compact_message(message: Dict) -> CachedMessage:
+    """Convert a stored message dict to the tuple kept in the cache."""
+    return (message.get('nurse', ''), message.get('bot', ''), message.get('tokens'), message.get('token_ids'),
+            message.get('journal_id'))
+
+
+def expand_message(message: CachedMessage) -> Dict:
+    """Rebuild the dict Mongo returns for a cached pair, leaving out absent fields."""
+    nurse, bot, tokens, token_ids, journal_id = message
+    expanded = {'nurse': nurse, 'bot': bot}
+    if tokens is not None:
+        expanded['tokens'] = tokens
+    if token_ids is not None:
+        expanded['token_ids'] = token_ids
+    if journal_id is not None:
+        expanded['journal_id'] = journal_id
+    return expanded
+
+
+def message_size(message: CachedMessage) -> int:
+    """Approximate bytes held by one cached pair."""
+    nurse, bot, _, token_ids, _ = message
+    size = MESSAGE_OVERHEAD_BYTES + sys.getsizeof(nurse) + sys.getsizeof(bot)
+    if token_ids:
+        size += TOKEN_ID_BYTES * len(token_ids.get('ids', ()))
+    return size
+
+
+class CachedHistory:
+    """The history window of one conversation as of `version`."""
+
+    __slots__ = ('version', 'window', 'messages', 'summary', 'size')
+
+    def __init__(self, version: int, window: Optional[int], messages: Tuple[CachedMessage, ...],
+                 summary: Optional[Dict]):
+        self.version = version
+        # The history_limit the copy was read with; None means every pair.
+        self.window = window
+        self.messages = messages
+        self.summary = summary
+        self.size = ENTRY_OVERHEAD_BYTES + sum(message_size(message) for message in messages)
+        if summary:
+            self.size += sys.getsizeof(summary.get('text', ''))
+
+    def covers(self, history_limit: Optional[int]) -> bool:
+        """True if the copy holds at least the last `history_limit` pairs."""
+        if self.window is None:
+            return True
+        return history_limit is not None and history_limit <= self.window
+
+
+class HistoryCache:
+    """Process-local LRU of recent conversation histories, bounded by approximate memory use.
+
+    Entries carry the conversation's history_version; callers compare it with the
+    version in Mongo before serving one, so writes by other workers are never hidden.
+    Not thread-safe: it is used from the event loop only.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        """
+        Parameters:
+        max_bytes (int): Approximate memory the cached histories may use before the least
+            recently used ones are evicted.
+        """
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries: Dict[str, CachedHistory] = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, conversation_id: str) -> Optional[CachedHistory]:
+        """Return the cached history of a conversation and mark it recently used, or None."""
+        entry = self._entries.get(conversation_id)
+        if entry is not None:
+            self._entries.move_to_end(conversation_id)
+        return entry
+
+    def put(self, conversation_id: str, entry: CachedHistory):
+        """Store `entry` unless a copy of a later version is already cached."""
+        current = self._entries.get(conversation_id)
+        if current is not None and current.version > entry.version:
+            return
+        self.invalidate(conversation_id)
+        if entry.size > self.max_bytes:
+            return
+        self._entries[conversation_id] = entry
+        self.bytes += entry.size
+        while self.bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= evicted.size
+            HISTORY_EVICTIONS.inc()
+        self._report()
+
+    def append(self, conversation_id: str, message: CachedMessage, version: int):
+        """Apply a pair written as `version` to the cached copy, if the copy is the version just before it.
+
+        Otherwise another writer got in between and the copy is dropped.
+        """
+        entry = self._entries.get(conversation_id)
+        if entry is None:
+            return
+        if entry.version != version - 1:
+            self.invalidate(conversation_id)
+            return
+        messages = entry.messages + (message,)
+        if entry.window is not None:
+            messages = messages[-entry.window:] if entry.window > 0 else ()
+        self.put(conversation_id, CachedHistory(version, entry.window, messages, entry.summary))
+
+    def invalidate(self, conversation_id: str):
+        """Drop the cached history of a conversation, if any."""
+        entry = self._entries.pop(conversation_id, None)
+        if entry is not None:
+            self.bytes -= entry.size
+            self._report()
+
+    def _report(self):
+        HISTORY_BYTES.set(self.bytes)
+        HISTORY_ENTRIES.set(len(self._entries))
+
+
+class CachedCrudHandler:
+    """Wraps an AsyncMessageCrudHandler so history reads are served from a HistoryCache.
+
+    A read first fetches only the conversation's history_version; the cached copy is
+    used if it is at that version and holds enough pairs, otherwise the history is read
+    and cached. `add_message` writes through: the pair goes to Mongo and is appended to
+    the cached copy. Without a cached copy, the write reads back the history window in
+    the same round trip (append_message) and caches it for the next turn. Summary
+    updates and deletes drop the copy.
+
+    Only embedded message storage is supported: with a messages collection the version
+    is bumped before the pair is inserted, so a copy read in between would pass every
+    later version check without the pair.
+
+    Cached reads return only the fields the prompt is built from: conversation_id,
+    history_version, summary and messages. Every other method is forwarded to the
+    wrapped handler.
+    """
+
+    def __init__(self, crud, cache: HistoryCache, history_limit: Optional[int] = None):
+        """
+        Parameters:
+        crud: The AsyncMessageCrudHandler holding the conversations.
+        cache (HistoryCache): The cache of histories, usually one per process.
+        history_limit (Optional[int]): Pairs read back by a write that finds no cached copy,
+            usually the prompt's history window; None reads every pair.
+
+        Raises:
+            ValueError: If the handler does not use embedded message storage.
+        """
+        if crud.message_storage != EMBEDDED_STORAGE:
+            raise ValueError("The history cache requires embedded message storage.")
+        self.crud = crud
+        self.cache = cache
+        self.history_limit = history_limit
+
+    def __getattr__(self, name):
+        return getattr(self.crud, name)
+
+    async def get_conversation(self, conversation_id: str, history_limit: Optional[int] = None) -> Optional[Dict]:
+        """Retrieve a conversation's history window; see AsyncMessageCrudHandler.get_conversation."""
+        entry = self.cache.get(conversation_id)
+        if entry is not None and entry.covers(history_limit):
+            current = await self.crud.conversations.find_one({'conversation_id': conversation_id},
+                                                            HISTORY_VERSION_PROJECTION)
+            if current is None:
+                self.cache.invalidate(conversation_id)
+                return None
+            if current.get('history_version') == entry.version:
+                HISTORY_HITS.inc()
+                return self._expand(conversation_id, entry, history_limit)
+            HISTORY_STALE.inc()
+            self.cache.invalidate(conversation_id)
+        HISTORY_MISSES.inc()
+        conversation = await self.crud.get_conversation(conversation_id, history_limit)
+        self._put(conversation_id, conversation, history_limit)
+        return conversation
+
+    def _put(self, conversation_id: str, conversation: Optional[Dict], history_limit: Optional[int]):
+        if conversation is not None and conversation.get('history_version') is not None:
+            messages = tuple(compact_message(message) for message in conversation.get('messages', []))
+            self.cache.put(conversation_id, CachedHistory(conversation['history_version'], history_limit, messages,
+                                                          conversation.get('summary')))
+
+    @staticmethod
+    def _expand(conversation_id: str, entry: CachedHistory, history_limit: Optional[int]) -> Dict:
+        messages = entry.messages
+        if history_limit is not None:
+            messages = messages[-history_limit:] if history_limit > 0 else ()
+        conversation = {'conversation_id': conversation_id, 'history_version': entry.version,
+                        'messages': [expand_message(message) for message in messages]}
+        if entry.summary is not None:
+            conversation['summary'] = dict(entry.summary)
+        return conversation
+
+    async def get_messages(self, conversation_id: str, history_limit: Optional[int] = None) -> List[Dict]:
+        """Get a conversation's last `history_limit` messages, from the cache when it is current."""
+        conversation = await self.get_conversation(conversation_id, history_limit)
+        return conversation.get('messages', []) if conversation else []
+
+    async def add_message(self, conversation_id: str, nurse_message: str, bot_message: str,
+                          token_count: Optional[int] = None, token_ids: Optional[Dict] = None) -> bool:
+        """Add a message pair to the conversation and to its cached history.
+
+        Raises:
+            ValueError: If the conversation_id does not exist in the database.
+        """
+        if self.cache.get(conversation_id) is None:
+            conversation = await self.crud.append_message(conversation_id, nurse_message, bot_message,
+                                                          self.history_limit, token_count, token_ids)
+            if conversation is None:
+                raise ValueError(f"Conversation ID {conversation_id} not found.")
+            self._put(conversation_id, conversation, self.history_limit)
+            return True
+        version = await self.crud.push_message(conversation_id, nurse_message, bot_message, token_count, token_ids)
+        self.cache.append(conversation_id, (nurse_message, bot_message, token_count, token_ids, None), version)
+        return True
+
+    async def update_summary(self, conversation_id: str, text: str, covered: int, expected_version: int,
+                             token_count: Optional[int] = None) -> bool:
+        """Store a new rolling summary and drop the cached history; see AsyncMessageCrudHandler.update_summary."""
+        self.cache.invalidate(conversation_id)
+        return await self.crud.update_summary(conversation_id, text, covered, expected_version, token_count)
+
+    async def delete_conversation(self, conversation_id: str) -> bool:
+        """Delete a conversation and its cached history; see AsyncMessageCrudHandler.delete_conversation."""
+        self.cache.invalidate(conversation_id)
+        return await self.crud.delete_conversation(conversation_id)
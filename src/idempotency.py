@@ -0,0 +1,93 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+from src.metrics import REGISTRY
+
+IDEMPOTENT_REPLAYS = REGISTRY.counter("idempotent_replays_total",
+                                      "Requests answered from an earlier request with the same idempotency key.")
+
+
+class IdempotencyKeyConflict(ValueError):
+    """An idempotency key was reused with a different request payload."""
+
+
+class _Entry:
+    __slots__ = ("fingerprint", "task", "expires_at")
+
+    def __init__(self, fingerprint, task, expires_at):
+        self.fingerprint = fingerprint
+        self.task = task
+        self.expires_at = expires_at
+
+
+class IdempotencyRegistry:
+    """Coalesces requests that share an idempotency key onto a single execution.
+
+    The first request for a key starts the work as a task; retries that arrive while
+    it is running await the same task, and retries that arrive after it finished get
+    its result directly. Failed or cancelled executions are forgotten, so a retry
+    runs the work again. The registry lives in process memory, holds at most
+    `max_entries` keys (oldest dropped first) and forgets each key `ttl_seconds`
+    after it was first seen.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl_seconds: float = 600,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        Parameters:
+        max_entries (int): Keys remembered before the oldest is dropped.
+        ttl_seconds (float): How long a key is remembered after its first request.
+        clock (Callable[[], float]): Time source, in seconds.
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._entries: "OrderedDict[Hashable, _Entry]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def run(self, key: Hashable, fingerprint: Any, fn: Callable[[], Awaitable]):
+        """Run `fn` once per key and return its result to every request carrying that key.
+
+        Args:
+            key (Hashable): Idempotency key, scoped by the caller (e.g. per conversation).
+            fingerprint (Any): Identifies the request payload; reusing a key with a different one is an error.
+            fn (Callable[[], Awaitable]): Starts the work when the key has not been seen.
+
+        Returns:
+            The result of the execution the key was first used for.
+
+        Raises:
+            IdempotencyKeyConflict: If the key was already used for a different payload.
+        """
+        self._expire()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.fingerprint != fingerprint:
+                raise IdempotencyKeyConflict(f"Idempotency key {key!r} was already used for a different request.")
+            IDEMPOTENT_REPLAYS.inc()
+        else:
+            entry = _Entry(fingerprint, asyncio.ensure_future(fn()), self.clock() + self.ttl_seconds)
+            self._entries[key] = entry
+            entry.task.add_done_callback(lambda task: self._forget_failed(key, task))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        # A client disconnecting must not cancel work that retries are waiting on.
+        return await asyncio.shield(entry.task)
+
+    def _forget_failed(self, key: Hashable, task: asyncio.Future):
+        if task.cancelled() or task.exception() is not None:
+            entry = self._entries.get(key)
+            if entry is not None and entry.task is task:
+                del self._entries[key]
+
+    def _expire(self):
+        now = self.clock()
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.expires_at > now:
+                break
+            del self._entries[key]
@@ -0,0 +1,68 @@
+import json
+from typing import Optional
+
+
+class JsonObjectExtractor:
+    """Incrementally captures the first top-level JSON object from streamed text.
+
+    Text is fed chunk by chunk (e.g. one decoded token at a time). Anything before the
+    first '{' is skipped; from there the extractor tracks brace depth, ignoring braces
+    inside strings and escaped quotes, and marks itself complete as soon as the
+    top-level object closes. Chunks fed after that are ignored.
+    """
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.complete = False
+        self._chars = []
+
+    @property
+    def text(self) -> str:
+        """The captured object text so far (possibly incomplete)."""
+        return ''.join(self._chars)
+
+    def feed(self, chunk: str) -> bool:
+        """Consume a chunk of text and return True once the top-level object is complete."""
+        for char in chunk:
+            if self.complete:
+                break
+            if self.depth == 0:
+                if char == '{':
+                    self.depth = 1
+                    self._chars.append(char)
+                continue
+            self._chars.append(char)
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char == '{':
+                self.depth += 1
+            elif char == '}':
+                self.depth -= 1
+                if self.depth == 0:
+                    self.complete = True
+        return self.complete
+
+    def parse(self) -> Optional[dict]:
+        """Return the captured object as a dict, or None if it is incomplete or invalid JSON."""
+        if not self.complete:
+            return None
+        try:
+            return json.loads(self.text)
+        except json.JSONDecodeError:
+            return None
+
+
+def parse_json_object(text: str) -> Optional[dict]:
+    """Parse the first complete top-level JSON object found in `text`, or return None."""
+    extractor = JsonObjectExtractor()
+    extractor.feed(text)
+    return extractor.parse()
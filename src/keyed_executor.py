@@ -0,0 +1,86 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+
+from src.metrics import REGISTRY
+
+ACTIVE_KEYS = REGISTRY.gauge("keyed_executor_active_keys", "Conversations with a turn running or queued.")
+REJECTED_TURNS = REGISTRY.counter("keyed_executor_rejected_total",
+                                  "Turns rejected because their conversation's queue was full.")
+
+
+class KeyQueueFull(RuntimeError):
+    """Too many turns are already queued for the same key."""
+
+
+class _KeyState:
+    __slots__ = ("lock", "pending")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending = 0
+
+
+class KeyedExecutor:
+    """Runs coroutines one at a time per key and concurrently across keys.
+
+    Each key (a conversation id) behaves like a small actor: its turns run in
+    arrival order, each one seeing the history written by the previous one, while
+    turns for different keys proceed in parallel, up to `max_concurrency` at once.
+    A key's state exists only while it has running or queued turns, so idle
+    conversations cost no memory.
+    """
+
+    def __init__(self, max_pending_per_key: int = 8, max_concurrency: Optional[int] = None):
+        """
+        Parameters:
+        max_pending_per_key (int): Turns allowed per key, running plus queued; more are rejected.
+        max_concurrency (int, optional): Turns allowed to run at once across all keys. Unbounded if None.
+        """
+        self.max_pending_per_key = max_pending_per_key
+        self._slots = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+        self._keys: Dict[Hashable, _KeyState] = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    async def run(self, key: Hashable, fn: Callable[[], Awaitable]):
+        """Await `fn()` once every earlier turn for `key` has finished.
+
+        Raises:
+            KeyQueueFull: If `max_pending_per_key` turns are already running or queued for `key`.
+        """
+        async with self.hold(key):
+            return await fn()
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable):
+        """Wait for `key`'s turn and keep it for the duration of the `async with` block.
+
+        Used instead of `run` when the turn is not a single coroutine, e.g. a streamed response.
+
+        Raises:
+            KeyQueueFull: If `max_pending_per_key` turns are already running or queued for `key`.
+        """
+        state = self._keys.get(key)
+        if state is None:
+            state = self._keys[key] = _KeyState()
+            ACTIVE_KEYS.inc()
+        if state.pending >= self.max_pending_per_key:
+            REJECTED_TURNS.inc()
+            raise KeyQueueFull(f"Too many requests queued for {key}.")
+        state.pending += 1
+        try:
+            # The global slot is taken only once it is this key's turn, so turns queued
+            # behind a busy conversation never hold up other conversations.
+            async with state.lock:
+                if self._slots is None:
+                    yield
+                else:
+                    async with self._slots:
+                        yield
+        finally:
+            state.pending -= 1
+            if state.pending == 0 and self._keys.get(key) is state:
+                del self._keys[key]
+                ACTIVE_KEYS.dec()
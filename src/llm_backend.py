@@ -0,0 +1,347 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from concurrent.futures import Executor
+from typing import AsyncIterator, Awaitable, Callable, Iterator, Optional, Sequence, Tuple, Type
+
+from src import config
+from src.metrics import REGISTRY
+
+LLM_REQUEST_SECONDS = REGISTRY.histogram("llm_request_seconds", "Duration of individual LLM API attempts.")
+LLM_RETRIES = REGISTRY.counter("llm_retries_total", "LLM API attempts retried after a transient failure.")
+LLM_HEDGES = REGISTRY.counter("llm_hedged_requests_total", "Duplicate LLM requests sent because the first was slow.")
+
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+TOKENS_PER_SECOND_BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+LLM_PROMPT_BUILD_SECONDS = REGISTRY.histogram("llm_prompt_build_seconds",
+                                              "Time to assemble a prompt, tokenization included for the local model.")
+LLM_GENERATION_SECONDS = REGISTRY.histogram("llm_generation_seconds",
+                                            "Duration of a local generation batch or an API request with retries.")
+LLM_FIRST_TOKEN_SECONDS = REGISTRY.histogram("llm_first_token_seconds",
+                                             "Time until the first response token: prefill for the local model.")
+LLM_PROMPT_TOKENS = REGISTRY.histogram("llm_prompt_tokens", "Prompt tokens per response.", buckets=TOKEN_BUCKETS)
+LLM_COMPLETION_TOKENS = REGISTRY.histogram("llm_completion_tokens", "Generated tokens per response.",
+                                           buckets=TOKEN_BUCKETS)
+LLM_TOKENS_PER_SECOND = REGISTRY.histogram("llm_tokens_per_second",
+                                           "Generated tokens per second of generation, summed over a batch.",
+                                           buckets=TOKENS_PER_SECOND_BUCKETS)
+LLM_PARSE_FAILURES = REGISTRY.counter("llm_parse_failures_total", "Model responses that were not a valid JSON object.")
+
+
+def observe_generation(prompt_tokens: Sequence[int], completion_tokens: Sequence[int], seconds: float,
+                       first_token_seconds: Optional[float] = None):
+    """Record the duration, token counts and speed of one generation.
+
+    Args:
+        prompt_tokens (Sequence[int]): Prompt length of every response generated, e.g. each row of a batch.
+        completion_tokens (Sequence[int]): Generated length of every response; empty if unknown.
+        seconds (float): Duration of the whole generation.
+        first_token_seconds (float, optional): Time until the first token was generated, if known.
+    """
+    LLM_GENERATION_SECONDS.observe(seconds)
+    if first_token_seconds is not None:
+        LLM_FIRST_TOKEN_SECONDS.observe(first_token_seconds)
+    for count in prompt_tokens:
+        LLM_PROMPT_TOKENS.observe(count)
+    for count in completion_tokens:
+        LLM_COMPLETION_TOKENS.observe(count)
+    if completion_tokens and seconds > 0:
+        LLM_TOKENS_PER_SECOND.observe(sum(completion_tokens) / seconds)
+
+
+class LLMBackend:
+    """Interface shared by every LLMRunner.
+
+    Backends either generate synchronously (`run`, `stream`, `summarize`), in which case
+    callers run them on a thread pool, or set `is_async` and implement the coroutine
+    variants (`arun`, `astream`, `asummarize`) so they run on the event loop directly.
+    The synchronous methods are available on every backend.
+    """
+
+    # Token budgets the ContextBuilder and summarizer size the prompt with.
+    history_token_budget = 256
+    summary_token_budget = 96
+    # True when the a-prefixed coroutine methods are the native implementation.
+    is_async = False
+
+    def count_tokens(self, text: str) -> int:
+        """Return the number of tokens the backend's model sees for `text`."""
+        raise NotImplementedError
+
+    def encode_message(self, nurse_message: str, bot_message: str) -> Optional[dict]:
+        """Return prompt token ids to store with a new pair ('token_ids'), or None if the backend has no use for them."""
+        return None
+
+    def run(self, messages: list = None, prompt: str = '', summary: str = '') -> Optional[dict]:
+        """Generate the response to `prompt`; None if the model output is not valid JSON."""
+        raise NotImplementedError
+
+    def stream(self, messages: list = None, prompt: str = '', summary: str = '') -> Iterator[str]:
+        """Yield the raw response text piece by piece as it is generated."""
+        raise NotImplementedError
+
+    def summarize(self, summary: str, messages: list) -> str:
+        """Fold `messages` into the rolling `summary` and return the new summary text."""
+        raise NotImplementedError
+
+    async def arun(self, messages: list = None, prompt: str = '', summary: str = '') -> Optional[dict]:
+        raise NotImplementedError
+
+    async def astream(self, messages: list = None, prompt: str = '', summary: str = '') -> AsyncIterator[str]:
+        raise NotImplementedError
+        yield
+
+    async def asummarize(self, summary: str, messages: list) -> str:
+        raise NotImplementedError
+
+    async def acount_tokens(self, text: str) -> int:
+        """Coroutine variant of count_tokens; overridden by backends that count over a connection."""
+        return self.count_tokens(text)
+
+    async def aencode_message(self, nurse_message: str, bot_message: str) -> Optional[dict]:
+        """Coroutine variant of encode_message; overridden by backends that encode over a connection."""
+        return self.encode_message(nurse_message, bot_message)
+
+
+class RequestPolicy:
+    """Concurrency limit, per-attempt timeout, retries with jittered backoff and hedging for API calls.
+
+    Every attempt holds one of `max_concurrency` slots and is abandoned after
+    `timeout_seconds`. Failures of the types in `retry_on` are retried up to
+    `max_retries` times, sleeping a random time between 0 and an exponentially growing
+    cap ("full jitter") so retries from many requests don't arrive together. When
+    `hedge_after_seconds` is set and an attempt is still running after that long, an
+    identical second attempt is started and whichever finishes first wins; the other
+    is cancelled. This trims the latency tail at the cost of a few duplicate requests.
+    """
+
+    def __init__(self, max_concurrency: int = 16, timeout_seconds: float = 30, max_retries: int = 2,
+                 backoff_base_seconds: float = 0.5, backoff_cap_seconds: float = 8,
+                 hedge_after_seconds: Optional[float] = None,
+                 retry_on: Tuple[Type[BaseException], ...] = (asyncio.TimeoutError, ConnectionError),
+                 rng: Optional[random.Random] = None):
+        """
+        Parameters:
+        max_concurrency (int): Attempts in flight at once, hedges included.
+        timeout_seconds (float): Time allowed for a single attempt.
+        max_retries (int): Retries after the first attempt fails with a retryable error.
+        backoff_base_seconds (float): Backoff cap before the first retry; doubles with each retry.
+        backoff_cap_seconds (float): Upper bound for the backoff cap.
+        hedge_after_seconds (float, optional): Start a duplicate attempt after this long; no hedging if None.
+        retry_on (tuple): Exception types treated as transient.
+        rng (random.Random, optional): Source of the jitter.
+        """
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.timeout_seconds = timeout_seconds
+        self.max_retries = max_retries
+        self.backoff_base_seconds = backoff_base_seconds
+        self.backoff_cap_seconds = backoff_cap_seconds
+        self.hedge_after_seconds = hedge_after_seconds
+        self.retry_on = tuple(retry_on) + (asyncio.TimeoutError,)
+        self.rng = rng or random.Random()
+
+    def backoff(self, retry: int) -> float:
+        """Seconds to sleep before retry number `retry` (0-based)."""
+        return self.rng.uniform(0, min(self.backoff_cap_seconds, self.backoff_base_seconds * 2 ** retry))
+
+    async def call(self, fn: Callable[[], Awaitable]):
+        """Await `fn()` under the policy and return the first successful result.
+
+        Raises:
+            The last attempt's exception if every attempt failed, or any non-retryable exception at once.
+        """
+        for retry in range(self.max_retries + 1):
+            try:
+                return await self._hedged(fn)
+            except self.retry_on:
+                if retry == self.max_retries:
+                    raise
+            LLM_RETRIES.inc()
+            await asyncio.sleep(self.backoff(retry))
+
+    async def _attempt(self, fn: Callable[[], Awaitable]):
+        async with self.semaphore:
+            started = time.monotonic()
+            try:
+                return await asyncio.wait_for(fn(), self.timeout_seconds)
+            finally:
+                LLM_REQUEST_SECONDS.observe(time.monotonic() - started)
+
+    async def _hedged(self, fn: Callable[[], Awaitable]):
+        if self.hedge_after_seconds is None:
+            return await self._attempt(fn)
+        pending = {asyncio.ensure_future(self._attempt(fn))}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=self.hedge_after_seconds)
+            if not done:
+                LLM_HEDGES.inc()
+                pending.add(asyncio.ensure_future(self._attempt(fn)))
+            error = None
+            while True:
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                if not pending:
+                    raise error
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+def lognormal_latency(median_seconds: float, sigma: float = 0.5,
+                      rng: Optional[random.Random] = None) -> Callable[[], float]:
+    """Return a sampler of right-skewed latencies, the usual shape of LLM API response times."""
+    rng = rng or random.Random()
+    return lambda: median_seconds * rng.lognormvariate(0, sigma)
+
+
+def echo_response(prompt: str) -> dict:
+    """Default FakeLLMBackend reply: a well-formed response that repeats the input."""
+    return {"intent": "echo", "entities": {}, "message": f"Received: {prompt}"}
+
+
+class FakeLLMBackend(LLMBackend):
+    """Offline backend with simulated latency and failures, for tests and load experiments.
+
+    Each request sleeps for a latency drawn from `latency`, fails with `failure` with
+    probability `failure_rate`, and otherwise answers with `respond(prompt)`. The async
+    methods go through a RequestPolicy exactly like the OpenAI backend, so timeouts,
+    retries and hedging can be exercised without network access.
+    """
+
+    is_async = True
+    history_token_budget = 4096
+    summary_token_budget = 512
+
+    def __init__(self, latency: Callable[[], float] = lambda: 0.0, failure_rate: float = 0.0,
+                 failure: Type[Exception] = ConnectionError, respond: Callable[[str], dict] = echo_response,
+                 policy: Optional[RequestPolicy] = None, rng: Optional[random.Random] = None):
+        """
+        Parameters:
+        latency (Callable[[], float]): Returns the simulated duration of one request, in seconds.
+        failure_rate (float): Probability that a request fails.
+        failure (Type[Exception]): Exception raised by failing requests.
+        respond (Callable[[str], dict]): Builds the response for a prompt.
+        policy (RequestPolicy, optional): Applied to the async methods; a default policy if None.
+        rng (random.Random, optional): Source of the simulated failures.
+        """
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure = failure
+        self.respond = respond
+        self.policy = policy or RequestPolicy()
+        self.rng = rng or random.Random()
+        self.requests = 0
+
+    def count_tokens(self, text: str) -> int:
+        return len(text.split())
+
+    def _outcome(self) -> float:
+        self.requests += 1
+        if self.rng.random() < self.failure_rate:
+            raise self.failure("Simulated backend failure")
+        return self.latency()
+
+    def run(self, messages: list = None, prompt: str = '', summary: str = '') -> Optional[dict]:
+        time.sleep(self._outcome())
+        return self.respond(prompt)
+
+    def stream(self, messages: list = None, prompt: str = '', summary: str = '') -> Iterator[str]:
+        text = json.dumps(self.run(messages, prompt, summary))
+        for start in range(0, len(text), 8):
+            yield text[start:start + 8]
+
+    def summarize(self, summary: str, messages: list) -> str:
+        time.sleep(self._outcome())
+        return ' '.join(filter(None, [summary] + [message['nurse'] for message in messages]))
+
+    async def _complete(self, prompt: str) -> dict:
+        await asyncio.sleep(self._outcome())
+        return self.respond(prompt)
+
+    async def arun(self, messages: list = None, prompt: str = '', summary: str = '') -> Optional[dict]:
+        return await self.policy.call(lambda: self._complete(prompt))
+
+    async def astream(self, messages: list = None, prompt: str = '', summary: str = '') -> AsyncIterator[str]:
+        text = json.dumps(await self.arun(messages, prompt, summary))
+        for start in range(0, len(text), 8):
+            yield text[start:start + 8]
+
+    async def asummarize(self, summary: str, messages: list) -> str:
+        async def complete():
+            await asyncio.sleep(self._outcome())
+            return ' '.join(filter(None, [summary] + [message['nurse'] for message in messages]))
+
+        return await self.policy.call(complete)
+
+
+async def iterate_in_executor(executor: Optional[Executor], fn: Callable[..., Iterator], *args, **kwargs):
+    """Run a blocking generator on `executor` and yield its items on the event loop as they arrive.
+
+    If the consumer stops early, the generator is closed after the item it is producing,
+    so it can stop its work instead of running to the end.
+    """
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue()
+    done = object()
+    stopped = threading.Event()
+
+    def produce():
+        iterator = fn(*args, **kwargs)
+        try:
+            for item in iterator:
+                if stopped.is_set():
+                    break
+                loop.call_soon_threadsafe(items.put_nowait, item)
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+            loop.call_soon_threadsafe(items.put_nowait, done)
+
+    producer = loop.run_in_executor(executor, produce)
+    try:
+        while True:
+            item = await items.get()
+            if item is done:
+                break
+            yield item
+    finally:
+        stopped.set()
+    # Re-raises anything the generator raised.
+    await producer
+
+
+def create_llm_runner(backend: str = config.LLM_BACKEND):
+    """
+    Build the LLMBackend selected by the LLM_BACKEND setting.
+
+    Only the chosen backend's module is imported, so every backend except the local
+    model can run on a machine without unsloth or a GPU.
+
+    Args:
+        backend (str): One of config.LLM_BACKENDS.
+
+    Returns:
+        LLMBackend: The runner for that backend; the local model is fully loaded and the
+            remote backend connected on return.
+
+    Raises:
+        ValueError: If the backend is unknown.
+    """
+    if backend == config.LOCAL_BACKEND:
+        from src.management_bot import LLMRunner
+        return LLMRunner(constrained_decoding=config.MODEL_CONSTRAINED_DECODING)
+    elif backend == config.OPENAI_BACKEND:
+        from src.management_bot_openai import LLMRunner
+    elif backend == config.FAKE_BACKEND:
+        return FakeLLMBackend(latency=lognormal_latency(config.FAKE_LATENCY_MEDIAN_SECONDS))
+    elif backend == config.REMOTE_BACKEND:
+        from src.model_server import RemoteLLMBackend
+        return RemoteLLMBackend()
+    else:
+        raise ValueError(f"Unknown LLM backend {backend}, expected one of {', '.join(config.LLM_BACKENDS)}.")
+    return LLMRunner()
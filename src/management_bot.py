@@ -1,156 +1,81 @@
-import sys
-import re
 import json
-import io
-from contextlib import redirect_stdout
+import logging
+import threading
+import torch
+from time import perf_counter
 from unsloth import FastLanguageModel
-from transformers import TextStreamer
-
-llm_instruction_template_1 = """# System Context
-You are a specialized medical assistant AI designed to help nurses manage patient information, medications, and appointments. You must process natural language commands and return structured JSON responses. Always maintain medical data privacy and accuracy in your responses.
-
-# Previous Thread History"""
-
-llm_instruction_template_2 = """# Task Definition
-You must parse natural language commands related to nursing tasks and return structured JSON output. You handle three main types of tasks:
-
-1. Adding new patients
-2. Assigning medications
-3. Scheduling follow-ups
-
-# Response Format Requirements
-- Always respond with valid JSON
-- Include "intent", "entities", and "message" in every response
-- Use consistent key names across responses
-- Return error messages in JSON format when information is missing
-- Include a human-readable confirmation message for each successful action
-
-# Supported Intents and Required Entities
-1. add_patient
-   - name (string)
-   - gender (string)
-   - age (number)
-   - condition (string)
-
-2. assign_medication
-   - patient_name (string)
-   - medication (string)
-   - dosage (string)
-   - frequency (string)
-
-3. schedule_followup
-   - patient_name (string)
-   - date (string)
-
-# Error Handling
-If any required entity is missing, respond with:
-{
-    "error": true,
-    "missing_entities": ["entity1", "entity2"],
-    "message": "Please provide the following information: [list missing items]"
-}
-
-# Examples
-Input: "Add a new patient John Doe, male, 45 years old, with diabetes."
-Expected Output:
-{
-    "intent": "add_patient",
-    "entities": {
-        "name": "John Doe",
-        "gender": "male",
-        "age": 45,
-        "condition": "diabetes"
-    },
-    "message": "Successfully added new patient John Doe to the system. Patient profile created with provided details."
-}
-
-Input: "Assign medication Paracetamol 500mg twice a day for John Doe."
-Expected Output:
-{
-    "intent": "assign_medication",
-    "entities": {
-        "patient_name": "John Doe",
-        "medication": "Paracetamol",
-        "dosage": "500mg",
-        "frequency": "twice a day"
-    },
-    "message": "Medication Paracetamol has been assigned to John Doe. Dosage: 500mg to be taken twice a day."
-}
-
-Input: "Schedule a follow-up for John Doe on December 20th."
-Expected Output:
-{
-    "intent": "schedule_followup",
-    "entities": {
-        "patient_name": "John Doe",
-        "date": "2024-12-20"
-    },
-    "message": "Follow-up appointment scheduled for John Doe on December 20th, 2024."
-}
-
-# Message Format Guidelines
-1. add_patient messages should:
-   - Confirm successful patient addition
-   - Acknowledge all provided details
-   - Use a professional, medical tone
-
-2. assign_medication messages should:
-   - Confirm medication assignment
-   - Repeat dosage and frequency for verification
-   - Include patient name for clarity
-
-3. schedule_followup messages should:
-   - Confirm appointment scheduling
-   - Include full date in a clear format
-   - Include patient name
-
-# Rules
-1. Never make assumptions about missing data
-2. Maintain consistent entity names across all responses
-3. Always validate that patient names match exactly
-4. Convert all dates to ISO format (YYYY-MM-DD)
-5. Preserve exact medication dosages as provided
-6. Return error messages for ambiguous commands
-7. Include clear, human-readable confirmation messages
-
-# Process Flow
-1. Identify the primary intent from the input
-2. Extract all relevant entities
-3. Validate completeness of required entities
-4. Generate appropriate confirmation message
-5. Format response in JSON with message
-6. Include error handling if needed
-
-Remember that you are processing nurse commands in a healthcare context. Maintain high accuracy and ask for clarification when needed."""
-
-formatted_instruction_prompt = """Below is an instruction that describes a task, paired with an input that provides further context. Write a response that appropriately completes the request.
-
-    ### Instruction:
-    {}
-
-    ### Input:
-    {}
-
-    ### Response:
-    {}"""
-
-
-class LLMRunner:
-    def __init__(self):
+from transformers import TextIteratorStreamer
+from typing import Iterator
+
+from src.context_builder import format_history
+from src.prefix_cache import PrefixKVCache
+from src.batch_scheduler import BatchScheduler
+from src.json_stream import parse_json_object
+from src.stopping_criteria import BraceBalancedStoppingCriteria
+from src.constrained_decoding import ConstrainedDecoder, TruncatedResponseError
+from src import config
+from src.llm_backend import LLM_PARSE_FAILURES, LLM_PROMPT_BUILD_SECONDS, LLMBackend, observe_generation
+from src.prompt_tokens import PromptTokenCache
+from src.prompts import static_prompt_prefix, summary_instruction_template
+
+logger = logging.getLogger(__name__)
+
+
+class LLMRunner(LLMBackend):
+    # Tokens available for thread history: max_seq_length (2048) minus the ~1,500-token
+    # instructions, the nurse input and max_new_tokens.
+    history_token_budget = 256
+    summary_token_budget = 96
+
+    def __init__(self, max_batch_size: int = 8, max_wait_ms: float = 10, constrained_decoding: bool = False,
+                 device: str = config.MODEL_DEVICE, apply_peft: bool = config.MODEL_APPLY_PEFT):
+        """
+        Parameters:
+        max_batch_size (int): Maximum number of concurrent prompts generated together; 1 disables batching.
+        max_wait_ms (float): How long a prompt waits for others to join its batch.
+        constrained_decoding (bool): Force every response to match the intent/error schemas token by token.
+            A response with a value longer than its slot allows is generated again without constraints.
+        device (str): Device the prompts are placed on, e.g. "cuda", "cuda:1" or "cpu".
+        apply_peft (bool): Wrap the model in trainable LoRA adapters (for fine-tuning) instead of
+            preparing it for inference.
+        """
+        self.device = device
+        self.apply_peft = apply_peft
         self.model = None
         self.tokenizer = None
+        self.constrained_decoder = None
         self._initialize_model_and_tokenizer()
+        if constrained_decoding:
+            self.constrained_decoder = ConstrainedDecoder(self.model, self.tokenizer)
+        self.scheduler = None
+        if max_batch_size > 1:
+            self.scheduler = BatchScheduler(self.generate_batch, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
 
     def _initialize_model_and_tokenizer(self):
         self.model, self.tokenizer = self._load_model_and_tokenizer()
-        self.model = self._apply_peft_to_model(self.model)
-
-    def _load_model_and_tokenizer(self, model_name="unsloth/Meta-Llama-3.1-8B", max_seq_length=2048, dtype=None, load_in_4bit=True):
+        if self.apply_peft:
+            self.model = self._apply_peft_to_model(self.model)
+        else:
+            # Serving needs no trainable adapters, gradient checkpointing or dropout:
+            # switch to eval mode and unsloth's fast inference kernels.
+            FastLanguageModel.for_inference(self.model)
+        self.prefix_cache = self._build_prefix_cache()
+        self.prompt_tokens = PromptTokenCache(lambda text: self.tokenizer.encode(text, add_special_tokens=False),
+                                              tokenizer_id=self.tokenizer.name_or_path)
+
+    def _build_prefix_cache(self):
+        """Prefill the static instructions once so requests only prefill history and input."""
+        prefix_ids = self.tokenizer([static_prompt_prefix], return_tensors="pt").input_ids.to(self.device)
+        return PrefixKVCache(self.model, prefix_ids)
+
+    def _load_model_and_tokenizer(self, model_name=config.MODEL_NAME, max_seq_length=config.MODEL_MAX_SEQ_LENGTH, dtype=None,
+                                  load_in_4bit=config.MODEL_LOAD_IN_4BIT):
         model, tokenizer = FastLanguageModel.from_pretrained(
             model_name=model_name,
             max_seq_length=max_seq_length,
             dtype=dtype,
-            load_in_4bit=load_in_4bit
+            load_in_4bit=load_in_4bit,
+            device_map={"": self.device}
         )
         return model, tokenizer
 
@@ -185,60 +110,157 @@ class LLMRunner:
             dict: Parsed JSON response, or None if parsing fails
         """
         try:
-            # Read buffer contents
             content = buffer.getvalue()
+        except AttributeError:
+            logger.warning("Invalid buffer object")
+            return None
 
-            # Find everything between "### Response:" and the end of the JSON object
-            pattern = r'### Response:\s*({[\s\S]*})'
-            match = re.search(pattern, content)
+        # Parse the first complete JSON object following "### Response:"
+        start = content.find('### Response:')
+        if start == -1:
+            logger.warning("No JSON response found in buffer")
+            return None
+        return parse_json_object(content[start:])
 
-            if not match:
-                print("No JSON response found in buffer")
-                return None
+    def count_tokens(self, text: str) -> int:
+        """Return the number of tokens the model's tokenizer produces for `text`."""
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
 
-            # Extract and parse JSON
-            json_str = match.group(1).strip()
-            return json.loads(json_str)
+    def encode_message(self, nurse_message: str, bot_message: str) -> dict:
+        """Return the prompt token ids of a new pair, to be stored with it as 'token_ids'."""
+        return self.prompt_tokens.stored_ids(nurse_message, bot_message)
 
-        except AttributeError:
-            print("Invalid buffer object")
-            return None
-        except json.JSONDecodeError as e:
-            print(f"Failed to parse JSON: {e}")
-            return None
-        except Exception as e:
-            print(f"Unexpected error: {e}")
-            return None
+    def _suffix_ids(self, messages: list = None, prompt: str = '', summary: str = ''):
+        """Token ids of the dynamic prompt suffix, assembled from cached pair ids; shape (1, length)."""
+        with LLM_PROMPT_BUILD_SECONDS.time():
+            return torch.tensor([self.prompt_tokens.suffix_ids(messages, prompt, summary)], dtype=torch.long)
 
-    def run(self, messages: list = None, prompt: str = ''):
+    def _observe_generation(self, suffix_ids: list, stopping_criteria: BraceBalancedStoppingCriteria, started: float):
+        """Record the metrics of a generation that began at `started` and has just ended."""
+        prefix_length = self.prefix_cache.prefix_ids.shape[-1]
+        first_token_at = stopping_criteria.first_token_at
+        observe_generation([prefix_length + ids.shape[-1] for ids in suffix_ids], stopping_criteria.generated,
+                           perf_counter() - started, first_token_at - started if first_token_at else None)
 
-        if not messages:
-            formatted_messages = []
-            for message in messages:
-                nurse_line = f"NURSE: {message['nurse']}"
-                bot_line = f"BOT: {message['bot']}"
-                formatted_messages.extend([nurse_line, bot_line])
-                
-            full_context = '\n'.join(formatted_messages)
-        else:
-            full_context = ''
-
-            
-        instruction = llm_instruction_template_1+full_context+llm_instruction_template_2
-        
-        formatted_instruction_prompt.format(str(instruction), str(prompt), "")
-
-        inputs = self.tokenizer([
-            formatted_instruction_prompt
-        ], return_tensors="pt").to("cuda")
-
-        text_streamer = TextStreamer(self.tokenizer)
-        buffer = io.StringIO()
-
-        with redirect_stdout(buffer):
-            self.model.generate(
-                **inputs, streamer=text_streamer, max_new_tokens=128)
-            
-        json_response = self.__parse_json_from_buffer(buffer)
-        
-        return json_response
+    def summarize(self, summary: str, messages: list) -> str:
+        """
+        Fold `messages` into the rolling `summary` of a conversation.
+
+        Args:
+            summary (str): Current summary of the older turns ('' if none yet).
+            messages (list): Turns to add to the summary, oldest first.
+
+        Returns:
+            str: The updated summary text.
+        """
+        summary_prompt = summary_instruction_template.format(summary or 'None', format_history(messages))
+        inputs = self.tokenizer([summary_prompt], return_tensors="pt").to(self.device)
+        outputs = self.model.generate(**inputs, max_new_tokens=self.summary_token_budget)
+        return self.tokenizer.decode(outputs[0][inputs['input_ids'].shape[1]:], skip_special_tokens=True).strip()
+
+    def generate_batch(self, requests: list) -> list:
+        """
+        Generate responses for several prompts in one padded batch.
+
+        Args:
+            requests (list): Dicts holding the keyword arguments of `run` (messages, prompt, summary).
+
+        Returns:
+            list: Parsed JSON responses (None where parsing failed), in request order.
+        """
+        suffix_ids = [self._suffix_ids(**request) for request in requests]
+        if not self.constrained_decoder:
+            return self._generate_unconstrained(suffix_ids)
+        # Constrained decoding walks each prompt's grammar separately; literals are still
+        # prefilled in one forward pass, so no decode steps are spent on key names.
+        results, truncated = [], []
+        for index, ids in enumerate(suffix_ids):
+            try:
+                results.append(self.constrained_decoder.decode(self.prefix_cache, ids))
+            except TruncatedResponseError as error:
+                logger.warning("%s Generating the response without constraints.", error)
+                results.append(None)
+                truncated.append(index)
+        if truncated:
+            generated = self._generate_unconstrained([suffix_ids[index] for index in truncated])
+            for index, result in zip(truncated, generated):
+                results[index] = result
+        return results
+
+    def _generate_unconstrained(self, suffix_ids: list) -> list:
+        """Generate free-form responses for several prompt suffixes in one padded batch."""
+        pad_token_id = self.tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = self.tokenizer.eos_token_id
+        inputs = self.prefix_cache.build_batch_inputs(suffix_ids, pad_token_id)
+        # Each row stops as soon as its JSON object closes instead of running to max_new_tokens,
+        # and the criteria parse the object from the token stream as it is generated.
+        stopping_criteria = BraceBalancedStoppingCriteria(self.tokenizer, batch_size=len(suffix_ids))
+        started = perf_counter()
+        self.model.generate(**inputs, max_new_tokens=128, pad_token_id=pad_token_id,
+                            stopping_criteria=[stopping_criteria])
+        self._observe_generation(suffix_ids, stopping_criteria, started)
+        results = stopping_criteria.results()
+        LLM_PARSE_FAILURES.inc(results.count(None))
+        return results
+
+    def stream(self, messages: list = None, prompt: str = '', summary: str = '') -> Iterator[str]:
+        """
+        Yield the response text piece by piece as the model generates it.
+
+        Streaming requests are generated on their own rather than through the batch
+        scheduler, since the streamer follows a single sequence. Generation still stops
+        as soon as the JSON object closes.
+
+        Args:
+            messages (list): History window, oldest first.
+            prompt (str): The nurse's message.
+            summary (str): Rolling summary of older turns.
+
+        Yields:
+            str: Decoded text chunks; together they form the raw response.
+        """
+        suffix_ids = self._suffix_ids(messages, prompt, summary)
+        if self.constrained_decoder:
+            # The constrained decoder builds the response node by node, so it is sent whole.
+            try:
+                response = self.constrained_decoder.decode(self.prefix_cache, suffix_ids)
+            except TruncatedResponseError as error:
+                logger.warning("%s Streaming the response without constraints.", error)
+            else:
+                yield json.dumps(response)
+                return
+        pad_token_id = self.tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = self.tokenizer.eos_token_id
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        stopping_criteria = BraceBalancedStoppingCriteria(self.tokenizer)
+        generate_kwargs = dict(self.prefix_cache.build_inputs(suffix_ids), max_new_tokens=128,
+                               pad_token_id=pad_token_id, streamer=streamer, stopping_criteria=[stopping_criteria])
+
+        def generate():
+            try:
+                self.model.generate(**generate_kwargs)
+            except Exception:
+                # Unblock the consumer; the truncated output then fails JSON validation.
+                streamer.end()
+                raise
+
+        generation = threading.Thread(target=generate, name="llm-stream", daemon=True)
+        started = perf_counter()
+        generation.start()
+        try:
+            yield from streamer
+        finally:
+            # Stops the model at its next step if the consumer closed the stream early.
+            stopping_criteria.cancelled = True
+            generation.join()
+        self._observe_generation([suffix_ids], stopping_criteria, started)
+
+    def run(self, messages: list = None, prompt: str = '', summary: str = ''):
+
+        request = {'messages': messages, 'prompt': prompt, 'summary': summary}
+        if self.scheduler:
+            # Concurrent callers are gathered into one batch by the scheduler thread.
+            return self.scheduler.run(request)
+        return self.generate_batch([request])[0]
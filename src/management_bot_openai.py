@@ -1,173 +1,176 @@
-from openai import OpenAI
+from openai import APIConnectionError, AsyncOpenAI, InternalServerError, OpenAI, RateLimitError
+import asyncio
+import httpx
 import json
+import logging
 import os
-import re
+from time import perf_counter
+from typing import AsyncIterator, Iterator, Optional
+
+from src import config
+from src.context_builder import format_history
+from src.llm_backend import LLM_PARSE_FAILURES, LLM_PROMPT_BUILD_SECONDS, LLMBackend, RequestPolicy, observe_generation
+from src.prompts import build_prompt, summary_instruction_template
+
+try:
+    import tiktoken
+except ImportError:  # token counts fall back to a character-based estimate
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
 
 OPENAI_KEY = os.getenv('OPENAI_API_KEY')
-client = OpenAI(
-    api_key= OPENAI_KEY
-)
-
-llm_instruction_template_1 = """# System Context
-You are a specialized medical assistant AI designed to help nurses manage patient information, medications, and appointments. You must process natural language commands and return structured JSON responses. Always maintain medical data privacy and accuracy in your responses.
-
-# Previous Thread History"""
-
-llm_instruction_template_2 = """# Task Definition
-You must parse natural language commands related to nursing tasks and return structured JSON output. You handle three main types of tasks:
-
-1. Adding new patients
-2. Assigning medications
-3. Scheduling follow-ups
-
-# Response Format Requirements
-- Always respond with valid JSON
-- Include "intent", "entities", and "message" in every response
-- Use consistent key names across responses
-- Return error messages in JSON format when information is missing
-- Include a human-readable confirmation message for each successful action
-
-# Supported Intents and Required Entities
-1. add_patient
-   - name (string)
-   - gender (string)
-   - age (number)
-   - condition (string)
-
-2. assign_medication
-   - patient_name (string)
-   - medication (string)
-   - dosage (string)
-   - frequency (string)
-
-3. schedule_followup
-   - patient_name (string)
-   - date (string)
-
-# Error Handling
-If any required entity is missing, respond with:
-{
-    "error": true,
-    "missing_entities": ["entity1", "entity2"],
-    "message": "Please provide the following information: [list missing items]"
-}
-
-# Examples
-Input: "Add a new patient John Doe, male, 45 years old, with diabetes."
-Expected Output:
-{
-    "intent": "add_patient",
-    "entities": {
-        "name": "John Doe",
-        "gender": "male",
-        "age": 45,
-        "condition": "diabetes"
-    },
-    "message": "Successfully added new patient John Doe to the system. Patient profile created with provided details."
-}
-
-Input: "Assign medication Paracetamol 500mg twice a day for John Doe."
-Expected Output:
-{
-    "intent": "assign_medication",
-    "entities": {
-        "patient_name": "John Doe",
-        "medication": "Paracetamol",
-        "dosage": "500mg",
-        "frequency": "twice a day"
-    },
-    "message": "Medication Paracetamol has been assigned to John Doe. Dosage: 500mg to be taken twice a day."
-}
-
-Input: "Schedule a follow-up for John Doe on December 20th."
-Expected Output:
-{
-    "intent": "schedule_followup",
-    "entities": {
-        "patient_name": "John Doe",
-        "date": "2024-12-20"
-    },
-    "message": "Follow-up appointment scheduled for John Doe on December 20th, 2024."
-}
-
-# Message Format Guidelines
-1. add_patient messages should:
-   - Confirm successful patient addition
-   - Acknowledge all provided details
-   - Use a professional, medical tone
-
-2. assign_medication messages should:
-   - Confirm medication assignment
-   - Repeat dosage and frequency for verification
-   - Include patient name for clarity
-
-3. schedule_followup messages should:
-   - Confirm appointment scheduling
-   - Include full date in a clear format
-   - Include patient name
-
-# Rules
-1. Never make assumptions about missing data
-2. Maintain consistent entity names across all responses
-3. Always validate that patient names match exactly
-4. Convert all dates to ISO format (YYYY-MM-DD)
-5. Preserve exact medication dosages as provided
-6. Return error messages for ambiguous commands
-7. Include clear, human-readable confirmation messages
-
-# Process Flow
-1. Identify the primary intent from the input
-2. Extract all relevant entities
-3. Validate completeness of required entities
-4. Generate appropriate confirmation message
-5. Format response in JSON with message
-6. Include error handling if needed
-
-Remember that you are processing nurse commands in a healthcare context. Maintain high accuracy and ask for clarification when needed."""
-
-formatted_instruction_prompt = """Below is an instruction that describes a task, paired with an input that provides further context. Write a response that appropriately completes the request.
-
-    ### Instruction:
-    {}
-
-    ### Input:
-    {}
-
-    ### Response:
-    {}"""
-
-
-class LLMRunner:
-    def __init__(self):
-        pass
-
-    def run(self, messages: list = [], prompt: str = ''):
-
-        if messages:
-            formatted_messages = []
-            for message in messages:
-                nurse_line = f"NURSE: {message['nurse']}"
-                bot_line = f"BOT: {message['bot']}"
-                formatted_messages.extend([nurse_line, bot_line])
-
-            full_context = '\n'.join(formatted_messages)
-        else:
-            full_context = ' '
-
-        instruction = llm_instruction_template_1 + \
-            full_context+llm_instruction_template_2
-        formatted_prompt = formatted_instruction_prompt.format(
-            str(instruction), str(prompt), "")
-
-        # Send a request to OpenAI's GPT model
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "user", "content": formatted_prompt}]
-        )
-        
-        json_response = self.__parse_json_from_response(
-            response.choices[0].message.content.strip())
-        return json_response
+# Transient API failures worth retrying; other errors (bad request, auth) fail at once.
+RETRYABLE_ERRORS = (APIConnectionError, RateLimitError, InternalServerError)
+
+
+class LLMRunner(LLMBackend):
+    history_token_budget = 4096
+    summary_token_budget = 512
+    is_async = True
+
+    def __init__(self, model: str = config.OPENAI_MODEL, max_concurrency: int = config.OPENAI_MAX_CONCURRENCY,
+                 timeout_seconds: float = config.OPENAI_TIMEOUT_SECONDS, max_retries: int = config.OPENAI_MAX_RETRIES,
+                 hedge_after_seconds: Optional[float] = config.OPENAI_HEDGE_AFTER_SECONDS):
+        """
+        Parameters:
+        model (str): Chat completion model.
+        max_concurrency (int): Requests in flight at once from this runner; also sizes the connection pool.
+        timeout_seconds (float): Time allowed for a single API attempt.
+        max_retries (int): Retries after a transient failure (connection error, timeout, 429, 5xx).
+        hedge_after_seconds (float, optional): Send a duplicate request when the first is slower than
+            this; no hedging if None.
+        """
+        self.model = model
+        self.encoding = tiktoken.encoding_for_model("gpt-4") if tiktoken else None
+        limits = httpx.Limits(max_connections=max_concurrency * 2, max_keepalive_connections=max_concurrency)
+        # One client per runner keeps connections alive between requests. The async client's
+        # own retries are disabled; the RequestPolicy retries with jitter and hedges instead.
+        self.client = OpenAI(api_key=OPENAI_KEY, timeout=timeout_seconds, max_retries=max_retries,
+                             http_client=httpx.Client(limits=limits))
+        self.async_client = AsyncOpenAI(api_key=OPENAI_KEY, timeout=timeout_seconds, max_retries=0,
+                                        http_client=httpx.AsyncClient(limits=limits))
+        self.policy = RequestPolicy(max_concurrency=max_concurrency, timeout_seconds=timeout_seconds,
+                                    max_retries=max_retries, hedge_after_seconds=hedge_after_seconds,
+                                    retry_on=RETRYABLE_ERRORS)
+
+    def count_tokens(self, text: str) -> int:
+        """Return the number of GPT-4 tokens in `text` (estimated if tiktoken is not installed)."""
+        if self.encoding is None:
+            return len(text) // 4 + 1
+        return len(self.encoding.encode(text))
+
+    def _summary_request(self, summary: str, messages: list) -> dict:
+        summary_prompt = summary_instruction_template.format(summary or 'None', format_history(messages))
+        return {"model": self.model, "messages": [{"role": "user", "content": summary_prompt}],
+                "max_tokens": self.summary_token_budget}
+
+    def _response_request(self, messages: list, prompt: str, summary: str) -> dict:
+        # Keeping the static instructions as a fixed prefix also lets OpenAI's prompt caching reuse them.
+        with LLM_PROMPT_BUILD_SECONDS.time():
+            formatted_prompt = ''.join(build_prompt(messages, prompt, summary))
+        return {"model": self.model, "messages": [{"role": "user", "content": formatted_prompt}]}
+
+    def _stream_request(self, messages: list, prompt: str, summary: str) -> dict:
+        # The last chunk then carries the token usage, with no choices.
+        return dict(self._response_request(messages, prompt, summary), stream=True,
+                    stream_options={"include_usage": True})
+
+    @staticmethod
+    def _observe_usage(usage, started: float, first_token_at: Optional[float] = None):
+        """Record the metrics of a response requested at `started`, from its token usage if reported."""
+        observe_generation([usage.prompt_tokens] if usage else [], [usage.completion_tokens] if usage else [],
+                           perf_counter() - started, first_token_at - started if first_token_at else None)
+
+    def summarize(self, summary: str, messages: list) -> str:
+        """
+        Fold `messages` into the rolling `summary` of a conversation.
+
+        Args:
+            summary (str): Current summary of the older turns ('' if none yet).
+            messages (list): Turns to add to the summary, oldest first.
+
+        Returns:
+            str: The updated summary text.
+        """
+        response = self.client.chat.completions.create(**self._summary_request(summary, messages))
+        return response.choices[0].message.content.strip()
+
+    async def asummarize(self, summary: str, messages: list) -> str:
+        """Async variant of `summarize`, sent under the request policy."""
+        response = await self.policy.call(
+            lambda: self.async_client.chat.completions.create(**self._summary_request(summary, messages)))
+        return response.choices[0].message.content.strip()
+
+    def run(self, messages: list = [], prompt: str = '', summary: str = ''):
+        request = self._response_request(messages, prompt, summary)
+        started = perf_counter()
+        response = self.client.chat.completions.create(**request)
+        self._observe_usage(response.usage, started)
+        return self.__parse_json_from_response(response.choices[0].message.content.strip())
+
+    async def arun(self, messages: list = [], prompt: str = '', summary: str = ''):
+        """
+        Async variant of `run` on the pooled client.
+
+        The request goes through the runner's RequestPolicy: bounded concurrency, a
+        per-attempt timeout, jittered retries on transient errors and, if configured, a
+        hedged duplicate when the first attempt is slow.
+        """
+        request = self._response_request(messages, prompt, summary)
+        started = perf_counter()
+        response = await self.policy.call(lambda: self.async_client.chat.completions.create(**request))
+        self._observe_usage(response.usage, started)
+        return self.__parse_json_from_response(response.choices[0].message.content.strip())
+
+    def stream(self, messages: list = [], prompt: str = '', summary: str = '') -> Iterator[str]:
+        """
+        Yield the response text piece by piece using OpenAI's streaming API.
+
+        Args:
+            messages (list): History window, oldest first.
+            prompt (str): The nurse's message.
+            summary (str): Rolling summary of older turns.
+
+        Yields:
+            str: Content deltas; together they form the raw response.
+        """
+        started = perf_counter()
+        response = self.client.chat.completions.create(**self._stream_request(messages, prompt, summary))
+        first_token_at = usage = None
+        for chunk in response:
+            if chunk.usage:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                if first_token_at is None:
+                    first_token_at = perf_counter()
+                yield chunk.choices[0].delta.content
+        self._observe_usage(usage, started, first_token_at)
+
+    async def astream(self, messages: list = [], prompt: str = '', summary: str = '') -> AsyncIterator[str]:
+        """Async variant of `stream`. Only opening the stream is retried; it is never hedged."""
+        async with self.policy.semaphore:
+            started = perf_counter()
+            response = await self._open_stream(messages, prompt, summary)
+            first_token_at = usage = None
+            async for chunk in response:
+                if chunk.usage:
+                    usage = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if first_token_at is None:
+                        first_token_at = perf_counter()
+                    yield chunk.choices[0].delta.content
+            self._observe_usage(usage, started, first_token_at)
+
+    async def _open_stream(self, messages: list, prompt: str, summary: str):
+        for retry in range(self.policy.max_retries + 1):
+            try:
+                return await self.async_client.chat.completions.create(
+                    **self._stream_request(messages, prompt, summary))
+            except RETRYABLE_ERRORS:
+                if retry == self.policy.max_retries:
+                    raise
+            await asyncio.sleep(self.policy.backoff(retry))
 
     def __parse_json_from_response(self, response_text):
         """
@@ -182,10 +185,12 @@ class LLMRunner:
         try:
             return json.loads(response_text)
         except json.JSONDecodeError as e:
-            print(f"Failed to parse JSON: {e}")
+            LLM_PARSE_FAILURES.inc()
+            logger.warning("Failed to parse JSON: %s", e)
             return None
-        except Exception as e:
-            print(f"Unexpected error: {e}")
+        except Exception:
+            LLM_PARSE_FAILURES.inc()
+            logger.exception("Unexpected error while parsing the model response")
             return None
         
 
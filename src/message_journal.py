@@ -0,0 +1,457 @@
+import asyncio
+import fcntl
+import glob
+import json
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+from src.crud_handler import EMBEDDED_STORAGE, message_push_update
+from src.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_PENDING = REGISTRY.gauge("message_journal_pending_entries", "Journaled turns not yet written to Mongo.")
+JOURNAL_FLUSHED = REGISTRY.counter("message_journal_flushed_total", "Journaled turns written to Mongo.")
+JOURNAL_REPLAYED = REGISTRY.counter("message_journal_replayed_total",
+                                    "Turns replayed from journals left behind by exited processes.")
+JOURNAL_APPEND_SECONDS = REGISTRY.histogram("message_journal_append_seconds",
+                                            "Time for a turn to reach the journal on disk, fsync included.")
+JOURNAL_FLUSH_SECONDS = REGISTRY.histogram("message_journal_flush_seconds", "Duration of group commits to Mongo.")
+JOURNAL_BACKPRESSURE = REGISTRY.counter("message_journal_backpressure_total",
+                                        "Turns that waited because max_pending_entries turns were not flushed yet.")
+
+
+def create_locked(path: str):
+    """Create `path` holding an exclusive lock on it from the moment it has that name."""
+    temporary = path + ".tmp"
+    while True:
+        file = open(temporary, 'ab')
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            os.rename(temporary, path)
+            return file
+        except FileNotFoundError:
+            # remove_abandoned deleted it between the open and the lock.
+            file.close()
+
+
+def remove_abandoned(directory: str):
+    """Delete temporary journal files left by processes that exited before renaming them.
+
+    Those files never held a turn; the ones still locked are being created.
+    """
+    for path in glob.glob(os.path.join(directory, "journal-*.log.tmp")):
+        try:
+            file = open(path, 'rb')
+        except FileNotFoundError:
+            continue
+        with file:
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+class MessageJournal:
+    """Append-only segment files of turns that have been acknowledged but may not be in Mongo yet.
+
+    Every process writes its own segments in `directory`, holding an exclusive lock on
+    each until it is deleted. Entries are JSON lines. Appends that arrive while a write
+    is in progress are written and fsync'd together with the next one, so under load
+    many turns share one fsync. `rotate` starts a new segment; a sealed segment is
+    deleted once `flushed` has been called for every entry in it. A journal file whose
+    lock can be taken belongs to a process that has exited; `recover` hands its entries
+    back for replay. Files are created and locked under a temporary name and only then
+    renamed to `journal-*.log`, so a recovering process never sees a live journal
+    before its owner holds the lock.
+    """
+
+    def __init__(self, directory: str, fsync: bool = True):
+        """
+        Parameters:
+        directory (str): Directory holding the journal files; created if needed.
+        fsync (bool): fsync after every write. Only disable for tests.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fsync = fsync
+        self.name = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._seq = 0
+        self._segment = 0
+        # Open segments of this process and, per segment, the entries written or being
+        # written to it that are not in Mongo yet.
+        self._files = {}
+        self._live: Dict[str, int] = {}
+        self.path = None
+        self._file = None
+        self._open_segment()
+        self._buffer: List[Tuple[bytes, asyncio.Future]] = []
+        self._writer: Optional[asyncio.Future] = None
+        # Recovered files of exited processes, kept locked until they are discarded.
+        self._recovered = {}
+
+    def _open_segment(self):
+        self._segment += 1
+        self.path = os.path.join(self.directory, f"journal-{self.name}-{self._segment:06d}.log")
+        self._file = self._files[self.path] = create_locked(self.path)
+        self._live[self.path] = 0
+
+    @property
+    def segments(self) -> int:
+        """Number of segment files this process currently holds."""
+        return len(self._files)
+
+    def next_id(self) -> str:
+        """Return a journal id that is unique across processes and restarts."""
+        self._seq += 1
+        return f"{self.name}:{self._seq}"
+
+    async def append(self, entry: Dict) -> str:
+        """Return once `entry` has been written to the journal and fsync'd.
+
+        Returns:
+            str: The segment holding the entry; pass it to `flushed` once the entry is in Mongo.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._buffer.append((json.dumps(entry).encode() + b"\n", future))
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.ensure_future(self._write_buffered())
+        return await asyncio.shield(future)
+
+    async def _write_buffered(self):
+        loop = asyncio.get_running_loop()
+        while self._buffer:
+            batch, self._buffer = self._buffer, []
+            path, file = self.path, self._file
+            # Counted before the write, so the segment cannot be deleted while it is in progress.
+            self._live[path] += len(batch)
+            try:
+                await loop.run_in_executor(None, self._write, file, b"".join(line for line, _ in batch))
+            except Exception as e:
+                self.flushed(path, len(batch))
+                for _, future in batch:
+                    future.set_exception(e)
+            else:
+                for _, future in batch:
+                    future.set_result(path)
+
+    def _write(self, file, data: bytes):
+        file.write(data)
+        file.flush()
+        if self.fsync:
+            os.fsync(file.fileno())
+
+    def rotate(self):
+        """Send later appends to a new segment, unless the current one is still empty."""
+        if self._live[self.path]:
+            self._open_segment()
+
+    def flushed(self, path: str, count: int = 1):
+        """Record that `count` entries of segment `path` are in Mongo or no longer needed.
+
+        A segment that is no longer written to is deleted once none of its entries is left.
+        """
+        self._live[path] -= count
+        if not self._live[path] and path != self.path:
+            os.unlink(path)
+            self._files.pop(path).close()
+            del self._live[path]
+
+    def recover(self) -> Iterator[Tuple[str, List[Dict]]]:
+        """Yield (path, entries) for each journal file left behind by an exited process.
+
+        The file stays locked by this process until `discard(path)` is called once the
+        entries are safely in Mongo. A torn last line, from a crash mid-write, is skipped:
+        that turn was never acknowledged.
+        """
+        remove_abandoned(self.directory)
+        for path in sorted(glob.glob(os.path.join(self.directory, "journal-*.log"))):
+            if path in self._files:
+                continue
+            file = open(path, 'rb')
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Still owned by a running process.
+                file.close()
+                continue
+            entries = []
+            for line in file:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    logger.warning("Skipping a torn entry in %s", path)
+            self._recovered[path] = file
+            yield path, entries
+
+    def discard(self, path: str):
+        """Delete a recovered journal file whose entries have been replayed."""
+        os.unlink(path)
+        self._recovered.pop(path).close()
+
+    def close(self, delete: bool = False):
+        """Release the journal; `delete` removes its segments, e.g. once every entry is in Mongo."""
+        for path, file in self._files.items():
+            if delete:
+                os.unlink(path)
+            file.close()
+        self._files.clear()
+
+
+def journal_update(entry: Dict) -> UpdateOne:
+    """Build the write that appends a journaled turn to its conversation.
+
+    The pair keeps its journal_id and the filter skips conversations that already hold
+    it, so replaying an entry that did reach Mongo is a no-op.
+    """
+    update = message_push_update(entry['nurse'], entry['bot'], entry.get('tokens'), entry.get('token_ids'))
+    update['$push']['messages']['journal_id'] = entry['journal_id']
+    return UpdateOne({'conversation_id': entry['conversation_id'], 'messages.journal_id': {'$ne': entry['journal_id']}},
+                     update)
+
+
+def merge_unflushed(messages: List[Dict], unflushed: List[Dict], history_limit: Optional[int] = None) -> List[Dict]:
+    """Append journaled turns missing from `messages`, then keep the last `history_limit` pairs."""
+    stored = {message.get('journal_id') for message in messages}
+    merged = messages + [
+        {key: entry[key] for key in ('nurse', 'bot', 'tokens', 'token_ids', 'journal_id') if entry.get(key) is not None}
+        for entry in unflushed if entry['journal_id'] not in stored
+    ]
+    if history_limit is not None:
+        merged = merged[-history_limit:] if history_limit > 0 else []
+    return merged
+
+
+class WriteBehindCrudHandler:
+    """Wraps an AsyncMessageCrudHandler so turns are acknowledged once journaled on local disk.
+
+    `add_message` appends the turn to the MessageJournal and returns; a background
+    flusher writes pending turns to Mongo with one ordered `bulk_write` once
+    `flush_max_entries` are pending or `flush_interval_seconds` have passed. Each flush
+    rotates the journal, so segments are deleted as their turns reach Mongo and the
+    files stay small under steady traffic. Once `max_pending_entries` turns are waiting,
+    e.g. while Mongo is unreachable, `add_message` waits for a flush before journaling
+    more. Reads through this handler see turns that are not in Mongo yet. On `start`,
+    journals left by processes that exited before flushing are replayed; replay is
+    idempotent.
+
+    Only embedded message storage is supported. Other workers read Mongo directly, so
+    they see a turn up to one flush interval late. Every other method is forwarded to
+    the wrapped handler.
+    """
+
+    def __init__(self, crud, journal: MessageJournal, flush_max_entries: int = 256,
+                 flush_interval_seconds: float = 0.05, known_conversations: int = 100000,
+                 max_pending_entries: int = 10000):
+        """
+        Parameters:
+        crud: The AsyncMessageCrudHandler that receives the flushed turns.
+        journal (MessageJournal): This process's journal.
+        flush_max_entries (int): Pending turns that trigger a flush without waiting for the interval.
+        flush_interval_seconds (float): Longest time a turn stays pending while the flusher is healthy.
+        known_conversations (int): Conversation ids remembered as existing, so most turns
+            skip the existence check.
+        max_pending_entries (int): Turns journaled but not flushed, in progress included,
+            beyond which new turns wait for a flush.
+
+        Raises:
+            ValueError: If the handler does not use embedded message storage.
+        """
+        if crud.message_storage != EMBEDDED_STORAGE:
+            raise ValueError("Write-behind journaling requires embedded message storage.")
+        self.crud = crud
+        self.journal = journal
+        self.flush_max_entries = flush_max_entries
+        self.flush_interval_seconds = flush_interval_seconds
+        self.known_conversations = known_conversations
+        self.max_pending_entries = max_pending_entries
+        self._pending: Dict[str, Dict] = OrderedDict()
+        # journal_id -> the journal segment holding the pending turn.
+        self._segments: Dict[str, str] = {}
+        self._by_conversation: Dict[str, List[Dict]] = {}
+        self._known = OrderedDict()
+        self._appending = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._drained: Optional[asyncio.Condition] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self._closing = False
+
+    def __getattr__(self, name):
+        return getattr(self.crud, name)
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def start(self):
+        """Replay journals left behind by exited processes, then start the background flusher."""
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._drained = asyncio.Condition()
+        for path, entries in self.journal.recover():
+            if entries:
+                await self.crud.conversations.bulk_write([journal_update(entry) for entry in entries], ordered=True)
+                JOURNAL_REPLAYED.inc(len(entries))
+                logger.info("Replayed %d journaled turns from %s", len(entries), path)
+            self.journal.discard(path)
+        self._flusher = asyncio.ensure_future(self._flush_forever())
+
+    def _remember(self, conversation_id: str):
+        self._known[conversation_id] = True
+        self._known.move_to_end(conversation_id)
+        if len(self._known) > self.known_conversations:
+            self._known.popitem(last=False)
+
+    async def conversation_exists(self, conversation_id: str) -> bool:
+        """Check whether a conversation exists; recently seen conversations are not read again."""
+        if conversation_id in self._known:
+            return True
+        if await self.crud.conversations.count_documents({'conversation_id': conversation_id}, limit=1):
+            self._remember(conversation_id)
+            return True
+        return False
+
+    async def add_message(self, conversation_id: str, nurse_message: str, bot_message: str,
+                          token_count: Optional[int] = None, token_ids: Optional[Dict] = None) -> bool:
+        """Journal a new message pair; it reaches Mongo with the next flush.
+
+        Returns:
+            bool: True once the pair is durable in the journal.
+
+        Raises:
+            ValueError: If the conversation_id does not exist in the database.
+        """
+        if not await self.conversation_exists(conversation_id):
+            raise ValueError(f"Conversation ID {conversation_id} not found.")
+        if len(self._pending) + self._appending >= self.max_pending_entries:
+            JOURNAL_BACKPRESSURE.inc()
+            self._wakeup.set()
+            async with self._drained:
+                await self._drained.wait_for(lambda: len(self._pending) + self._appending < self.max_pending_entries)
+        entry = {'journal_id': self.journal.next_id(), 'conversation_id': conversation_id,
+                 'nurse': nurse_message, 'bot': bot_message, 'tokens': token_count, 'token_ids': token_ids}
+        started = time.monotonic()
+        self._appending += 1
+        try:
+            segment = await self.journal.append(entry)
+        finally:
+            self._appending -= 1
+        JOURNAL_APPEND_SECONDS.observe(time.monotonic() - started)
+        self._pending[entry['journal_id']] = entry
+        self._segments[entry['journal_id']] = segment
+        self._by_conversation.setdefault(conversation_id, []).append(entry)
+        JOURNAL_PENDING.inc()
+        if len(self._pending) == 1 or len(self._pending) >= self.flush_max_entries:
+            self._wakeup.set()
+        return True
+
+    async def get_conversation(self, conversation_id: str, history_limit: Optional[int] = None) -> Optional[Dict]:
+        """Retrieve a conversation from Mongo with its not yet flushed turns appended."""
+        # Taken before the read: a turn flushed in between is then found in Mongo and not repeated.
+        unflushed = list(self._by_conversation.get(conversation_id, ()))
+        conversation = await self.crud.get_conversation(conversation_id, history_limit)
+        if conversation is None:
+            return None
+        self._remember(conversation_id)
+        if unflushed:
+            conversation['messages'] = merge_unflushed(conversation.get('messages', []), unflushed, history_limit)
+        return conversation
+
+    async def get_messages(self, conversation_id: str, history_limit: Optional[int] = None) -> List[Dict]:
+        """Get a conversation's messages, including turns not flushed to Mongo yet."""
+        conversation = await self.get_conversation(conversation_id, history_limit)
+        return conversation.get('messages', []) if conversation else []
+
+    async def delete_conversation(self, conversation_id: str) -> bool:
+        """Delete a conversation and drop its pending turns; see AsyncMessageCrudHandler.delete_conversation."""
+        self._known.pop(conversation_id, None)
+        for entry in self._by_conversation.pop(conversation_id, ()):
+            self._forget(entry)
+        await self._notify_drained()
+        return await self.crud.delete_conversation(conversation_id)
+
+    def _forget(self, entry: Dict) -> bool:
+        """Drop a turn from the pending ones and release its journal segment; False if it was not pending."""
+        if self._pending.pop(entry['journal_id'], None) is None:
+            return False
+        JOURNAL_PENDING.dec()
+        self.journal.flushed(self._segments.pop(entry['journal_id']))
+        return True
+
+    async def _notify_drained(self):
+        if self._drained is not None:
+            async with self._drained:
+                self._drained.notify_all()
+
+    async def _flush_forever(self):
+        while not self._closing:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            if len(self._pending) < self.flush_max_entries:
+                # Let more turns join the batch.
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.flush_interval_seconds)
+                except asyncio.TimeoutError:
+                    pass
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Flushing the message journal failed; retrying")
+                await asyncio.sleep(self.flush_interval_seconds)
+
+    async def flush(self):
+        """Write every pending turn to Mongo in one ordered bulk_write.
+
+        Raises:
+            PyMongoError: If the write fails; the turns stay pending and are retried.
+        """
+        async with self._flush_lock:
+            entries = list(self._pending.values())
+            if not entries:
+                return
+            # Later turns go to a new segment; the current one is deleted once its turns are in Mongo.
+            self.journal.rotate()
+            started = time.monotonic()
+            await self.crud.conversations.bulk_write([journal_update(entry) for entry in entries], ordered=True)
+            JOURNAL_FLUSH_SECONDS.observe(time.monotonic() - started)
+            for entry in entries:
+                if not self._forget(entry):
+                    continue
+                conversation_entries = self._by_conversation.get(entry['conversation_id'])
+                if conversation_entries:
+                    conversation_entries.remove(entry)
+                    if not conversation_entries:
+                        del self._by_conversation[entry['conversation_id']]
+            JOURNAL_FLUSHED.inc(len(entries))
+        await self._notify_drained()
+
+    async def close_connection(self):
+        """Flush every pending turn, release the journal and close the wrapped handler."""
+        if self._flusher is not None:
+            # Stopped through a flag, not cancel(): on Python 3.11 wait_for can swallow a
+            # cancellation that arrives together with a wakeup, leaving the flusher running.
+            self._closing = True
+            self._wakeup.set()
+            await self._flusher
+        flushed = True
+        if self._flush_lock is not None:
+            try:
+                await self.flush()
+            except Exception:
+                flushed = False
+                logger.exception("Could not flush the message journal on shutdown; it is replayed on the next start")
+        self.journal.close(delete=flushed and not self._pending)
+        await self.crud.close_connection()
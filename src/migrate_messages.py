@@ -0,0 +1,107 @@
+"""Migrate embedded conversation messages into the separate messages collection.
+
+Converts conversations stored with EMBEDDED_STORAGE (one growing messages array per
+document) to COLLECTION_STORAGE (one document per message pair keyed by
+(conversation_id, seq)). Conversations are streamed from a cursor and converted in
+batches, so memory use is bounded by the batch size rather than the database size.
+
+The migration is safe to re-run: already inserted pairs are skipped through the
+unique (conversation_id, seq) index, and a conversation is only converted if its
+messages array did not change while the batch was being copied.
+
+Usage:
+    python -m src.migrate_messages --connection-string mongodb://localhost:27017 --database medical_conversations
+"""
+import argparse
+from typing import Dict, List
+
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from src.crud_handler import MESSAGE_INDEXES, failed_duplicate_indexes, message_document, verify_indexes
+
+
+def migrate_conversations(db, batch_size: int = 100, dry_run: bool = False) -> Dict[str, int]:
+    """Move every embedded messages array into the messages collection.
+
+    Args:
+        db: pymongo Database holding the conversations and messages collections.
+        batch_size (int): Number of conversations converted per round of writes.
+        dry_run (bool): Count what would be migrated without writing anything.
+
+    Returns:
+        Dict[str, int]: Counts of migrated conversations, copied messages and
+        conversations skipped because they were modified during the migration.
+    """
+    if not dry_run:
+        for keys, options in MESSAGE_INDEXES:
+            db.messages.create_index(keys, **options)
+        verify_indexes(db.messages.index_information(), MESSAGE_INDEXES, 'messages')
+
+    stats = {'conversations': 0, 'messages': 0, 'skipped': 0}
+    cursor = db.conversations.find(
+        {'messages': {'$exists': True}}, {'conversation_id': 1, 'messages': 1}, batch_size=batch_size)
+    batch = []
+    for conversation in cursor:
+        batch.append(conversation)
+        if len(batch) >= batch_size:
+            _migrate_batch(db, batch, stats, dry_run)
+            batch = []
+    if batch:
+        _migrate_batch(db, batch, stats, dry_run)
+    return stats
+
+
+def _migrate_batch(db, batch: List[Dict], stats: Dict[str, int], dry_run: bool):
+    documents = [
+        # Stored token counts and ids move with the pair so migrated histories are not re-tokenized.
+        message_document(conversation['conversation_id'], seq, message.get('nurse'), message.get('bot'),
+                         message.get('tokens'), message.get('token_ids'))
+        for conversation in batch
+        for seq, message in enumerate(conversation['messages'])
+    ]
+    if dry_run:
+        stats['conversations'] += len(batch)
+        stats['messages'] += len(documents)
+        return
+
+    if documents:
+        try:
+            db.messages.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            # Pairs copied by an earlier, interrupted run are rejected by the unique index.
+            failed_duplicate_indexes(e)
+
+    # Only convert conversations whose array is unchanged since it was read, so a
+    # concurrent append is never lost; skipped conversations are picked up on re-run.
+    result = db.conversations.bulk_write([
+        UpdateOne(
+            {'_id': conversation['_id'], 'messages': {'$size': len(conversation['messages'])}},
+            {'$set': {'message_count': len(conversation['messages'])}, '$unset': {'messages': ''}}
+        )
+        for conversation in batch
+    ], ordered=False)
+    stats['conversations'] += result.modified_count
+    stats['skipped'] += len(batch) - result.modified_count
+    stats['messages'] += len(documents)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate embedded messages to the messages collection.")
+    parser.add_argument("--connection-string", default="mongodb://localhost:27017")
+    parser.add_argument("--database", default="medical_conversations")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    client = MongoClient(args.connection_string)
+    try:
+        stats = migrate_conversations(client[args.database], batch_size=args.batch_size, dry_run=args.dry_run)
+    finally:
+        client.close()
+    print(f"Migrated {stats['conversations']} conversations ({stats['messages']} messages), "
+          f"skipped {stats['skipped']} modified during migration.")
+
+
+if __name__ == "__main__":
+    main()
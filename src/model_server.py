@@ -0,0 +1,369 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
+from typing import AsyncIterator, Dict, Iterator, Optional
+
+from src import config
+from src.llm_backend import LLMBackend, create_llm_runner, iterate_in_executor
+
+logger = logging.getLogger(__name__)
+
+# Every message is a JSON object preceded by its length as a 4-byte big-endian integer.
+HEADER = struct.Struct(">I")
+MAX_FRAME_BYTES = 16 * 1024 * 1024
+
+
+class RemoteBackendError(RuntimeError):
+    """The model server failed to handle a request."""
+
+
+def encode_frame(message: dict) -> bytes:
+    payload = json.dumps(message).encode()
+    return HEADER.pack(len(payload)) + payload
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Optional[dict]:
+    """Read one message from `reader`, or return None once the peer has closed the connection."""
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError:
+        return None
+    (length,) = HEADER.unpack(header)
+    if length > MAX_FRAME_BYTES:
+        raise RemoteBackendError(f"Frame of {length} bytes exceeds the {MAX_FRAME_BYTES} byte limit.")
+    return json.loads(await reader.readexactly(length))
+
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("The model server closed the connection.")
+        data.extend(chunk)
+    return bytes(data)
+
+
+class ModelServer:
+    """Serves one LLMBackend to API worker processes over a Unix socket.
+
+    The model is loaded once, in this process; any number of uvicorn workers connect
+    with RemoteLLMBackend. Each connection can carry many concurrent requests, tagged
+    with ids, so requests from all workers reach the backend together and the local
+    runner's BatchScheduler can batch them. Synchronous backends run on a thread pool
+    that should be at least as large as the runner's batch size.
+
+    Requests are {"id", "method", "params"} with method one of info, count_tokens,
+    encode_message, run, stream and summarize. Replies are {"id", "result"} or {"id", "error"}; streams send
+    {"id", "chunk"} frames followed by {"id", "done": true}. {"id", "method": "cancel"} stops
+    the request with that id, e.g. a stream the client stopped reading; it gets no reply.
+    """
+
+    def __init__(self, backend: LLMBackend, socket_path: str = config.MODEL_SERVER_SOCKET, workers: int = 32):
+        """
+        Parameters:
+        backend (LLMBackend): The runner that serves the requests.
+        socket_path (str): Filesystem path of the Unix socket to listen on.
+        workers (int): Threads for the blocking calls of synchronous backends.
+        """
+        self.backend = backend
+        self.socket_path = socket_path
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="model-server")
+        self._server = None
+
+    async def start(self):
+        """Start listening; a stale socket file left by a previous run is replaced.
+
+        Raises:
+            RuntimeError: If another server still answers on the socket path.
+        """
+        if os.path.exists(self.socket_path):
+            try:
+                _, writer = await asyncio.open_unix_connection(self.socket_path)
+            except OSError:
+                os.unlink(self.socket_path)
+            else:
+                writer.close()
+                raise RuntimeError(f"Another model server is listening on {self.socket_path}.")
+        self._server = await asyncio.start_unix_server(self._serve_connection, path=self.socket_path)
+
+    async def serve_forever(self):
+        await self.start()
+        logger.info("Model server listening on %s", self.socket_path)
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            # Only a server that started owns the socket file.
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+        self.executor.shutdown(wait=False)
+
+    async def _serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        tasks: Dict[int, asyncio.Task] = {}
+        try:
+            while True:
+                request = await read_frame(reader)
+                if request is None:
+                    break
+                request_id = request.get("id")
+                if request.get("method") == "cancel":
+                    if request_id in tasks:
+                        tasks[request_id].cancel()
+                    continue
+                task = asyncio.ensure_future(self._serve_request(request, writer))
+                tasks[request_id] = task
+                task.add_done_callback(lambda done, request_id=request_id: tasks.pop(request_id, None))
+        except (ConnectionError, RemoteBackendError, ValueError) as e:
+            logger.warning("Dropping model server connection: %s", e)
+        finally:
+            for task in list(tasks.values()):
+                task.cancel()
+            writer.close()
+
+    async def _serve_request(self, request: dict, writer: asyncio.StreamWriter):
+        request_id = request.get("id")
+        try:
+            if request.get("method") == "stream":
+                # Closed explicitly so a cancelled stream stops generating right away.
+                async with aclosing(self._stream(**request.get("params", {}))) as chunks:
+                    async for chunk in chunks:
+                        writer.write(encode_frame({"id": request_id, "chunk": chunk}))
+                        await writer.drain()
+                reply = {"id": request_id, "done": True}
+            else:
+                reply = {"id": request_id, "result": await self._call(request.get("method"), request.get("params", {}))}
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("Model server request failed")
+            reply = {"id": request_id, "error": f"{type(e).__name__}: {e}"}
+        writer.write(encode_frame(reply))
+        await writer.drain()
+
+    async def _call(self, method: str, params: dict):
+        backend = self.backend
+        if method == "info":
+            return {"history_token_budget": backend.history_token_budget,
+                    "summary_token_budget": backend.summary_token_budget}
+        if method not in ("count_tokens", "encode_message", "run", "summarize"):
+            raise ValueError(f"Unknown method {method}.")
+        # Tokenizers are synchronous even in async backends, and a long history takes a
+        # while to tokenize, so token calls also go to the pool instead of the event loop.
+        if backend.is_async and method in ("run", "summarize"):
+            return await getattr(backend, "a" + method)(**params)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: getattr(backend, method)(**params))
+
+    def _stream(self, **params) -> AsyncIterator[str]:
+        if self.backend.is_async:
+            return self.backend.astream(**params)
+        return iterate_in_executor(self.executor, self.backend.stream, **params)
+
+
+class RemoteLLMBackend(LLMBackend):
+    """LLMBackend that forwards every call to a ModelServer over its Unix socket.
+
+    Async calls, token counting and encoding for the async handler included, share one
+    multiplexed connection per process; synchronous calls (the synchronous handler) use a
+    separate blocking connection. The token budgets are read from the server when the
+    backend is created.
+    """
+
+    is_async = True
+
+    def __init__(self, socket_path: str = config.MODEL_SERVER_SOCKET,
+                 connect_timeout_seconds: float = config.MODEL_SERVER_CONNECT_TIMEOUT_SECONDS):
+        """
+        Parameters:
+        socket_path (str): Filesystem path of the model server's Unix socket.
+        connect_timeout_seconds (float): How long to wait for the server to come up, e.g. while it loads the model.
+
+        Raises:
+            ConnectionError: If the server is not reachable within the timeout.
+        """
+        self.socket_path = socket_path
+        self._sock = self._connect_blocking(connect_timeout_seconds)
+        self._sock_lock = threading.Lock()
+        self._ids = itertools.count()
+        self._replies: Dict[int, asyncio.Queue] = {}
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._connect_lock: Optional[asyncio.Lock] = None
+        info = self._call_blocking("info", {})
+        self.history_token_budget = info["history_token_budget"]
+        self.summary_token_budget = info["summary_token_budget"]
+
+    def _connect_blocking(self, timeout_seconds: float) -> socket.socket:
+        deadline = time.monotonic() + timeout_seconds
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.socket_path)
+                return sock
+            except (FileNotFoundError, ConnectionRefusedError) as e:
+                sock.close()
+                if time.monotonic() >= deadline:
+                    raise ConnectionError(f"Model server at {self.socket_path} is not reachable.") from e
+                time.sleep(0.5)
+
+    # Blocking connection
+
+    def _blocking_frames(self, method: str, params: dict) -> Iterator[dict]:
+        with self._sock_lock:
+            request_id = next(self._ids)
+            self._sock.sendall(encode_frame({"id": request_id, "method": method, "params": params}))
+            finished = False
+            try:
+                while True:
+                    (length,) = HEADER.unpack(_recv_exactly(self._sock, HEADER.size))
+                    reply = json.loads(_recv_exactly(self._sock, length))
+                    if reply.get("id") != request_id:
+                        # Left over from a stream whose consumer stopped reading early.
+                        continue
+                    if "error" in reply:
+                        finished = True
+                        raise RemoteBackendError(reply["error"])
+                    finished = "chunk" not in reply
+                    yield reply
+                    if finished:
+                        return
+            finally:
+                if not finished:
+                    self._sock.sendall(encode_frame({"id": request_id, "method": "cancel"}))
+
+    def _call_blocking(self, method: str, params: dict):
+        for reply in self._blocking_frames(method, params):
+            return reply["result"]
+
+    def count_tokens(self, text: str) -> int:
+        return self._call_blocking("count_tokens", {"text": text})
+
+    def encode_message(self, nurse_message: str, bot_message: str) -> Optional[dict]:
+        return self._call_blocking("encode_message", {"nurse_message": nurse_message, "bot_message": bot_message})
+
+    def run(self, messages: list = None, prompt: str = '', summary: str = '') -> Optional[dict]:
+        return self._call_blocking("run", {"messages": messages or [], "prompt": prompt, "summary": summary})
+
+    def stream(self, messages: list = None, prompt: str = '', summary: str = '') -> Iterator[str]:
+        params = {"messages": messages or [], "prompt": prompt, "summary": summary}
+        for reply in self._blocking_frames("stream", params):
+            if "chunk" in reply:
+                yield reply["chunk"]
+
+    def summarize(self, summary: str, messages: list) -> str:
+        return self._call_blocking("summarize", {"summary": summary, "messages": messages})
+
+    # Multiplexed async connection
+
+    async def _ensure_connected(self):
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._writer is None:
+                reader, self._writer = await asyncio.open_unix_connection(self.socket_path)
+                self._reader_task = asyncio.ensure_future(self._read_replies(reader))
+
+    async def _read_replies(self, reader: asyncio.StreamReader):
+        error = ConnectionError("The model server closed the connection.")
+        try:
+            while True:
+                reply = await read_frame(reader)
+                if reply is None:
+                    break
+                queue = self._replies.get(reply.get("id"))
+                if queue is not None:
+                    queue.put_nowait(reply)
+        except (ConnectionError, RemoteBackendError, ValueError) as e:
+            error = e
+        finally:
+            # Fail everything still waiting; the next request reconnects.
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            for queue in self._replies.values():
+                queue.put_nowait({"error": str(error)})
+
+    async def _request(self, method: str, params: dict) -> AsyncIterator[dict]:
+        await self._ensure_connected()
+        request_id = next(self._ids)
+        queue = self._replies[request_id] = asyncio.Queue()
+        finished = False
+        try:
+            self._writer.write(encode_frame({"id": request_id, "method": method, "params": params}))
+            await self._writer.drain()
+            while True:
+                reply = await queue.get()
+                if "error" in reply:
+                    finished = True
+                    raise RemoteBackendError(reply["error"])
+                finished = "chunk" not in reply
+                yield reply
+                if finished:
+                    return
+        finally:
+            del self._replies[request_id]
+            if not finished and self._writer is not None:
+                # The caller stopped early or was cancelled: let the server stop generating.
+                self._writer.write(encode_frame({"id": request_id, "method": "cancel"}))
+
+    async def _call(self, method: str, params: dict):
+        async with aclosing(self._request(method, params)) as replies:
+            async for reply in replies:
+                return reply["result"]
+
+    async def arun(self, messages: list = None, prompt: str = '', summary: str = '') -> Optional[dict]:
+        return await self._call("run", {"messages": messages or [], "prompt": prompt, "summary": summary})
+
+    async def astream(self, messages: list = None, prompt: str = '', summary: str = '') -> AsyncIterator[str]:
+        params = {"messages": messages or [], "prompt": prompt, "summary": summary}
+        async with aclosing(self._request("stream", params)) as replies:
+            async for reply in replies:
+                if "chunk" in reply:
+                    yield reply["chunk"]
+
+    async def asummarize(self, summary: str, messages: list) -> str:
+        return await self._call("summarize", {"summary": summary, "messages": messages})
+
+    async def acount_tokens(self, text: str) -> int:
+        return await self._call("count_tokens", {"text": text})
+
+    async def aencode_message(self, nurse_message: str, bot_message: str) -> Optional[dict]:
+        return await self._call("encode_message", {"nurse_message": nurse_message, "bot_message": bot_message})
+
+    async def aclose(self):
+        """Close both connections to the server."""
+        if self._writer is not None:
+            self._writer.close()
+        if self._reader_task is not None:
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+        self._sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the LLM to API workers over a Unix socket.")
+    parser.add_argument("--socket", default=config.MODEL_SERVER_SOCKET, help="Unix socket path to listen on.")
+    parser.add_argument("--backend", default=config.MODEL_SERVER_BACKEND, choices=config.SERVABLE_BACKENDS,
+                        help="Backend loaded by the server.")
+    parser.add_argument("--workers", type=int, default=32, help="Threads for blocking model calls.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = ModelServer(create_llm_runner(args.backend), socket_path=args.socket, workers=args.workers)
+    asyncio.run(server.serve_forever())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import torch
+from typing import List
+
+
+class PrefixKVCache:
+    """Attention KV cache for a fixed prompt prefix, computed once and shared by every request.
+
+    The prefix is prefilled a single time at startup. Each request then passes the
+    cached keys/values to `model.generate` along with the full input ids; generate
+    skips the positions already covered by the cache, so only the per-request suffix
+    (history and nurse input) is prefilled.
+
+    The cache is kept in the legacy tuple format. Generation concatenates new
+    keys/values into fresh tensors instead of writing into these, so one cache can be
+    shared by concurrent and batched requests without copying.
+    """
+
+    def __init__(self, model, prefix_ids: torch.Tensor):
+        """
+        Parameters:
+        model: A causal LM supporting `past_key_values` (e.g. a Llama model).
+        prefix_ids (torch.Tensor): Token ids of the static prefix, shape (1, prefix_length),
+            already on the model's device.
+        """
+        self.prefix_ids = prefix_ids
+        with torch.no_grad():
+            past_key_values = model(input_ids=prefix_ids, use_cache=True).past_key_values
+        if hasattr(past_key_values, "to_legacy_cache"):
+            past_key_values = past_key_values.to_legacy_cache()
+        self.past_key_values = past_key_values
+
+    @property
+    def length(self) -> int:
+        return self.prefix_ids.shape[1]
+
+    def expand(self, batch_size: int):
+        """Return the cached keys/values broadcast to `batch_size` rows (a view, not a copy)."""
+        if batch_size == 1:
+            return self.past_key_values
+        return tuple(
+            tuple(tensor.expand(batch_size, *tensor.shape[1:]) for tensor in layer)
+            for layer in self.past_key_values
+        )
+
+    def build_inputs(self, suffix_ids: torch.Tensor) -> dict:
+        """Build `model.generate` keyword arguments for a prompt made of the prefix plus `suffix_ids`.
+
+        Args:
+            suffix_ids (torch.Tensor): Token ids following the prefix, shape (1, suffix_length), non-empty.
+
+        Returns:
+            dict: input_ids, attention_mask and past_key_values for generate.
+        """
+        input_ids = torch.cat([self.prefix_ids, suffix_ids.to(self.prefix_ids.device)], dim=1)
+        return {
+            "input_ids": input_ids,
+            "attention_mask": torch.ones_like(input_ids),
+            "past_key_values": self.past_key_values,
+        }
+
+    def build_batch_inputs(self, suffix_ids: List[torch.Tensor], pad_token_id: int) -> dict:
+        """Build `model.generate` keyword arguments for a batch of prompts sharing the prefix.
+
+        Rows are padded between the prefix and their suffix, with the padding masked out.
+        Position ids follow the attention mask, so every suffix continues right after the
+        prefix positions the cache was computed with and each row generates exactly as it
+        would on its own.
+
+        Args:
+            suffix_ids (List[torch.Tensor]): Non-empty token ids following the prefix, one tensor per prompt.
+            pad_token_id (int): Token id used for padding.
+
+        Returns:
+            dict: input_ids, attention_mask and past_key_values for generate.
+        """
+        device = self.prefix_ids.device
+        prefix = self.prefix_ids[0]
+        longest = max(ids.shape[-1] for ids in suffix_ids)
+        rows, masks = [], []
+        for ids in suffix_ids:
+            ids = ids.reshape(-1).to(device)
+            padding = longest - ids.shape[0]
+            rows.append(torch.cat([prefix, ids.new_full((padding,), pad_token_id), ids]))
+            masks.append(torch.cat([torch.ones_like(prefix), torch.zeros(padding, dtype=prefix.dtype, device=device),
+                                    torch.ones_like(ids)]))
+        return {
+            "input_ids": torch.stack(rows),
+            "attention_mask": torch.stack(masks),
+            "past_key_values": self.expand(len(rows)),
+        }
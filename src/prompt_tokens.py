@@ -0,0 +1,98 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List
+
+from src.context_builder import format_message_pair
+from src.metrics import REGISTRY
+from src.prompts import dynamic_prompt_template, format_summary
+
+PAIR_CACHE_HITS = REGISTRY.counter("prompt_token_cache_hits_total",
+                                   "Message pairs whose prompt token ids were reused instead of re-encoded.")
+PAIR_CACHE_MISSES = REGISTRY.counter("prompt_token_cache_misses_total", "Message pairs encoded for the prompt.")
+
+# Static text around the history and the input, e.g. "# Previous Thread History\n".
+HISTORY_HEADER, INPUT_HEADER, RESPONSE_HEADER = dynamic_prompt_template.split('{}')
+
+
+class PromptTokenCache:
+    """Assembles the dynamic part of the prompt from token ids instead of re-encoding text.
+
+    The static template segments are encoded once. Each stored message pair is encoded
+    at most once: its ids are read from the message ('token_ids', written when the pair
+    was stored) or kept in a bounded in-memory LRU cache. A turn then only encodes the
+    new user input and concatenates ids, so its cost no longer grows with the history.
+
+    The ids decode to exactly the text of `build_prompt(...)[1]`, but are encoded in
+    pieces, so a token may be split differently at a segment boundary than if the whole
+    string were encoded at once, just as at the static prefix / suffix boundary.
+    """
+
+    def __init__(self, encode: Callable[[str], List[int]], tokenizer_id: str = '', cache_size: int = 10000):
+        """
+        Parameters:
+        encode (Callable[[str], List[int]]): Encodes text to token ids, without special tokens.
+        tokenizer_id (str): Names the tokenizer; stored ids from any other tokenizer are ignored.
+        cache_size (int): Maximum number of message pairs (and summaries) whose ids are cached.
+        """
+        self.encode = encode
+        self.tokenizer_id = tokenizer_id
+        self.cache_size = cache_size
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+        self.history_header_ids = encode(HISTORY_HEADER)
+        self.separator_ids = encode('\n')
+        self.input_header_ids = encode(INPUT_HEADER)
+        self.response_header_ids = encode(RESPONSE_HEADER)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _cached(self, key, text: str) -> List[int]:
+        with self._lock:
+            ids = self._ids.get(key)
+            if ids is not None:
+                self._ids.move_to_end(key)
+                PAIR_CACHE_HITS.inc()
+                return ids
+        PAIR_CACHE_MISSES.inc()
+        ids = self.encode(text)
+        with self._lock:
+            self._ids[key] = ids
+            while len(self._ids) > self.cache_size:
+                self._ids.popitem(last=False)
+        return ids
+
+    def pair_ids(self, message: Dict) -> List[int]:
+        """Return the token ids of a stored message pair, encoding it only on a cache miss."""
+        stored = message.get('token_ids')
+        if stored and stored.get('tokenizer') == self.tokenizer_id:
+            return stored['ids']
+        return self._cached(('pair', message['nurse'], message['bot']), format_message_pair(message))
+
+    def stored_ids(self, nurse_message: str, bot_message: str) -> Dict:
+        """Return the 'token_ids' value to store with a new pair, e.g. in the database."""
+        message = {'nurse': nurse_message, 'bot': bot_message}
+        return {'tokenizer': self.tokenizer_id, 'ids': self.pair_ids(message)}
+
+    def suffix_ids(self, messages: list, prompt: str, summary: str = '') -> List[int]:
+        """Return the token ids of the dynamic prompt suffix for a turn.
+
+        Args:
+            messages (list): History window, oldest first.
+            prompt (str): The nurse's new input; the only text encoded on every call.
+            summary (str): Rolling summary of older turns, if any.
+
+        Returns:
+            List[int]: Ids decoding to `build_prompt(messages, prompt, summary)[1]`.
+        """
+        ids = list(self.history_header_ids)
+        if summary:
+            ids.extend(self._cached(('summary', summary), format_summary(summary)))
+        for i, message in enumerate(messages or []):
+            if i:
+                ids.extend(self.separator_ids)
+            ids.extend(self.pair_ids(message))
+        ids.extend(self.input_header_ids)
+        ids.extend(self.encode(prompt))
+        ids.extend(self.response_header_ids)
+        return ids
@@ -0,0 +1,220 @@
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import aclosing
+from typing import AsyncIterator, Callable, Iterator, Optional
+
+from src.json_stream import parse_json_object
+from src.metrics import REGISTRY
+
+CACHE_HITS = REGISTRY.counter("response_cache_hits_total", "Bot responses served from the response cache.")
+CACHE_MISSES = REGISTRY.counter("response_cache_misses_total", "Bot responses that had to be generated.")
+CACHE_EVICTIONS = REGISTRY.counter("response_cache_evictions_total",
+                                   "Response cache entries dropped because the cache was full.")
+
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_input(user_input: str) -> str:
+    """Collapse whitespace and drop trailing periods so trivially different repeats share a key.
+
+    Case is kept: the response echoes names and medications as the nurse typed them.
+    """
+    return WHITESPACE.sub(' ', user_input).strip().rstrip('.').rstrip()
+
+
+def cache_key(user_input: str, messages: list = None, summary: str = '') -> str:
+    """Return the cache key for a prompt: the normalized input plus a hash of the context it is built from.
+
+    Args:
+        user_input (str): The nurse's message.
+        messages (list): History window passed to the runner; only the nurse/bot text is hashed.
+        summary (str): Rolling summary of older turns, if any.
+
+    Returns:
+        str: A SHA-256 hex digest. The input itself is hashed too, so keys never contain PHI.
+    """
+    context = json.dumps([[normalize_input(user_input), summary or ''],
+                          [[message.get('nurse', ''), message.get('bot', '')] for message in messages or []]])
+    return hashlib.sha256(context.encode()).hexdigest()
+
+
+class InMemoryCacheBackend:
+    """Process-local LRU cache with a per-entry time to live. Nothing is written to disk."""
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 300,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        Parameters:
+        max_entries (int): Entries kept before the least recently used one is evicted.
+        ttl_seconds (float): How long an entry stays valid after it is stored.
+        clock (Callable[[], float]): Time source, in seconds.
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= self.clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: dict):
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                CACHE_EVICTIONS.inc()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCacheBackend:
+    """Cache shared by all API workers, stored in Redis with a TTL per entry.
+
+    Redis handles eviction itself (configure `maxmemory` with an LRU policy), so
+    evictions are not counted here. Entries only reach disk if the Redis server has
+    RDB/AOF persistence enabled; keep it disabled for this cache to avoid storing
+    patient data.
+    """
+
+    def __init__(self, url: str = "redis://localhost:6379/0", ttl_seconds: float = 300,
+                 key_prefix: str = "response-cache:", client=None):
+        """
+        Parameters:
+        url (str): Redis connection URL, used when `client` is not given.
+        ttl_seconds (float): How long an entry stays valid after it is stored.
+        key_prefix (str): Prefix for the keys written by this cache.
+        client: An existing redis.Redis client.
+        """
+        if client is None:
+            try:
+                import redis
+            except ImportError as e:
+                raise ImportError("RedisCacheBackend requires the 'redis' package: pip install redis") from e
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+        self.key_prefix = key_prefix
+
+    def get(self, key: str) -> Optional[dict]:
+        value = self.client.get(self.key_prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key: str, value: dict):
+        self.client.set(self.key_prefix + key, json.dumps(value), px=int(self.ttl_seconds * 1000))
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.key_prefix + "*"):
+            self.client.delete(key)
+
+
+class CachedLLMRunner:
+    """Wraps an LLMRunner so repeated prompts in the same context are answered from a cache.
+
+    Only valid responses are cached; a None result is retried on the next call. Every
+    other attribute (count_tokens, summarize, the token budgets) is forwarded to the
+    wrapped runner, so this can be used anywhere an LLMRunner is.
+    """
+
+    def __init__(self, runner, backend=None):
+        """
+        Parameters:
+        runner: Either LLMRunner (local model or OpenAI).
+        backend: InMemoryCacheBackend (default) or RedisCacheBackend.
+        """
+        self.runner = runner
+        self.backend = backend if backend is not None else InMemoryCacheBackend()
+
+    def __getattr__(self, name):
+        return getattr(self.runner, name)
+
+    def run(self, messages: list = None, prompt: str = '', summary: str = ''):
+        key = cache_key(prompt, messages, summary)
+        cached = self.backend.get(key)
+        if cached is not None:
+            CACHE_HITS.inc()
+            # Callers may modify the response, so never hand out the stored object itself.
+            return json.loads(json.dumps(cached))
+        CACHE_MISSES.inc()
+        response = self.runner.run(messages=messages or [], prompt=prompt, summary=summary)
+        if response is not None:
+            self.backend.set(key, json.loads(json.dumps(response)))
+        return response
+
+    async def arun(self, messages: list = None, prompt: str = '', summary: str = ''):
+        """Async counterpart of `run` for backends with native coroutine methods."""
+        key = cache_key(prompt, messages, summary)
+        cached = self.backend.get(key)
+        if cached is not None:
+            CACHE_HITS.inc()
+            return json.loads(json.dumps(cached))
+        CACHE_MISSES.inc()
+        response = await self.runner.arun(messages=messages or [], prompt=prompt, summary=summary)
+        if response is not None:
+            self.backend.set(key, json.loads(json.dumps(response)))
+        return response
+
+    def stream(self, messages: list = None, prompt: str = '', summary: str = '') -> Iterator[str]:
+        """Streaming counterpart of `run`: a hit is sent as a single chunk, a miss is streamed and then cached."""
+        key = cache_key(prompt, messages, summary)
+        cached = self.backend.get(key)
+        if cached is not None:
+            CACHE_HITS.inc()
+            yield json.dumps(cached)
+            return
+        CACHE_MISSES.inc()
+        chunks = []
+        for chunk in self.runner.stream(messages=messages or [], prompt=prompt, summary=summary):
+            chunks.append(chunk)
+            yield chunk
+        response = parse_json_object(''.join(chunks))
+        if response is not None:
+            self.backend.set(key, response)
+
+    async def astream(self, messages: list = None, prompt: str = '', summary: str = '') -> AsyncIterator[str]:
+        """Async counterpart of `stream`."""
+        key = cache_key(prompt, messages, summary)
+        cached = self.backend.get(key)
+        if cached is not None:
+            CACHE_HITS.inc()
+            yield json.dumps(cached)
+            return
+        CACHE_MISSES.inc()
+        chunks = []
+        async with aclosing(self.runner.astream(messages=messages or [], prompt=prompt, summary=summary)) as stream:
+            async for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+        response = parse_json_object(''.join(chunks))
+        if response is not None:
+            self.backend.set(key, response)
+
+    @staticmethod
+    def stats() -> dict:
+        """Hit, miss and eviction counts across all cached runners in this process."""
+        lookups = CACHE_HITS.value + CACHE_MISSES.value
+        return {
+            "hits": CACHE_HITS.value,
+            "misses": CACHE_MISSES.value,
+            "evictions": CACHE_EVICTIONS.value,
+            "hit_rate": CACHE_HITS.value / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,58 @@
+from time import perf_counter
+from typing import List, Optional
+
+import torch
+from transformers import StoppingCriteria
+
+from src.json_stream import JsonObjectExtractor
+
+
+class BraceBalancedStoppingCriteria(StoppingCriteria):
+    """Stops each generated sequence as soon as its top-level JSON object closes.
+
+    Every generation step decodes each row's generated tokens and feeds the new text to
+    that row's JsonObjectExtractor, so the parsed responses are available from
+    `extractors` once generation ends. Tokens are decoded together rather than one by
+    one, like transformers' TextStreamer does: with byte-level BPE a character can span
+    several tokens, and text ending in an incomplete character (U+FFFD) is held back
+    until the rest of it arrives. The tokens each row generated before stopping and the
+    time the first token arrived are kept for the generation metrics. Setting `cancelled`
+    stops every row at the next step, e.g. when a streamed response was abandoned.
+    """
+
+    def __init__(self, tokenizer, batch_size: int = 1):
+        self.tokenizer = tokenizer
+        self.extractors: List[JsonObjectExtractor] = [JsonObjectExtractor() for _ in range(batch_size)]
+        self.generated = [0] * batch_size
+        self._token_ids: List[List[int]] = [[] for _ in range(batch_size)]
+        self._decoded_length = [0] * batch_size
+        # perf_counter() time of the first generation step, i.e. once the prompt has been prefilled.
+        self.first_token_at: Optional[float] = None
+        self.cancelled = False
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if self.first_token_at is None:
+            self.first_token_at = perf_counter()
+        if self.cancelled:
+            return torch.ones(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        done = []
+        for row, (extractor, token_id) in enumerate(zip(self.extractors, input_ids[:, -1].tolist())):
+            if not extractor.complete:
+                self.generated[row] += 1
+                extractor.feed(self._new_text(row, token_id))
+            done.append(extractor.complete)
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+    def _new_text(self, row: int, token_id: int) -> str:
+        """Add a generated token to `row` and return the text it completes, '' if a character is still partial."""
+        self._token_ids[row].append(token_id)
+        text = self.tokenizer.decode(self._token_ids[row], skip_special_tokens=True)
+        if text.endswith('\ufffd'):
+            return ''
+        new_text = text[self._decoded_length[row]:]
+        self._decoded_length[row] = len(text)
+        return new_text
+
+    def results(self) -> List[Optional[dict]]:
+        """Return the parsed JSON response of each row (None where it is missing or invalid)."""
+        return [extractor.parse() for extractor in self.extractors]
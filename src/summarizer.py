@@ -0,0 +1,85 @@
+import logging
+from typing import Awaitable, Callable, Dict, List
+
+from src.context_builder import ContextBuilder
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationSummarizer:
+    """Compacts turns that no longer fit the history window into a rolling summary.
+
+    The summary is stored on the conversation record as
+    {'text', 'version', 'covered', 'tokens', 'updated_at'}, where `covered` is the number
+    of oldest message pairs it accounts for. Each run folds only the turns between
+    `covered` and the start of the current history window into the previous summary,
+    so summaries are updated incrementally and never recomputed from scratch. Updates
+    are conditional on the version they were computed from, so concurrent runs are safe.
+
+    Summarization is meant to run after the response has been returned (e.g. as a
+    FastAPI background task), so it never adds to request latency.
+    """
+
+    def __init__(self, crud, context_builder: ContextBuilder,
+                 summarize: Callable[[str, List[Dict]], Awaitable[str]], min_batch: int = 4, max_batch: int = 20):
+        """
+        Parameters:
+        crud (AsyncMessageCrudHandler): Conversation storage.
+        context_builder (ContextBuilder): Defines which recent turns stay in the prompt verbatim.
+        summarize (Callable): Awaitable taking (previous summary text, turns) and returning the new summary text.
+        min_batch (int): Minimum number of turns outside the window before a new summary is produced.
+        max_batch (int): Maximum number of turns folded into the summary per run.
+        """
+        self.crud = crud
+        self.context_builder = context_builder
+        self.summarize_turns = summarize
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self._running = set()
+
+    def history_budget(self, summary: Dict) -> int:
+        """Return the tokens left for verbatim history once the summary is in the prompt."""
+        return max(self.context_builder.token_budget - (summary.get('tokens') or 0), 0)
+
+    async def summarize(self, conversation_id: str) -> bool:
+        """Fold turns that fell out of the history window into the conversation's summary.
+
+        Args:
+            conversation_id (str): The unique identifier of the conversation.
+
+        Returns:
+            bool: True if a new summary version was stored.
+        """
+        if conversation_id in self._running:
+            return False
+        self._running.add(conversation_id)
+        try:
+            state = await self.crud.get_summary_state(conversation_id)
+            if state is None:
+                return False
+            summary = state.get('summary') or {}
+            covered = summary.get('covered', 0)
+
+            recent = await self.crud.get_messages(conversation_id, self.context_builder.max_turns)
+            window = await self.context_builder.aselect(recent, self.history_budget(summary))
+            window_start = state['message_count'] - len(window)
+            if window_start - covered < self.min_batch:
+                return False
+
+            turns = await self.crud.get_messages_page(
+                conversation_id, start=covered, limit=min(window_start - covered, self.max_batch))
+            if not turns:
+                return False
+            text = await self.summarize_turns(summary.get('text', ''), turns)
+            return await self.crud.update_summary(
+                conversation_id, text, turns[-1]['seq'] + 1, summary.get('version', 0),
+                await self.context_builder.acount(text))
+        finally:
+            self._running.discard(conversation_id)
+
+    async def summarize_in_background(self, conversation_id: str):
+        """Run `summarize`, logging instead of raising since nobody awaits a background task."""
+        try:
+            await self.summarize(conversation_id)
+        except Exception:
+            logger.exception("Failed to summarize conversation %s", conversation_id)
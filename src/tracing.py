@@ -0,0 +1,108 @@
+import re
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+from typing import List, Optional, Tuple
+
+from src.metrics import Histogram
+
+TRACE_ID_HEADER = "X-Trace-Id"
+# Trace ids sent by a client or proxy are kept if they look like one; others are replaced.
+VALID_TRACE_ID = re.compile(r"[A-Za-z0-9._-]{1,64}")
+
+
+class RequestTrace:
+    """Trace id and stage durations of the request being served."""
+
+    __slots__ = ('trace_id', 'stages')
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.stages: List[Tuple[str, float]] = []
+
+    def server_timing(self) -> str:
+        """Format the stage durations as a Server-Timing header value, in milliseconds."""
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages)
+
+
+_current_trace: ContextVar[Optional[RequestTrace]] = ContextVar("request_trace", default=None)
+
+
+def current_trace() -> Optional[RequestTrace]:
+    """Return the trace of the request being served, or None outside a request."""
+    return _current_trace.get()
+
+
+def observe_stage(name: str, histogram: Histogram, seconds: float):
+    """Record that a stage of the current request took `seconds`: in `histogram` and in the request's trace."""
+    histogram.observe(seconds)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.stages.append((name, seconds))
+
+
+@contextmanager
+def stage(name: str, histogram: Histogram):
+    """Time the `with` block as one stage of the current request; see observe_stage."""
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, histogram, perf_counter() - started)
+
+
+class TracingMiddleware:
+    """ASGI middleware that times every HTTP request and gives it a RequestTrace.
+
+    With `response_headers`, responses carry the trace id (reused from the request's
+    X-Trace-Id header when valid) and a Server-Timing header listing the stages that
+    finished before the response started. Streamed responses send their headers first,
+    so they only carry the trace id.
+    """
+
+    def __init__(self, app, histogram: Histogram, response_headers: bool = False, untimed_paths=("/metrics",)):
+        """
+        Parameters:
+        app: The ASGI application to wrap.
+        histogram (Histogram): Receives the duration of every request, body included.
+        response_headers (bool): Add X-Trace-Id and Server-Timing headers to responses.
+        untimed_paths: Paths not observed in `histogram`, e.g. the metrics scrape itself.
+        """
+        self.app = app
+        self.histogram = histogram
+        self.response_headers = response_headers
+        self.untimed_paths = frozenset(untimed_paths)
+        self._trace_header = TRACE_ID_HEADER.lower().encode()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        trace = RequestTrace(self._trace_id(scope))
+        token = _current_trace.set(trace)
+        started = perf_counter()
+
+        async def send_with_headers(message):
+            if message['type'] == 'http.response.start':
+                headers = list(message.get('headers', ()))
+                headers.append((self._trace_header, trace.trace_id.encode()))
+                if trace.stages:
+                    headers.append((b"server-timing", trace.server_timing().encode()))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_headers if self.response_headers else send)
+        finally:
+            _current_trace.reset(token)
+            if scope.get('path') not in self.untimed_paths:
+                self.histogram.observe(perf_counter() - started)
+
+    def _trace_id(self, scope) -> str:
+        for key, value in scope.get('headers', ()):
+            if key == self._trace_header:
+                trace_id = value.decode('latin-1')
+                if VALID_TRACE_ID.fullmatch(trace_id):
+                    return trace_id
+        return uuid.uuid4().hex
@@ -0,0 +1,109 @@
+import asyncio
+import pytest
+from src.admission import BULK, INTERACTIVE, AdmissionController, Overloaded
+
+
+async def hold(controller, log, name, release, facility=None, lane=INTERACTIVE):
+    async with controller.admit(facility, lane):
+        log.append(name)
+        await release.wait()
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_requests_beyond_concurrency_wait_in_order():
+    async def scenario():
+        controller, log, release = AdmissionController(max_concurrency=2), [], asyncio.Event()
+        tasks = [asyncio.ensure_future(hold(controller, log, i, release)) for i in range(4)]
+        await settle()
+        started = list(log)
+        depth = controller.queue_depth()
+        release.set()
+        await asyncio.gather(*tasks)
+        return started, depth, log, controller
+
+    started, depth, log, controller = asyncio.run(scenario())
+    assert started == [0, 1]
+    assert depth == 2
+    assert log == [0, 1, 2, 3]
+    assert controller.running == 0
+
+def test_interactive_lane_is_served_before_bulk():
+    async def scenario():
+        controller, log = AdmissionController(max_concurrency=1), []
+        first, rest = asyncio.Event(), asyncio.Event()
+        rest.set()
+        tasks = [asyncio.ensure_future(hold(controller, log, "running", first))]
+        await settle()
+        tasks.append(asyncio.ensure_future(hold(controller, log, "bulk", rest, lane=BULK)))
+        await settle()
+        tasks.append(asyncio.ensure_future(hold(controller, log, "interactive", rest)))
+        await settle()
+        first.set()
+        await asyncio.gather(*tasks)
+        return log
+
+    assert asyncio.run(scenario()) == ["running", "interactive", "bulk"]
+
+def test_facility_limit_lets_other_facilities_through():
+    async def scenario():
+        controller, log, release = AdmissionController(max_concurrency=4, facility_limits={"north": 1}), [], asyncio.Event()
+        tasks = [asyncio.ensure_future(hold(controller, log, name, release, facility=facility))
+                 for name, facility in [("north-1", "north"), ("north-2", "north"), ("south-1", "south")]]
+        await settle()
+        started = list(log)
+        release.set()
+        await asyncio.gather(*tasks)
+        return started
+
+    assert asyncio.run(scenario()) == ["north-1", "south-1"]
+
+def test_full_lane_is_rejected_with_retry_after():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=1, max_queue=1, initial_service_seconds=4)
+        log, release = [], asyncio.Event()
+        tasks = [asyncio.ensure_future(hold(controller, log, i, release)) for i in range(2)]
+        await settle()
+        with pytest.raises(Overloaded) as error:
+            async with controller.admit():
+                pass
+        # The bulk lane has its own queue.
+        tasks.append(asyncio.ensure_future(hold(controller, log, "bulk", release, lane=BULK)))
+        await settle()
+        release.set()
+        await asyncio.gather(*tasks)
+        return error.value.retry_after, log
+
+    retry_after, log = asyncio.run(scenario())
+    assert retry_after == 8
+    assert log == [0, 1, "bulk"]
+
+def test_cancelled_waiter_gives_up_its_place():
+    async def scenario():
+        controller, log, release = AdmissionController(max_concurrency=1), [], asyncio.Event()
+        running = asyncio.ensure_future(hold(controller, log, "running", release))
+        await settle()
+        cancelled = asyncio.ensure_future(hold(controller, log, "cancelled", release))
+        waiting = asyncio.ensure_future(hold(controller, log, "waiting", release))
+        await settle()
+        cancelled.cancel()
+        await settle()
+        release.set()
+        await asyncio.gather(running, waiting)
+        return log, controller
+
+    log, controller = asyncio.run(scenario())
+    assert log == ["running", "waiting"]
+    assert controller.running == 0
+    assert controller.queue_depth() == 0
+
+def test_unknown_lane_is_rejected():
+    async def scenario():
+        async with AdmissionController().admit(lane="urgent"):
+            pass
+
+    with pytest.raises(ValueError):
+        asyncio.run(scenario())
@@ -0,0 +1,61 @@
+import asyncio
+import pytest
+from datetime import datetime
+from src.async_crud_handler import AsyncMessageCrudHandler
+import uuid
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def with_handler(test):
+    handler = AsyncMessageCrudHandler("mongodb://localhost:27017", "test_db")
+    try:
+        return await test(handler)
+    finally:
+        await handler.close_connection()
+
+
+def test_create_conversation():
+    async def test(crud_handler):
+        conversation_id = str(uuid.uuid4())
+        result = await crud_handler.create_conversation(conversation_id)
+        assert isinstance(result, str)
+        conversation = await crud_handler.get_conversation(conversation_id)
+        assert conversation["conversation_id"] == conversation_id
+        assert len(conversation["messages"]) == 0
+        assert isinstance(conversation["created_at"], datetime)
+        assert isinstance(conversation["updated_at"], datetime)
+    run(with_handler(test))
+
+def test_add_message():
+    async def test(crud_handler):
+        conversation_id = str(uuid.uuid4())
+        await crud_handler.create_conversation(conversation_id)
+
+        result = await crud_handler.add_message(conversation_id, "Hello", "Hi there!")
+        assert result is True
+
+        messages = await crud_handler.get_messages(conversation_id)
+        assert len(messages) == 1
+        assert messages[0]["nurse"] == "Hello"
+        assert messages[0]["bot"] == "Hi there!"
+    run(with_handler(test))
+
+def test_get_nonexistent_conversation():
+    async def test(crud_handler):
+        assert await crud_handler.get_conversation("nonexistent_id") is None
+    run(with_handler(test))
+
+def test_delete_nonexistent_conversation():
+    async def test(crud_handler):
+        with pytest.raises(ValueError):
+            await crud_handler.delete_conversation("nonexistent_id")
+    run(with_handler(test))
+
+def test_handlers_share_client():
+    first = AsyncMessageCrudHandler("mongodb://localhost:27017", "test_db")
+    second = AsyncMessageCrudHandler("mongodb://localhost:27017", "other_db")
+    assert first.client is second.client
+    run(first.close_connection())
@@ -0,0 +1,58 @@
+import threading
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from src.batch_scheduler import BatchScheduler, BATCH_SIZE
+
+
+def test_concurrent_requests_are_batched_and_routed_back():
+    batches = []
+    release = threading.Event()
+
+    def generate_batch(requests):
+        release.wait(timeout=5)
+        batches.append(list(requests))
+        return [request * 10 for request in requests]
+
+    scheduler = BatchScheduler(generate_batch, max_batch_size=4, max_wait_ms=200)
+    try:
+        # The first request blocks the worker while the rest queue up behind it.
+        futures = [scheduler.submit(i) for i in range(5)]
+        release.set()
+        assert [future.result(timeout=5) for future in futures] == [0, 10, 20, 30, 40]
+    finally:
+        scheduler.close()
+    assert all(len(batch) <= 4 for batch in batches)
+    assert len(batches) < 5
+
+def test_batch_waits_for_requests_within_window():
+    scheduler = BatchScheduler(lambda requests: [len(requests)] * len(requests), max_batch_size=8, max_wait_ms=200)
+    try:
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            sizes = list(pool.map(scheduler.run, range(3)))
+    finally:
+        scheduler.close()
+    assert sizes == [3, 3, 3]
+    assert BATCH_SIZE.count >= 1
+
+def test_batch_exception_is_propagated_to_every_caller():
+    def generate_batch(requests):
+        raise RuntimeError("CUDA out of memory")
+
+    scheduler = BatchScheduler(generate_batch, max_batch_size=2, max_wait_ms=50)
+    try:
+        futures = [scheduler.submit(i) for i in range(2)]
+        for future in futures:
+            with pytest.raises(RuntimeError):
+                future.result(timeout=5)
+    finally:
+        scheduler.close()
+
+def test_requests_without_a_result_fail():
+    scheduler = BatchScheduler(lambda requests: requests[:1], max_batch_size=2, max_wait_ms=200)
+    try:
+        futures = [scheduler.submit(i) for i in range(2)]
+        assert futures[0].result(timeout=5) == 0
+        with pytest.raises(RuntimeError, match="1 results for 2 requests"):
+            futures[1].result(timeout=5)
+    finally:
+        scheduler.close()
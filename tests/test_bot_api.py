@@ -0,0 +1,145 @@
+import asyncio
+import json
+import pytest
+from types import SimpleNamespace
+from fastapi.testclient import TestClient
+from bot_api import app, get_conversation_handler
+from conversation_handler import ConversationHandler
+from src.async_clinical_store import AsyncClinicalStore
+from src.llm_backend import FakeLLMBackend
+
+
+class MemoryCrud:
+    """Conversations kept in a dict, standing in for the async Mongo handler."""
+
+    def __init__(self, *conversation_ids):
+        self.messages = {conversation_id: [] for conversation_id in conversation_ids}
+
+    async def get_conversation(self, conversation_id, history_limit=None):
+        if conversation_id not in self.messages:
+            return None
+        return {"conversation_id": conversation_id, "messages": list(self.messages[conversation_id])}
+
+    async def add_message(self, conversation_id, nurse_message, bot_message, token_count=None, token_ids=None):
+        self.messages[conversation_id].append({"nurse": nurse_message, "bot": bot_message})
+        return True
+
+    async def close_connection(self):
+        pass
+
+
+class MemoryCursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def sort(self, *args):
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def limit(self, count):
+        return MemoryCursor(self.documents[:count])
+
+    async def to_list(self, length):
+        return list(self.documents)
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self.documents:
+            yield document
+
+
+class MemoryCollection:
+    """Collection stand-in; find applies plain equality conditions and ignores the rest of the filter."""
+
+    def __init__(self, documents=()):
+        self.documents = list(documents)
+
+    def find(self, query, projection=None):
+        conditions = {key: value for key, value in query.items() if not key.startswith('$')
+                      and not isinstance(value, dict)}
+        return MemoryCursor([document for document in self.documents
+                             if all(document.get(key) == value for key, value in conditions.items())])
+
+
+FOLLOWUPS = [{"date": "2024-12-20", "patient_id": "p1", "patient_name": "John Doe", "ward": "3B"},
+             {"date": "2024-12-21", "patient_id": "p1", "patient_name": "John Doe", "ward": "3B"}]
+
+
+def server_sent_events(body):
+    """Split an event-stream body into (event, data) pairs, checking the framing of each."""
+    events = []
+    assert body.endswith("\n\n")
+    for frame in body[:-2].split("\n\n"):
+        event, data = frame.split("\n")
+        assert event.startswith("event: ") and data.startswith("data: ")
+        events.append((event[len("event: "):], json.loads(data[len("data: "):])))
+    return events
+
+
+@pytest.fixture
+def handler():
+    handler = ConversationHandler(bot=FakeLLMBackend(), fast_path=False, history_cache_bytes=0)
+    handler.async_crud = MemoryCrud("conv123")
+    app.dependency_overrides[get_conversation_handler] = lambda: handler
+    yield handler
+    app.dependency_overrides.clear()
+    asyncio.run(handler.close())
+
+
+@pytest.fixture
+def clinical_store(handler):
+    handler.async_clinical_store = AsyncClinicalStore(SimpleNamespace(
+        patients=MemoryCollection([{"patient_id": "p1", "name": "John Doe", "name_key": "john doe", "ward": "3B"}]),
+        medications=MemoryCollection(), followups=MemoryCollection(FOLLOWUPS)))
+    return handler.async_clinical_store
+
+
+def test_streamed_conversation_sends_tokens_then_the_result(handler):
+    response = TestClient(app).post("/conversation/stream",
+                                    json={"conversation_id": "conv123", "user_input": "Hello"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = server_sent_events(response.text)
+    assert [event for event, _ in events] == ["token"] * (len(events) - 1) + ["result"]
+    expected = {"intent": "echo", "entities": {}, "message": "Received: Hello"}
+    assert json.loads("".join(data["text"] for _, data in events[:-1])) == expected
+    assert events[-1][1] == {"response": expected, "persisted": True}
+    assert handler.async_crud.messages["conv123"] == [{"nurse": "Hello", "bot": "Received: Hello"}]
+
+def test_streamed_conversation_ends_with_an_error_event(handler):
+    response = TestClient(app).post("/conversation/stream",
+                                    json={"conversation_id": "missing", "user_input": "Hello"})
+    assert response.status_code == 200
+    [(event, data)] = server_sent_events(response.text)
+    assert event == "error"
+    assert data["detail"] == "Error processing conversation: Conversation ID missing not found."
+
+def test_followups_are_paged_with_a_cursor(clinical_store):
+    client = TestClient(app)
+    first = client.get("/followups", params={"patient_name": "john doe", "limit": 1}).json()
+    assert first["followups"] == FOLLOWUPS[:1] and first["next_cursor"]
+    response = client.get("/followups", params={"limit": 1, "cursor": "not a cursor"})
+    assert response.status_code == 400
+
+def test_followups_of_unknown_patients_are_not_found(clinical_store):
+    client = TestClient(app)
+    for path in ("/followups", "/followups/stream"):
+        response = client.get(path, params={"patient_name": "Nobody"})
+        assert response.status_code == 404 and "No patient named Nobody" in response.json()["detail"]
+
+def test_followups_are_streamed_as_ndjson(clinical_store):
+    response = TestClient(app).get("/followups/stream", params={"ward": "3B"})
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert response.text.endswith("\n")
+    assert [json.loads(line) for line in response.text.splitlines()] == FOLLOWUPS
+
+def test_followups_are_not_found_without_clinical_records(handler):
+    handler.async_clinical_store = None
+    client = TestClient(app)
+    for path in ("/followups", "/followups/stream"):
+        response = client.get(path)
+        assert response.status_code == 404 and response.json()["detail"] == "Clinical records are disabled."
@@ -0,0 +1,102 @@
+import pytest
+import uuid
+from datetime import date
+from src.clinical_store import (ClinicalRecordError, ClinicalStore, decode_cursor, encode_cursor, followup_filter,
+                                normalize_name, single_patient, validate_intent)
+from src.crud_handler import MessageCrudHandler
+
+
+def add_patient(name, age=45):
+    return {"intent": "add_patient",
+            "entities": {"name": name, "gender": "male", "age": age, "condition": "diabetes"}}
+
+
+def test_normalize_name_ignores_case_and_spacing():
+    assert normalize_name("  John   DOE ") == normalize_name("john doe") == "john doe"
+
+def test_error_responses_change_nothing():
+    assert validate_intent({"error": True, "missing_entities": ["age"], "message": "..."}) is None
+    assert validate_intent({"intent": "echo", "entities": {}, "message": "..."}) is None
+
+def test_missing_and_malformed_entities_are_rejected():
+    with pytest.raises(ClinicalRecordError, match="dosage"):
+        validate_intent({"intent": "assign_medication",
+                         "entities": {"patient_name": "John Doe", "medication": "Paracetamol", "frequency": "daily"}})
+    with pytest.raises(ClinicalRecordError):
+        validate_intent(add_patient("John Doe", age="forty"))
+    with pytest.raises(ClinicalRecordError):
+        validate_intent({"intent": "schedule_followup", "entities": {"patient_name": "John Doe", "date": "Dec 20"}})
+
+def test_names_shared_by_several_patients_need_a_ward():
+    assert single_patient([], "John Doe") is None
+    assert single_patient([{"patient_id": "a"}], "John Doe") == {"patient_id": "a"}
+    with pytest.raises(ClinicalRecordError, match="ward"):
+        single_patient([{"patient_id": "a"}, {"patient_id": "b"}], "John Doe")
+
+def test_cursor_round_trip():
+    cursor = encode_cursor({"date": "2024-12-20", "patient_id": "abc"})
+    assert decode_cursor(cursor) == ("2024-12-20", "abc")
+    with pytest.raises(ValueError):
+        decode_cursor("not a cursor")
+
+def test_followup_filter_pages_after_the_cursor():
+    cursor = encode_cursor({"date": "2024-12-20", "patient_id": "abc"})
+    assert followup_filter(date(2024, 12, 20), date(2024, 12, 26), ward="3B", cursor=cursor) == {'$and': [
+        {'date': {'$gte': '2024-12-20', '$lte': '2024-12-26'}, 'ward': '3B'},
+        {'$or': [{'date': {'$gt': '2024-12-20'}}, {'date': '2024-12-20', 'patient_id': {'$gt': 'abc'}}]}
+    ]}
+
+
+@pytest.fixture
+def store():
+    crud = MessageCrudHandler("mongodb://localhost:27017", "test_db")
+    yield ClinicalStore(crud.db)
+    crud.close_connection()
+
+def test_intents_for_an_added_patient_are_stored(store):
+    name = f"Patient {uuid.uuid4().hex[:8]}"
+    store.apply_intent(add_patient(name), "conv123")
+    store.apply_intent({"intent": "assign_medication", "entities": {
+        "patient_name": name.upper(), "medication": "Paracetamol", "dosage": "500mg", "frequency": "twice a day"}},
+        "conv123")
+    medications = store.get_medications(name)
+    assert [medication["medication"] for medication in medications] == ["Paracetamol"]
+    assert medications[0]["patient_name"] == name
+
+def test_duplicate_patients_are_rejected(store):
+    name = f"Patient {uuid.uuid4().hex[:8]}"
+    store.apply_intent(add_patient(name), "conv123")
+    with pytest.raises(ClinicalRecordError):
+        store.apply_intent(add_patient(name.lower()), "conv123")
+
+def test_patients_in_different_wards_can_share_a_name(store):
+    name = f"Patient {uuid.uuid4().hex[:8]}"
+    for ward in ("3A", "3B"):
+        store.apply_intent({"intent": "add_patient", "entities": dict(add_patient(name)["entities"], ward=ward)},
+                           "conv123")
+    with pytest.raises(ClinicalRecordError, match="ward"):
+        store.find_patient(name)
+    assert store.find_patient(name, "3B")["ward"] == "3B"
+
+def test_unknown_patients_are_rejected(store):
+    with pytest.raises(ClinicalRecordError, match="No patient"):
+        store.apply_intent({"intent": "schedule_followup",
+                            "entities": {"patient_name": f"Nobody {uuid.uuid4().hex}", "date": "2024-12-20"}}, "c")
+
+def test_followups_are_paged_in_date_order(store):
+    ward = f"Ward {uuid.uuid4().hex[:8]}"
+    for i in range(3):
+        name = f"Patient {uuid.uuid4().hex[:8]}"
+        entities = dict(add_patient(name)["entities"], ward=ward)
+        store.apply_intent({"intent": "add_patient", "entities": entities}, "conv123")
+        for day in ("2024-12-21", "2024-12-20"):
+            store.apply_intent({"intent": "schedule_followup", "entities": {"patient_name": name, "date": day}},
+                               "conv123")
+    followups, cursor = [], None
+    while True:
+        page, cursor = store.find_followups(ward=ward, limit=4, cursor=cursor)
+        followups.extend(page)
+        if cursor is None:
+            break
+    assert [followup["date"] for followup in followups] == ["2024-12-20"] * 3 + ["2024-12-21"] * 3
+    assert len({(followup["date"], followup["patient_id"]) for followup in followups}) == 6
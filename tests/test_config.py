@@ -0,0 +1,25 @@
+import pytest
+import sys
+from types import SimpleNamespace
+from src import config
+from src.config import env_bool
+from conversation_handler import create_llm_runner
+
+@pytest.mark.parametrize("value, expected", [("1", True), ("true", True), ("On", True), ("0", False), ("no", False)])
+def test_env_bool(monkeypatch, value, expected):
+    monkeypatch.setenv("TEST_FLAG", value)
+    assert env_bool("TEST_FLAG", not expected) is expected
+
+def test_env_bool_default(monkeypatch):
+    monkeypatch.delenv("TEST_FLAG", raising=False)
+    assert env_bool("TEST_FLAG", True) is True
+
+def test_unknown_backend_is_rejected():
+    with pytest.raises(ValueError):
+        create_llm_runner("llamacpp")
+
+def test_local_runner_gets_the_constrained_decoding_setting(monkeypatch):
+    # Stands in for src.management_bot so the model is not loaded.
+    monkeypatch.setitem(sys.modules, "src.management_bot", SimpleNamespace(LLMRunner=lambda **kwargs: kwargs))
+    monkeypatch.setattr(config, "MODEL_CONSTRAINED_DECODING", True)
+    assert create_llm_runner(config.LOCAL_BACKEND) == {"constrained_decoding": True}
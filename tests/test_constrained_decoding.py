@@ -0,0 +1,94 @@
+import pytest
+import re
+from types import SimpleNamespace
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+from src.constrained_decoding import ConstrainedDecoder, TruncatedResponseError
+from src.prefix_cache import PrefixKVCache
+
+REQUIRED_ENTITIES = {
+    "add_patient": {"name", "gender", "age", "condition"},
+    "assign_medication": {"patient_name", "medication", "dosage", "frequency"},
+    "schedule_followup": {"patient_name", "date"},
+}
+
+
+class CharTokenizer:
+    """Tokenizer stand-in with one token per printable ASCII character; ids 0-2 are special."""
+
+    all_special_ids = [0, 1, 2]
+
+    def encode(self, text, add_special_tokens=False):
+        return [ord(char) for char in text]
+
+    def decode(self, token_ids, skip_special_tokens=False):
+        return ''.join(chr(token_id) for token_id in token_ids if 32 <= token_id < 127)
+
+
+class ScriptedModel:
+    """Model stand-in whose greedy choice at each position is the next character of `script`."""
+
+    def __init__(self, script, vocab_size=128):
+        self.script = script
+        self.vocab_size = vocab_size
+
+    def get_output_embeddings(self):
+        return SimpleNamespace(weight=torch.zeros(self.vocab_size, 1))
+
+    def __call__(self, input_ids, past_key_values, use_cache):
+        # The "cache" is just the number of tokens consumed so far.
+        position = past_key_values + input_ids.shape[1]
+        logits = torch.zeros(1, 1, self.vocab_size)
+        if position < len(self.script):
+            logits[0, -1, ord(self.script[position])] = 1
+        return SimpleNamespace(logits=logits, past_key_values=position)
+
+
+def scripted_decode(response_text):
+    decoder = ConstrainedDecoder(ScriptedModel(response_text), CharTokenizer())
+    return decoder.decode(SimpleNamespace(past_key_values=0), torch.tensor([[]], dtype=torch.long))
+
+
+def test_values_that_fit_their_slot_are_kept():
+    text = '{"intent": "schedule_followup", "entities": {"patient_name": "John Doe", "date": "2024-12-20"}, "message": "ok"}'
+    assert scripted_decode(text)["entities"] == {"patient_name": "John Doe", "date": "2024-12-20"}
+
+def test_values_longer_than_their_slot_are_not_truncated():
+    name = "John " * 10
+    with pytest.raises(TruncatedResponseError):
+        scripted_decode('{"intent": "schedule_followup", "entities": {"patient_name": "' + name + '", "date": ')
+
+def test_dates_are_always_iso_formatted():
+    response = scripted_decode('{"intent": "schedule_followup", "entities": {"patient_name": "John Doe", '
+                               '"date": "next Tuesday"}, "message": "ok"}')
+    assert re.fullmatch(r"\d{4}-\d{2}-\d{2}", response["entities"]["date"])
+
+@pytest.mark.parametrize("seed", range(4))
+def test_random_model_output_always_matches_schema(seed):
+    torch.manual_seed(seed)
+    config = transformers.LlamaConfig(vocab_size=128, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                                      num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=2048)
+    model = transformers.LlamaForCausalLM(config).eval()
+    tokenizer = CharTokenizer()
+    decoder = ConstrainedDecoder(model, tokenizer)
+    prefix_cache = PrefixKVCache(model, torch.tensor([tokenizer.encode("Instructions: reply in JSON.\n")]))
+
+    try:
+        response = decoder.decode(prefix_cache,
+                                  torch.tensor([tokenizer.encode("Input: Add a new patient.\nResponse: ")]))
+    except TruncatedResponseError:
+        # A random model rarely closes a string; cutting it off is what must not happen.
+        return
+
+    assert isinstance(response["message"], str)
+    if "error" in response:
+        assert response["error"] is True
+        assert response["missing_entities"]
+    else:
+        assert set(response["entities"]) == REQUIRED_ENTITIES[response["intent"]]
+        if response["intent"] == "add_patient":
+            assert isinstance(response["entities"]["age"], int)
+        if response["intent"] == "schedule_followup":
+            assert re.fullmatch(r"\d{4}-\d{2}-\d{2}", response["entities"]["date"])
@@ -0,0 +1,52 @@
+import asyncio
+from src.context_builder import ContextBuilder, format_history
+
+
+def count_words(text):
+    return len(text.split())
+
+
+def test_select_keeps_most_recent_turns_within_budget():
+    messages = [{"nurse": f"message {i}", "bot": "ok"} for i in range(5)]
+    # Each pair renders as "NURSE: message i\nBOT: ok" -> 5 words, +1 for the joining newline.
+    builder = ContextBuilder(count_words, token_budget=13)
+    assert builder.select(messages) == messages[-2:]
+
+def test_select_empty_when_budget_too_small():
+    builder = ContextBuilder(count_words, token_budget=1)
+    assert builder.select([{"nurse": "Hello", "bot": "Hi there!"}]) == []
+
+def test_stored_token_counts_are_not_recomputed():
+    calls = []
+
+    def count_tokens(text):
+        calls.append(text)
+        return 1
+
+    builder = ContextBuilder(count_tokens, token_budget=100)
+    messages = [{"nurse": "Hello", "bot": "Hi", "tokens": 4}, {"nurse": "Add patient", "bot": "Done"}]
+    builder.select(messages)
+    builder.select(messages)
+    assert calls == [format_history(messages[1:])]
+
+def test_async_selection_counts_missing_pairs_with_the_async_counter():
+    counted = []
+
+    def count_tokens(text):
+        raise AssertionError("the blocking counter was used")
+
+    async def acount_tokens(text):
+        counted.append(text)
+        return count_words(text)
+
+    builder = ContextBuilder(count_tokens, token_budget=13, acount_tokens=acount_tokens)
+    messages = [{"nurse": f"message {i}", "bot": "ok"} for i in range(4)] + [{"nurse": "x", "bot": "y", "tokens": 2}]
+
+    async def scenario():
+        selected = await builder.aselect(messages)
+        await builder.aselect(messages)
+        return selected, await builder.apair_tokens("message 0", "ok")
+
+    selected, pair_tokens = asyncio.run(scenario())
+    assert selected == messages[-2:]
+    assert len(counted) == 4 and pair_tokens == 6
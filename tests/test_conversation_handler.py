@@ -0,0 +1,177 @@
+import asyncio
+import json
+import pytest
+from conversation_handler import ConversationHandler
+from src.admission import AdmissionController
+from src.clinical_store import ClinicalRecordError, unknown_patient_error
+from src.fast_path import FastPathParser
+from src.llm_backend import FakeLLMBackend
+
+MEDICATION = {"intent": "assign_medication",
+              "entities": {"patient_name": "John Doe", "medication": "Paracetamol", "dosage": "500mg",
+                           "frequency": "twice a day"},
+              "message": "Medication Paracetamol has been assigned to John Doe."}
+
+
+class MemoryCrud:
+    """Conversations kept in a dict, standing in for the async Mongo handler."""
+
+    def __init__(self, *conversation_ids):
+        self.messages = {conversation_id: [] for conversation_id in conversation_ids}
+
+    async def get_conversation(self, conversation_id, history_limit=None):
+        if conversation_id not in self.messages:
+            return None
+        return {"conversation_id": conversation_id, "messages": list(self.messages[conversation_id])}
+
+    async def conversation_exists(self, conversation_id):
+        return conversation_id in self.messages
+
+    async def add_message(self, conversation_id, nurse_message, bot_message, token_count=None, token_ids=None):
+        if conversation_id not in self.messages:
+            raise ValueError(f"Conversation ID {conversation_id} not found.")
+        self.messages[conversation_id].append({"nurse": nurse_message, "bot": bot_message})
+        return True
+
+    async def close_connection(self):
+        pass
+
+
+class NoPatients:
+    """A clinical store that knows no patients."""
+
+    def apply_intent(self, response, conversation_id):
+        raise unknown_patient_error(response["entities"]["patient_name"])
+
+
+class AsyncNoPatients:
+    async def apply_intent(self, response, conversation_id):
+        raise unknown_patient_error(response["entities"]["patient_name"])
+
+
+class RecordingStore:
+    """A clinical store that accepts every intent and remembers it."""
+
+    def __init__(self):
+        self.applied = []
+
+    def apply_intent(self, response, conversation_id):
+        self.applied.append((conversation_id, response["intent"]))
+
+
+class AsyncRecordingStore(RecordingStore):
+    async def apply_intent(self, response, conversation_id):
+        super().apply_intent(response, conversation_id)
+
+
+class SyncMemoryCrud:
+    def __init__(self, *conversation_ids):
+        self.conversation_ids = set(conversation_ids)
+
+    def conversation_exists(self, conversation_id):
+        return conversation_id in self.conversation_ids
+
+    def close_connection(self):
+        pass
+
+
+@pytest.fixture
+def handler():
+    handler = ConversationHandler(bot=FakeLLMBackend(respond=lambda prompt: dict(MEDICATION)), fast_path=False,
+                                  clinical_records=True, history_cache_bytes=0)
+    handler.async_crud = MemoryCrud("conv123")
+    handler.clinical_store = NoPatients()
+    handler.async_clinical_store = AsyncNoPatients()
+    yield handler
+    asyncio.run(handler.close())
+
+
+def test_rejected_intents_keep_their_intent_and_entities():
+    rejected = ConversationHandler._rejected_intent(MEDICATION, ClinicalRecordError("No patient named John Doe."))
+    assert rejected == {"error": True, "intent": "assign_medication", "entities": MEDICATION["entities"],
+                        "message": "No patient named John Doe."}
+
+def test_intents_pass_through_without_clinical_records(handler):
+    handler.clinical_store = None
+    assert handler._apply_intent("conv123", MEDICATION) is MEDICATION
+
+def test_intents_for_unknown_patients_become_error_responses(handler):
+    response = handler._apply_intent("conv123", MEDICATION)
+    assert response["error"] is True and response["message"].startswith("No patient named John Doe")
+
+def test_rejected_turns_are_stored_as_errors(handler):
+    response = asyncio.run(handler.handle_conversation_async("conv123", "Give John Doe paracetamol"))
+    assert response["error"] is True
+    assert handler.async_crud.messages["conv123"] == [{"nurse": "Give John Doe paracetamol",
+                                                       "bot": response["message"]}]
+
+def test_streamed_turns_end_with_the_rejection(handler):
+    async def scenario():
+        return [event async for event in handler.stream_conversation("conv123", "Give John Doe paracetamol")]
+
+    events = asyncio.run(scenario())
+    tokens = "".join(chunk for kind, chunk in events if kind == "token")
+    assert MEDICATION["message"] in tokens
+    kind, result = events[-1]
+    assert kind == "result" and result["error"] is True
+    assert handler.async_crud.messages["conv123"][0]["bot"] == result["message"] != MEDICATION["message"]
+
+def test_turns_waiting_for_their_conversation_hold_no_admission_slot(handler):
+    handler.bot = FakeLLMBackend(latency=lambda: 0.1, respond=lambda prompt: dict(MEDICATION))
+    handler.async_crud = MemoryCrud("a", "b")
+    admission = AdmissionController(max_concurrency=2)
+
+    def admit():
+        return admission.admit()
+
+    async def scenario():
+        turns = [asyncio.ensure_future(handler.handle_conversation_async(conversation_id, "hello", admit=admit))
+                 for conversation_id in ("a", "a", "b")]
+        await asyncio.sleep(0.05)
+        assert admission.running == 2 and admission.queue_depth() == 0
+        await asyncio.gather(*turns)
+
+    asyncio.run(scenario())
+
+def collect(stream):
+    async def scenario():
+        return [event async for event in stream]
+    return asyncio.run(scenario())
+
+@pytest.mark.parametrize("is_async", [True, False])
+def test_streamed_tokens_form_the_stored_response(handler, is_async):
+    handler.clinical_store = handler.async_clinical_store = None
+    # The synchronous variant streams through the generation thread pool.
+    handler.bot.is_async = is_async
+    events = collect(handler.stream_conversation("conv123", "Give John Doe paracetamol"))
+    assert [kind for kind, _ in events] == ["token"] * (len(events) - 1) + ["result"]
+    assert json.loads("".join(chunk for _, chunk in events[:-1])) == MEDICATION
+    assert events[-1][1] == MEDICATION
+    assert handler.async_crud.messages["conv123"] == [{"nurse": "Give John Doe paracetamol",
+                                                       "bot": MEDICATION["message"]}]
+
+def test_streams_for_unknown_conversations_fail_before_generating(handler):
+    with pytest.raises(ValueError, match="not found"):
+        collect(handler.stream_conversation("missing", "hello"))
+    assert handler.bot.requests == 0
+
+def test_streamed_invalid_json_is_not_stored(handler):
+    handler.bot = FakeLLMBackend(respond=lambda prompt: "not json")
+    with pytest.raises(ValueError, match="valid JSON"):
+        collect(handler.stream_conversation("conv123", "hello"))
+    assert handler.async_crud.messages["conv123"] == []
+
+def test_fast_path_intents_for_unknown_conversations_are_not_applied(handler):
+    handler.fast_path = FastPathParser()
+    handler.crud = SyncMemoryCrud("conv123")
+    handler.clinical_store, handler.async_clinical_store = RecordingStore(), AsyncRecordingStore()
+    command = "Assign medication Paracetamol 500mg twice a day for John Doe."
+    with pytest.raises(ValueError, match="not found"):
+        handler.handle_conversation("missing", command)
+    with pytest.raises(ValueError, match="not found"):
+        asyncio.run(handler.handle_conversation_async("missing", command))
+    with pytest.raises(ValueError, match="not found"):
+        collect(handler.stream_conversation("missing", command))
+    assert handler.clinical_store.applied == handler.async_clinical_store.applied == []
+    asyncio.run(handler.handle_conversation_async("conv123", command))
+    assert handler.async_clinical_store.applied == [("conv123", "assign_medication")]
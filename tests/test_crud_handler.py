@@ -1,7 +1,7 @@
 import pytest
 from unittest.mock import Mock, patch
 from datetime import datetime
-from src.crud_handler import MessageCrudHandler
+from src.crud_handler import MessageCrudHandler, COLLECTION_STORAGE
 import uuid
 
 
@@ -56,4 +56,76 @@ def test_delete_nonexistent_conversation(crud_handler):
 def test_close_connection(mock_client):
     handler = MessageCrudHandler("mongodb://localhost:27017", "test_db")
     handler.close_connection()
-    handler.client.close.assert_called_once()
\ No newline at end of file
+    handler.client.close.assert_called_once()
+
+def test_append_message_returns_history_window(crud_handler):
+    conversation_id = str(uuid.uuid4())
+    crud_handler.create_conversation(conversation_id)
+    crud_handler.add_message(conversation_id, "First", "One")
+
+    conversation = crud_handler.append_message(conversation_id, "Second", "Two", history_limit=1)
+    assert conversation["messages"] == [{"nurse": "Second", "bot": "Two"}]
+    assert len(crud_handler.get_messages(conversation_id)) == 2
+
+def test_append_message_nonexistent_conversation(crud_handler):
+    assert crud_handler.append_message("nonexistent_id", "Hello", "Hi there!") is None
+
+def test_add_message_nonexistent_conversation(crud_handler):
+    with pytest.raises(ValueError):
+        crud_handler.add_message("nonexistent_id", "Hello", "Hi there!")
+
+def test_ensure_indexes(crud_handler):
+    indexes = crud_handler.conversations.index_information()
+    assert indexes["conversation_id_unique"]["unique"] is True
+    assert "updated_at" in indexes
+
+def test_create_duplicate_conversation(crud_handler):
+    conversation_id = str(uuid.uuid4())
+    crud_handler.create_conversation(conversation_id)
+    with pytest.raises(ValueError):
+        crud_handler.create_conversation(conversation_id)
+
+def test_allocate_conversation_ids(crud_handler):
+    conversation_ids = crud_handler.allocate_conversation_ids(5)
+    assert len(set(conversation_ids)) == 5
+    for conversation_id in conversation_ids:
+        assert crud_handler.get_conversation(conversation_id) is not None
+
+def test_get_messages_page(crud_handler):
+    conversation_id = str(uuid.uuid4())
+    crud_handler.create_conversation(conversation_id)
+    for i in range(5):
+        crud_handler.add_message(conversation_id, f"Nurse {i}", f"Bot {i}")
+
+    page = crud_handler.get_messages_page(conversation_id, start=1, limit=2)
+    assert [message["seq"] for message in page] == [1, 2]
+    next_page = crud_handler.get_messages_page(conversation_id, start=page[-1]["seq"] + 1, limit=10)
+    assert [message["nurse"] for message in next_page] == ["Nurse 3", "Nurse 4"]
+
+
+@pytest.fixture
+def collection_crud_handler():
+    handler = MessageCrudHandler("mongodb://localhost:27017", "test_db", message_storage=COLLECTION_STORAGE)
+    yield handler
+    handler.close_connection()
+
+def test_collection_storage_messages(collection_crud_handler):
+    conversation_id = str(uuid.uuid4())
+    collection_crud_handler.create_conversation(conversation_id)
+    for i in range(3):
+        collection_crud_handler.add_message(conversation_id, f"Nurse {i}", f"Bot {i}")
+
+    messages = collection_crud_handler.get_messages(conversation_id)
+    assert [message["seq"] for message in messages] == [0, 1, 2]
+    assert "messages" not in collection_crud_handler.conversations.find_one({"conversation_id": conversation_id})
+
+    recent = collection_crud_handler.get_messages(conversation_id, history_limit=2)
+    assert [message["nurse"] for message in recent] == ["Nurse 1", "Nurse 2"]
+
+def test_collection_storage_delete_removes_messages(collection_crud_handler):
+    conversation_id = str(uuid.uuid4())
+    collection_crud_handler.create_conversation(conversation_id)
+    collection_crud_handler.add_message(conversation_id, "Hello", "Hi there!")
+
+    collection_crud_handler.delete_conversation(conversation_id)
+    assert collection_crud_handler.messages.count_documents({"conversation_id": conversation_id}) == 0
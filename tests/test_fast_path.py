@@ -0,0 +1,71 @@
+import pytest
+from datetime import date
+from src.fast_path import FastPathParser, normalize_date
+
+
+@pytest.fixture
+def parser():
+    return FastPathParser(today=lambda: date(2024, 12, 1))
+
+def test_add_patient(parser):
+    result = parser.parse("Add a new patient John Doe, male, 45 years old, with diabetes.")
+    assert result == {
+        "intent": "add_patient",
+        "entities": {
+            "name": "John Doe",
+            "gender": "male",
+            "age": 45,
+            "condition": "diabetes"
+        },
+        "message": "Successfully added new patient John Doe to the system. Patient profile created with provided details."
+    }
+
+def test_assign_medication(parser):
+    result = parser.parse("Assign medication Paracetamol 500mg twice a day for John Doe.")
+    assert result == {
+        "intent": "assign_medication",
+        "entities": {
+            "patient_name": "John Doe",
+            "medication": "Paracetamol",
+            "dosage": "500mg",
+            "frequency": "twice a day"
+        },
+        "message": "Medication Paracetamol has been assigned to John Doe. Dosage: 500mg to be taken twice a day."
+    }
+
+def test_dosage_is_kept_as_typed(parser):
+    result = parser.parse("Assign medication Amoxicillin 250 mg every 8 hours for Jane Roe")
+    assert result["entities"]["dosage"] == "250 mg"
+    assert "Dosage: 250 mg to be taken every 8 hours." in result["message"]
+
+def test_schedule_followup(parser):
+    result = parser.parse("Schedule a follow-up for John Doe on December 20th.")
+    assert result == {
+        "intent": "schedule_followup",
+        "entities": {
+            "patient_name": "John Doe",
+            "date": "2024-12-20"
+        },
+        "message": "Follow-up appointment scheduled for John Doe on December 20th, 2024."
+    }
+
+@pytest.mark.parametrize("user_input", [
+    "Add a new patient John Doe, male, with diabetes.",
+    "Assign medication Paracetamol for John Doe.",
+    "Schedule a follow-up for John Doe next week.",
+    "Schedule a follow-up for John Doe on February 30th.",
+    "Add a new patient John Doe, male, 45 years old, with diabetes, and assign insulin.",
+])
+def test_incomplete_or_ambiguous_commands_fall_back(parser, user_input):
+    assert parser.parse(user_input) is None
+
+@pytest.mark.parametrize("text, expected", [
+    ("December 20th", date(2024, 12, 20)),
+    ("Dec 20, 2025", date(2025, 12, 20)),
+    ("20 December 2024", date(2024, 12, 20)),
+    ("2024-12-20", date(2024, 12, 20)),
+    ("January 3rd", date(2025, 1, 3)),
+    ("Smarch 3rd", None),
+])
+def test_normalize_date(text, expected):
+    assert normalize_date(text, today=date(2024, 12, 1)) == expected
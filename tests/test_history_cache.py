@@ -0,0 +1,132 @@
+import asyncio
+import pytest
+import uuid
+from src.async_crud_handler import AsyncMessageCrudHandler
+from src.crud_handler import COLLECTION_STORAGE, EMBEDDED_STORAGE
+from src.history_cache import CachedCrudHandler, CachedHistory, HistoryCache, compact_message, expand_message
+
+
+def history(version, count, window=None, text="x" * 100):
+    return CachedHistory(version, window, tuple((f"{text} {i}", "ok", None, None, None) for i in range(count)), None)
+
+
+def test_appends_apply_only_to_the_previous_version():
+    cache = HistoryCache()
+    cache.put("c", history(3, 2, window=2))
+    cache.append("c", ("new", "ok", 5, None, None), 4)
+    entry = cache.get("c")
+    assert entry.version == 4
+    assert [expand_message(m) for m in entry.messages][-1] == {"nurse": "new", "bot": "ok", "tokens": 5}
+    assert len(entry.messages) == 2
+    cache.append("c", ("lost", "ok", None, None, None), 6)
+    assert cache.get("c") is None
+
+def test_journal_ids_survive_the_cache():
+    stored = {"nurse": "a", "bot": "ok", "journal_id": "j:1"}
+    assert expand_message(compact_message(stored)) == stored
+
+def test_older_versions_do_not_replace_newer_ones():
+    cache = HistoryCache()
+    cache.put("c", history(5, 1))
+    cache.put("c", history(4, 3))
+    assert cache.get("c").version == 5
+
+def test_least_recently_used_histories_are_evicted_past_the_memory_limit():
+    entry_size = history(1, 10).size
+    cache = HistoryCache(max_bytes=2 * entry_size)
+    for conversation_id in ("a", "b"):
+        cache.put(conversation_id, history(1, 10))
+    cache.get("a")
+    cache.put("c", history(1, 10))
+    assert cache.get("b") is None and cache.get("a") is not None
+    assert cache.bytes == 2 * entry_size
+    cache.invalidate("a")
+    assert len(cache) == 1 and cache.bytes == entry_size
+
+def test_narrow_windows_do_not_serve_wider_reads():
+    assert history(1, 2, window=10).covers(5)
+    assert not history(1, 2, window=10).covers(20)
+    assert not history(1, 2, window=10).covers(None)
+    assert history(1, 2).covers(None)
+
+def test_collection_storage_is_not_cached():
+    crud = AsyncMessageCrudHandler("mongodb://localhost:27017", "test_db", message_storage=COLLECTION_STORAGE)
+    with pytest.raises(ValueError):
+        CachedCrudHandler(crud, HistoryCache())
+
+class MemoryConversations:
+    def __init__(self, crud):
+        self.crud = crud
+
+    async def find_one(self, query, projection=None):
+        conversation = self.crud.stored.get(query['conversation_id'])
+        return conversation and {'history_version': conversation['history_version']}
+
+
+class MemoryCrud:
+    """Embedded-storage handler stand-in counting its Mongo calls."""
+
+    message_storage = EMBEDDED_STORAGE
+
+    def __init__(self, *conversation_ids):
+        self.stored = {conversation_id: {'conversation_id': conversation_id, 'history_version': 0, 'messages': []}
+                       for conversation_id in conversation_ids}
+        self.conversations = MemoryConversations(self)
+        self.calls = []
+
+    def _window(self, conversation_id, history_limit):
+        conversation = self.stored[conversation_id]
+        messages = conversation['messages'][-history_limit:] if history_limit else list(conversation['messages'])
+        return dict(conversation, messages=messages)
+
+    async def get_conversation(self, conversation_id, history_limit=None):
+        self.calls.append('get_conversation')
+        return self._window(conversation_id, history_limit) if conversation_id in self.stored else None
+
+    async def append_message(self, conversation_id, nurse_message, bot_message, history_limit=None,
+                             token_count=None, token_ids=None):
+        self.calls.append('append_message')
+        if conversation_id not in self.stored:
+            return None
+        self.stored[conversation_id]['messages'].append({'nurse': nurse_message, 'bot': bot_message})
+        self.stored[conversation_id]['history_version'] += 1
+        return self._window(conversation_id, history_limit)
+
+    async def push_message(self, conversation_id, nurse_message, bot_message, token_count=None, token_ids=None):
+        self.calls.append('push_message')
+        self.stored[conversation_id]['messages'].append({'nurse': nurse_message, 'bot': bot_message})
+        self.stored[conversation_id]['history_version'] += 1
+        return self.stored[conversation_id]['history_version']
+
+
+def test_writes_without_a_cached_copy_read_back_the_window():
+    async def scenario():
+        crud = MemoryCrud("c")
+        cached = CachedCrudHandler(crud, HistoryCache(), history_limit=2)
+        for text in ("one", "two", "three"):
+            await cached.add_message("c", text, "ok")
+        messages = await cached.get_messages("c", 2)
+        assert [m['nurse'] for m in messages] == ["two", "three"]
+        assert crud.calls == ['append_message', 'push_message', 'push_message']
+        with pytest.raises(ValueError):
+            await cached.add_message("missing", "Hello", "ok")
+    asyncio.run(scenario())
+
+def test_writes_by_other_workers_are_not_hidden():
+    async def scenario():
+        crud = AsyncMessageCrudHandler("mongodb://localhost:27017", "test_db")
+        cached = CachedCrudHandler(crud, HistoryCache())
+        try:
+            conversation_id = str(uuid.uuid4())
+            await crud.create_conversation(conversation_id)
+            await cached.add_message(conversation_id, "Hello", "Hi there!")
+            assert [m["nurse"] for m in await cached.get_messages(conversation_id, 10)] == ["Hello"]
+            await cached.add_message(conversation_id, "Mine", "ok")
+            await crud.add_message(conversation_id, "Other worker", "ok")
+            messages = await cached.get_messages(conversation_id, 10)
+            assert [m["nurse"] for m in messages] == ["Hello", "Mine", "Other worker"]
+            await cached.delete_conversation(conversation_id)
+            assert await cached.get_conversation(conversation_id, 10) is None
+        finally:
+            await crud.close_connection()
+    asyncio.run(scenario())
@@ -0,0 +1,118 @@
+import asyncio
+import pytest
+from src.idempotency import IdempotencyKeyConflict, IdempotencyRegistry
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Work:
+    """Counts executions; each one waits until released."""
+
+    def __init__(self, fail=False):
+        self.calls = 0
+        self.fail = fail
+        self.release = None
+
+    async def __call__(self):
+        self.calls += 1
+        await self.release.wait()
+        if self.fail:
+            raise RuntimeError("generation failed")
+        return {"message": f"call {self.calls}"}
+
+
+def run(coroutine_fn):
+    return asyncio.run(coroutine_fn())
+
+def test_concurrent_duplicates_share_one_execution():
+    async def scenario():
+        registry, work = IdempotencyRegistry(), Work()
+        work.release = asyncio.Event()
+        requests = [asyncio.ensure_future(registry.run("key", "input", work)) for _ in range(3)]
+        await asyncio.sleep(0)
+        work.release.set()
+        return work, await asyncio.gather(*requests)
+
+    work, results = run(scenario)
+    assert work.calls == 1
+    assert results == [{"message": "call 1"}] * 3
+
+def test_completed_key_returns_stored_result():
+    async def scenario():
+        registry, work = IdempotencyRegistry(), Work()
+        work.release = asyncio.Event()
+        work.release.set()
+        first = await registry.run("key", "input", work)
+        second = await registry.run("key", "input", work)
+        other = await registry.run("other", "input", work)
+        return work, first, second, other
+
+    work, first, second, other = run(scenario)
+    assert first == second == {"message": "call 1"}
+    assert other == {"message": "call 2"}
+    assert work.calls == 2
+
+def test_failures_are_not_remembered():
+    async def scenario():
+        registry, work = IdempotencyRegistry(), Work(fail=True)
+        work.release = asyncio.Event()
+        work.release.set()
+        for _ in range(2):
+            with pytest.raises(RuntimeError):
+                await registry.run("key", "input", work)
+        return registry, work
+
+    registry, work = run(scenario)
+    assert work.calls == 2
+    assert len(registry) == 0
+
+def test_key_reused_with_different_input_conflicts():
+    async def scenario():
+        registry, work = IdempotencyRegistry(), Work()
+        work.release = asyncio.Event()
+        work.release.set()
+        await registry.run("key", "input", work)
+        with pytest.raises(IdempotencyKeyConflict):
+            await registry.run("key", "different input", work)
+
+    run(scenario)
+
+def test_cancelled_request_does_not_cancel_shared_work():
+    async def scenario():
+        registry, work = IdempotencyRegistry(), Work()
+        work.release = asyncio.Event()
+        first = asyncio.ensure_future(registry.run("key", "input", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        retry = asyncio.ensure_future(registry.run("key", "input", work))
+        await asyncio.sleep(0)
+        work.release.set()
+        return work, await retry
+
+    work, result = run(scenario)
+    assert work.calls == 1
+    assert result == {"message": "call 1"}
+
+def test_registry_is_bounded_and_keys_expire():
+    async def scenario():
+        clock = FakeClock()
+        registry, work = IdempotencyRegistry(max_entries=2, ttl_seconds=60, clock=clock), Work()
+        work.release = asyncio.Event()
+        work.release.set()
+        for key in ("a", "b", "c"):
+            await registry.run(key, "input", work)
+        assert len(registry) == 2
+        await registry.run("a", "input", work)
+        assert work.calls == 4
+        clock.now = 61
+        await registry.run("c", "input", work)
+        assert work.calls == 5
+        assert len(registry) == 1
+
+    run(scenario)
@@ -0,0 +1,72 @@
+import pytest
+from src.json_stream import JsonObjectExtractor, parse_json_object
+
+
+def test_extractor_completes_when_top_level_object_closes():
+    extractor = JsonObjectExtractor()
+    chunks = ['Response: ', '{"intent": "add', '_patient", "entities": {"name": ', '"John Doe"}', ', "message": "ok"}', ' trailing']
+    completed = [extractor.feed(chunk) for chunk in chunks]
+    assert completed == [False, False, False, False, True, True]
+    assert extractor.parse() == {"intent": "add_patient", "entities": {"name": "John Doe"}, "message": "ok"}
+
+def test_extractor_ignores_braces_inside_strings():
+    text = '{"message": "Use {braces} and \\"quotes\\" freely"} {"second": 1}'
+    assert parse_json_object(text) == {"message": 'Use {braces} and "quotes" freely'}
+
+def test_incomplete_or_missing_object_returns_none():
+    assert parse_json_object('{"intent": "add_patient", "entities": {') is None
+    assert parse_json_object('No JSON here') is None
+    assert parse_json_object('') is None
+
+def test_invalid_json_returns_none():
+    assert parse_json_object('{"intent": add_patient}') is None
+
+
+class CharTokenizer:
+    """Tokenizer stand-in where every token id is a character code."""
+
+    def decode(self, token_ids, skip_special_tokens=False):
+        return ''.join(chr(token_id) for token_id in token_ids)
+
+def test_stopping_criteria_stops_each_row_when_its_object_closes():
+    torch = pytest.importorskip("torch")
+    from src.stopping_criteria import BraceBalancedStoppingCriteria
+
+    rows = ['{"a": 1}  ', '{"b": {"c": "}"}}']
+    criteria = BraceBalancedStoppingCriteria(CharTokenizer(), batch_size=2)
+    length = max(len(row) for row in rows)
+    input_ids = torch.tensor([[ord(char) for char in row.ljust(length)] for row in rows])
+    stopped_at = [None, None]
+    for step in range(1, length + 1):
+        done = criteria(input_ids[:, :step], scores=None)
+        for row, finished in enumerate(done.tolist()):
+            if finished and stopped_at[row] is None:
+                stopped_at[row] = step
+    assert stopped_at == [8, 17]
+    assert criteria.results() == [{"a": 1}, {"b": {"c": "}"}}]
+
+class ByteTokenizer:
+    """Byte-level tokenizer stand-in: every token id is one UTF-8 byte."""
+
+    def decode(self, token_ids, skip_special_tokens=False):
+        return bytes(token_ids).decode('utf-8', errors='replace')
+
+def test_stopping_criteria_keeps_characters_split_across_tokens():
+    torch = pytest.importorskip("torch")
+    from src.stopping_criteria import BraceBalancedStoppingCriteria
+
+    output = list('{"name": "José Müller"}'.encode())
+    criteria = BraceBalancedStoppingCriteria(ByteTokenizer())
+    for step in range(1, len(output) + 1):
+        criteria(torch.tensor([output[:step]]), scores=None)
+    assert criteria.results() == [{"name": "José Müller"}]
+
+def test_cancelled_stopping_criteria_stop_every_row():
+    torch = pytest.importorskip("torch")
+    from src.stopping_criteria import BraceBalancedStoppingCriteria
+
+    criteria = BraceBalancedStoppingCriteria(CharTokenizer(), batch_size=2)
+    input_ids = torch.tensor([[ord('{')], [ord('{')]])
+    assert criteria(input_ids, scores=None).tolist() == [False, False]
+    criteria.cancelled = True
+    assert criteria(input_ids, scores=None).tolist() == [True, True]
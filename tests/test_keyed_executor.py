@@ -0,0 +1,94 @@
+import asyncio
+import pytest
+from src.keyed_executor import KeyQueueFull, KeyedExecutor
+
+
+class Turn:
+    """Records when it starts and finishes; finishes once released."""
+
+    def __init__(self, log, name):
+        self.log = log
+        self.name = name
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.log.append(f"start {self.name}")
+        await self.release.wait()
+        self.log.append(f"end {self.name}")
+        return self.name
+
+
+def test_turns_of_one_key_run_in_order():
+    async def scenario():
+        executor, log = KeyedExecutor(), []
+        turns = [Turn(log, i) for i in range(3)]
+        tasks = [asyncio.ensure_future(executor.run("conversation", turn)) for turn in turns]
+        await asyncio.sleep(0)
+        for turn in reversed(turns):
+            turn.release.set()
+        results = await asyncio.gather(*tasks)
+        return executor, log, results
+
+    executor, log, results = asyncio.run(scenario())
+    assert results == [0, 1, 2]
+    assert log == ["start 0", "end 0", "start 1", "end 1", "start 2", "end 2"]
+    assert len(executor) == 0
+
+def test_different_keys_run_concurrently():
+    async def scenario():
+        executor, log = KeyedExecutor(), []
+        turns = [Turn(log, key) for key in ("a", "b")]
+        tasks = [asyncio.ensure_future(executor.run(turn.name, turn)) for turn in turns]
+        await asyncio.sleep(0)
+        started = list(log)
+        for turn in turns:
+            turn.release.set()
+        await asyncio.gather(*tasks)
+        return started
+
+    assert asyncio.run(scenario()) == ["start a", "start b"]
+
+def test_max_concurrency_bounds_running_turns():
+    async def scenario():
+        executor, log = KeyedExecutor(max_concurrency=1), []
+        turns = [Turn(log, key) for key in ("a", "b")]
+        tasks = [asyncio.ensure_future(executor.run(turn.name, turn)) for turn in turns]
+        await asyncio.sleep(0)
+        started = list(log)
+        turns[0].release.set()
+        turns[1].release.set()
+        await asyncio.gather(*tasks)
+        return started
+
+    assert asyncio.run(scenario()) == ["start a"]
+
+def test_full_key_queue_is_rejected():
+    async def scenario():
+        executor, log = KeyedExecutor(max_pending_per_key=2), []
+        turns = [Turn(log, i) for i in range(2)]
+        tasks = [asyncio.ensure_future(executor.run("conversation", turn)) for turn in turns]
+        await asyncio.sleep(0)
+        with pytest.raises(KeyQueueFull):
+            await executor.run("conversation", Turn(log, 2))
+        for turn in turns:
+            turn.release.set()
+        await asyncio.gather(*tasks)
+        return executor
+
+    assert len(asyncio.run(scenario())) == 0
+
+def test_failed_turn_releases_the_key():
+    async def failing():
+        raise RuntimeError("generation failed")
+
+    async def scenario():
+        executor = KeyedExecutor()
+        with pytest.raises(RuntimeError):
+            await executor.run("conversation", failing)
+        assert len(executor) == 0
+        log = []
+        turn = Turn(log, "next")
+        turn.release.set()
+        return await executor.run("conversation", turn)
+
+    assert asyncio.run(scenario()) == "next"
@@ -0,0 +1,148 @@
+import asyncio
+import random
+import threading
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from src.llm_backend import FakeLLMBackend, RequestPolicy, iterate_in_executor, lognormal_latency
+from src.prompts import build_prompt, static_prompt_prefix
+
+
+class Attempts:
+    """Async call whose n-th attempt takes durations[n] seconds and raises errors[n] if set."""
+
+    def __init__(self, durations, errors=()):
+        self.durations = list(durations)
+        self.errors = list(errors)
+        self.started = 0
+        self.running = 0
+        self.max_running = 0
+
+    async def __call__(self):
+        attempt = self.started
+        self.started += 1
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(self.durations[attempt])
+            if attempt < len(self.errors) and self.errors[attempt]:
+                raise self.errors[attempt]
+            return attempt
+        finally:
+            self.running -= 1
+
+
+def test_transient_errors_are_retried():
+    attempts = Attempts([0, 0, 0], errors=[ConnectionError(), ConnectionError()])
+    policy = RequestPolicy(max_retries=2, backoff_base_seconds=0.001)
+    assert asyncio.run(policy.call(attempts)) == 2
+
+def test_retries_are_bounded():
+    attempts = Attempts([0, 0], errors=[ConnectionError(), ConnectionError()])
+    policy = RequestPolicy(max_retries=1, backoff_base_seconds=0.001)
+    with pytest.raises(ConnectionError):
+        asyncio.run(policy.call(attempts))
+    assert attempts.started == 2
+
+def test_other_errors_are_not_retried():
+    attempts = Attempts([0, 0], errors=[ValueError()])
+    with pytest.raises(ValueError):
+        asyncio.run(RequestPolicy(max_retries=3).call(attempts))
+    assert attempts.started == 1
+
+def test_slow_attempts_time_out_and_retry():
+    attempts = Attempts([1, 0])
+    policy = RequestPolicy(timeout_seconds=0.02, max_retries=1, backoff_base_seconds=0.001)
+    assert asyncio.run(policy.call(attempts)) == 1
+
+def test_slow_attempt_is_hedged():
+    attempts = Attempts([1, 0.01])
+    policy = RequestPolicy(hedge_after_seconds=0.02)
+    assert asyncio.run(policy.call(attempts)) == 1
+    assert attempts.started == 2
+
+def test_fast_attempt_is_not_hedged():
+    attempts = Attempts([0, 0])
+    assert asyncio.run(RequestPolicy(hedge_after_seconds=0.5).call(attempts)) == 0
+    assert attempts.started == 1
+
+def test_hedge_survives_failure_of_the_first_attempt():
+    attempts = Attempts([0.05, 0.1], errors=[ConnectionError()])
+    policy = RequestPolicy(hedge_after_seconds=0.01, max_retries=0)
+    assert asyncio.run(policy.call(attempts)) == 1
+
+def test_concurrency_is_bounded():
+    attempts = Attempts([0.01] * 8)
+    policy = RequestPolicy(max_concurrency=3)
+
+    async def scenario():
+        await asyncio.gather(*(policy.call(attempts) for _ in range(8)))
+
+    asyncio.run(scenario())
+    assert attempts.max_running == 3
+
+def test_backoff_is_jittered_below_an_exponential_cap():
+    policy = RequestPolicy(backoff_base_seconds=1, backoff_cap_seconds=5, rng=random.Random(0))
+    delays = [policy.backoff(retry) for retry in range(6)]
+    assert all(0 <= delay <= min(5, 2 ** retry) for retry, delay in enumerate(delays))
+    assert len(set(delays)) == len(delays)
+
+def test_fake_backend_recovers_from_simulated_failures():
+    backend = FakeLLMBackend(latency=lognormal_latency(0.001, rng=random.Random(1)), failure_rate=0.5,
+                             policy=RequestPolicy(max_retries=10, backoff_base_seconds=0.001),
+                             rng=random.Random(1))
+    response = asyncio.run(backend.arun(messages=[], prompt="Add a new patient"))
+    assert response["message"] == "Received: Add a new patient"
+    assert backend.requests > 1
+
+def test_fake_backend_stream_forms_the_response():
+    backend = FakeLLMBackend()
+
+    async def collect():
+        return ''.join([chunk async for chunk in backend.astream(prompt="hello")])
+
+    assert ''.join(backend.stream(prompt="hello")) == asyncio.run(collect())
+
+def test_iterated_items_arrive_in_order():
+    async def scenario():
+        return [item async for item in iterate_in_executor(None, iter, range(100))]
+    assert asyncio.run(scenario()) == list(range(100))
+
+def test_iterator_errors_reach_the_consumer_after_earlier_items():
+    def failing():
+        yield "first"
+        raise RuntimeError("generation failed")
+
+    async def scenario():
+        received = []
+        with pytest.raises(RuntimeError, match="generation failed"):
+            async for item in iterate_in_executor(None, failing):
+                received.append(item)
+        return received
+    assert asyncio.run(scenario()) == ["first"]
+
+def test_consumer_exit_closes_the_iterator():
+    closed = threading.Event()
+
+    def endless():
+        try:
+            while True:
+                yield "."
+        finally:
+            closed.set()
+
+    async def scenario():
+        items = iterate_in_executor(executor, endless)
+        async for item in items:
+            break
+        await items.aclose()
+
+    # Leaving the block waits for the producer thread, which only ends once the iterator is closed.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        asyncio.run(scenario())
+        assert closed.wait(5)
+
+def test_build_prompt_keeps_static_prefix_first():
+    prefix, suffix = build_prompt([{"nurse": "Add a new patient", "bot": "Added."}], "Schedule a follow-up",
+                                  summary="John Doe was admitted.")
+    assert prefix == static_prompt_prefix
+    assert suffix.index("John Doe was admitted.") < suffix.index("Add a new patient") < suffix.index("Schedule a follow-up")
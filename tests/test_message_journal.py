@@ -0,0 +1,134 @@
+import asyncio
+import os
+import uuid
+from src.async_crud_handler import AsyncMessageCrudHandler
+from src.message_journal import MessageJournal, WriteBehindCrudHandler, journal_update, merge_unflushed
+
+
+def entry(journal, conversation_id, nurse, bot="ok"):
+    return {"journal_id": journal.next_id(), "conversation_id": conversation_id, "nurse": nurse, "bot": bot}
+
+
+def test_entries_of_a_closed_journal_are_recovered(tmp_path):
+    async def scenario():
+        journal = MessageJournal(str(tmp_path), fsync=False)
+        entries = [entry(journal, "conv123", f"message {i}") for i in range(5)]
+        await asyncio.gather(*[journal.append(e) for e in entries])
+        journal.close()
+        return entries
+
+    entries = asyncio.run(scenario())
+    recovering = MessageJournal(str(tmp_path), fsync=False)
+    [(path, recovered)] = list(recovering.recover())
+    assert sorted(recovered, key=lambda e: e["nurse"]) == entries
+    recovering.discard(path)
+    assert list(recovering.recover()) == []
+
+def test_journals_of_running_processes_are_not_recovered(tmp_path):
+    running = MessageJournal(str(tmp_path), fsync=False)
+    assert list(MessageJournal(str(tmp_path), fsync=False).recover()) == []
+    running.close()
+
+def test_torn_last_line_is_skipped(tmp_path):
+    journal = MessageJournal(str(tmp_path), fsync=False)
+    asyncio.run(journal.append(entry(journal, "conv123", "complete")))
+    with open(journal.path, "ab") as file:
+        file.write(b'{"journal_id": "torn')
+    journal.close()
+    [(_, recovered)] = list(MessageJournal(str(tmp_path), fsync=False).recover())
+    assert [e["nurse"] for e in recovered] == ["complete"]
+
+def test_merge_unflushed_skips_turns_already_in_mongo():
+    stored = [{"nurse": "a", "bot": "ok", "journal_id": "j:1"}]
+    unflushed = [{"journal_id": "j:1", "conversation_id": "c", "nurse": "a", "bot": "ok"},
+                 {"journal_id": "j:2", "conversation_id": "c", "nurse": "b", "bot": "ok"}]
+    assert [m["nurse"] for m in merge_unflushed(stored, unflushed)] == ["a", "b"]
+    assert [m["nurse"] for m in merge_unflushed(stored, unflushed, history_limit=1)] == ["b"]
+
+def test_replayed_updates_skip_conversations_that_hold_the_turn():
+    update = journal_update({"journal_id": "j:7", "conversation_id": "c", "nurse": "a", "bot": "ok"})
+    assert update._filter == {"conversation_id": "c", "messages.journal_id": {"$ne": "j:7"}}
+    assert update._doc["$push"]["messages"] == {"nurse": "a", "bot": "ok", "journal_id": "j:7"}
+
+def test_unflushed_turns_are_read_and_then_flushed(tmp_path):
+    async def scenario():
+        crud = AsyncMessageCrudHandler("mongodb://localhost:27017", "test_db")
+        handler = WriteBehindCrudHandler(crud, MessageJournal(str(tmp_path)), flush_interval_seconds=60)
+        await handler.start()
+        try:
+            conversation_id = str(uuid.uuid4())
+            await crud.create_conversation(conversation_id)
+            await handler.add_message(conversation_id, "Hello", "Hi there!")
+            assert await crud.get_messages(conversation_id) == []
+            assert [m["nurse"] for m in await handler.get_messages(conversation_id)] == ["Hello"]
+            await handler.flush()
+            assert [m["nurse"] for m in await crud.get_messages(conversation_id)] == ["Hello"]
+        finally:
+            await handler.close_connection()
+    asyncio.run(scenario())
+
+def test_journals_are_locked_before_they_can_be_recovered(tmp_path):
+    abandoned = tmp_path / "journal-1-dead.log.tmp"
+    abandoned.write_bytes(b"")
+    journal = MessageJournal(str(tmp_path), fsync=False)
+    assert list(MessageJournal(str(tmp_path), fsync=False).recover()) == []
+    assert not list(tmp_path.glob("*.tmp"))
+    assert os.path.exists(journal.path)
+    journal.close()
+
+class FakeConversations:
+    def __init__(self):
+        self.writes = []
+        self.available = True
+
+    async def count_documents(self, query, limit=None):
+        return 1
+
+    async def bulk_write(self, requests, ordered=True):
+        if not self.available:
+            raise ConnectionError("Mongo is down")
+        self.writes.extend(requests)
+
+
+class FakeCrud:
+    message_storage = "embedded"
+
+    def __init__(self):
+        self.conversations = FakeConversations()
+
+    async def close_connection(self):
+        pass
+
+
+def test_flushed_segments_are_deleted(tmp_path):
+    async def scenario():
+        journal = MessageJournal(str(tmp_path), fsync=False)
+        handler = WriteBehindCrudHandler(FakeCrud(), journal, flush_interval_seconds=60)
+        await handler.start()
+        for round in range(3):
+            await handler.add_message("conv123", f"message {round}", "ok")
+            await handler.flush()
+            assert journal.segments == 1
+            assert len(list(tmp_path.glob("journal-*.log"))) == 1
+        assert len(handler.crud.conversations.writes) == 3
+        await handler.close_connection()
+        assert not list(tmp_path.glob("journal-*"))
+    asyncio.run(scenario())
+
+def test_turns_wait_while_too_many_are_pending(tmp_path):
+    async def scenario():
+        crud = FakeCrud()
+        crud.conversations.available = False
+        handler = WriteBehindCrudHandler(crud, MessageJournal(str(tmp_path), fsync=False),
+                                         flush_interval_seconds=0.01, max_pending_entries=2)
+        await handler.start()
+        await handler.add_message("conv123", "first", "ok")
+        await handler.add_message("conv123", "second", "ok")
+        waiting = asyncio.ensure_future(handler.add_message("conv123", "third", "ok"))
+        await asyncio.sleep(0.05)
+        assert not waiting.done() and len(handler) == 2
+        crud.conversations.available = True
+        assert await asyncio.wait_for(waiting, 1)
+        await handler.close_connection()
+        assert [w._doc["$push"]["messages"]["nurse"] for w in crud.conversations.writes] == ["first", "second", "third"]
+    asyncio.run(scenario())
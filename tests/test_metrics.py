@@ -0,0 +1,45 @@
+import asyncio
+import pytest
+from src.metrics import MetricsRegistry, timed
+
+
+def test_render_uses_the_prometheus_text_format():
+    registry = MetricsRegistry()
+    registry.counter("turns_total", "Turns served.").inc(3)
+    registry.gauge("queue_depth", "Waiting turns.").set(2)
+    histogram = registry.histogram("turn_seconds", "Turn duration.", buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 5):
+        histogram.observe(value)
+    assert registry.render() == "\n".join([
+        "# HELP queue_depth Waiting turns.",
+        "# TYPE queue_depth gauge",
+        "queue_depth 2",
+        "# HELP turn_seconds Turn duration.",
+        "# TYPE turn_seconds histogram",
+        'turn_seconds_bucket{le="0.1"} 2',
+        'turn_seconds_bucket{le="1.0"} 3',
+        'turn_seconds_bucket{le="+Inf"} 4',
+        "turn_seconds_sum 5.65",
+        "turn_seconds_count 4",
+        "# HELP turns_total Turns served.",
+        "# TYPE turns_total counter",
+        "turns_total 3",
+    ]) + "\n"
+
+def test_timed_observes_functions_and_coroutines_even_when_they_fail():
+    histogram = MetricsRegistry().histogram("call_seconds", "Call duration.")
+
+    @timed(histogram)
+    def fail():
+        raise ValueError("boom")
+
+    @timed(histogram)
+    async def answer():
+        return 42
+
+    with pytest.raises(ValueError):
+        fail()
+    assert asyncio.run(answer()) == 42
+    with histogram.time():
+        pass
+    assert histogram.count == 3
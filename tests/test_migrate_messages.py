@@ -0,0 +1,41 @@
+from types import SimpleNamespace
+from src.migrate_messages import migrate_conversations
+
+
+class MemoryCollection:
+    """Collection stand-in recording the writes the migration makes."""
+
+    def __init__(self, documents=()):
+        self.documents = list(documents)
+        self.inserted = []
+        self.indexes = {}
+
+    def create_index(self, keys, **options):
+        self.indexes[options['name']] = dict(options, key=keys)
+
+    def index_information(self):
+        return self.indexes
+
+    def find(self, query, projection=None, batch_size=None):
+        return iter(self.documents)
+
+    def insert_many(self, documents, ordered=True):
+        self.inserted.extend(documents)
+
+    def bulk_write(self, requests, ordered=True):
+        return SimpleNamespace(modified_count=len(requests))
+
+
+def test_stored_token_counts_and_ids_are_migrated():
+    token_ids = {"tokenizer": "llama", "ids": [1, 2, 3]}
+    conversations = MemoryCollection([{"_id": 1, "conversation_id": "conv123", "messages": [
+        {"nurse": "Hello", "bot": "Hi", "tokens": 3, "token_ids": token_ids},
+        {"nurse": "Old", "bot": "pair"}]}])
+    db = SimpleNamespace(conversations=conversations, messages=MemoryCollection())
+
+    stats = migrate_conversations(db)
+
+    assert stats == {"conversations": 1, "messages": 2, "skipped": 0}
+    first, second = db.messages.inserted
+    assert (first["seq"], first["tokens"], first["token_ids"]) == (0, 3, token_ids)
+    assert second["seq"] == 1 and "tokens" not in second and "token_ids" not in second
@@ -0,0 +1,172 @@
+import asyncio
+import threading
+import time
+import pytest
+from src.llm_backend import FakeLLMBackend, LLMBackend
+from src.model_server import ModelServer, RemoteBackendError, RemoteLLMBackend
+
+
+class StubRunner(LLMBackend):
+    """Synchronous stand-in for the local model."""
+
+    history_token_budget = 64
+    summary_token_budget = 16
+
+    def __init__(self):
+        self.threads = set()
+        self.stream_closed = threading.Event()
+
+    def count_tokens(self, text):
+        self.threads.add(threading.current_thread().name)
+        return len(text.split())
+
+    def run(self, messages=None, prompt='', summary=''):
+        self.threads.add(threading.current_thread().name)
+        if prompt == "fail":
+            raise RuntimeError("model crashed")
+        return {"intent": "stub", "message": f"{prompt} after {len(messages)} turns"}
+
+    def stream(self, messages=None, prompt='', summary=''):
+        if prompt != "endless":
+            yield from ['{"intent": "stub", ', f'"message": "{prompt}"}}']
+            return
+        try:
+            while True:
+                time.sleep(0.01)
+                yield "."
+        finally:
+            self.stream_closed.set()
+
+    def summarize(self, summary, messages):
+        return f"{summary} +{len(messages)}"
+
+
+@pytest.fixture
+def serve(tmp_path):
+    """Run a ModelServer for `backend` on its own event loop thread and return the socket path."""
+    loops = []
+
+    def start(backend):
+        loop = asyncio.new_event_loop()
+        server = ModelServer(backend, socket_path=str(tmp_path / "model.sock"), workers=4)
+        loop.run_until_complete(server.start())
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        loops.append((loop, server))
+        return server.socket_path
+
+    yield start
+    for loop, server in loops:
+        asyncio.run_coroutine_threadsafe(server.close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+def test_blocking_calls(serve):
+    remote = RemoteLLMBackend(serve(StubRunner()), connect_timeout_seconds=5)
+    assert (remote.history_token_budget, remote.summary_token_budget) == (64, 16)
+    assert remote.count_tokens("three word text") == 3
+    assert remote.run(messages=[{"nurse": "a", "bot": "b"}], prompt="hi") == {"intent": "stub", "message": "hi after 1 turns"}
+    assert ''.join(remote.stream(prompt="hi")) == '{"intent": "stub", "message": "hi"}'
+    assert remote.summarize("s", [{"nurse": "a", "bot": "b"}]) == "s +1"
+
+def test_concurrent_async_calls_share_one_connection(serve):
+    backend = StubRunner()
+    remote = RemoteLLMBackend(serve(backend), connect_timeout_seconds=5)
+
+    async def scenario():
+        responses = await asyncio.gather(*(remote.arun(messages=[], prompt=str(i)) for i in range(8)))
+        chunks = [chunk async for chunk in remote.astream(prompt="streamed")]
+        summary = await remote.asummarize("", [])
+        await remote.aclose()
+        return responses, chunks, summary
+
+    responses, chunks, summary = asyncio.run(scenario())
+    assert [response["message"] for response in responses] == [f"{i} after 0 turns" for i in range(8)]
+    assert ''.join(chunks) == '{"intent": "stub", "message": "streamed"}'
+    assert summary == " +0"
+    # Synchronous backends run on the server's thread pool.
+    assert all(name.startswith("model-server") for name in backend.threads)
+
+def test_async_token_calls_do_not_use_the_blocking_connection(serve):
+    backend = StubRunner()
+    remote = RemoteLLMBackend(serve(backend), connect_timeout_seconds=5)
+
+    async def scenario():
+        # Held as if a blocking call were in progress on another thread.
+        with remote._sock_lock:
+            count = await asyncio.wait_for(remote.acount_tokens("three word text"), 5)
+            token_ids = await asyncio.wait_for(remote.aencode_message("a", "b"), 5)
+        await remote.aclose()
+        return count, token_ids
+
+    assert asyncio.run(scenario()) == (3, None)
+    # Tokenizing runs on the server's thread pool, not its event loop.
+    assert backend.threads and all(name.startswith("model-server") for name in backend.threads)
+
+def test_abandoned_streams_are_cancelled_on_the_server(serve):
+    backend = StubRunner()
+    remote = RemoteLLMBackend(serve(backend), connect_timeout_seconds=5)
+
+    async def scenario():
+        async for chunk in remote.astream(prompt="endless"):
+            break
+        assert await asyncio.get_running_loop().run_in_executor(None, backend.stream_closed.wait, 5)
+        # The connection is still usable afterwards.
+        response = await remote.arun(prompt="ok")
+        await remote.aclose()
+        return response
+
+    assert asyncio.run(scenario())["message"] == "ok after 0 turns"
+
+def test_abandoned_blocking_streams_are_cancelled_on_the_server(serve):
+    backend = StubRunner()
+    remote = RemoteLLMBackend(serve(backend), connect_timeout_seconds=5)
+    stream = remote.stream(prompt="endless")
+    next(stream)
+    stream.close()
+    assert backend.stream_closed.wait(5)
+    assert remote.count_tokens("still works") == 2
+
+def test_server_errors_are_raised_to_the_caller(serve):
+    remote = RemoteLLMBackend(serve(StubRunner()), connect_timeout_seconds=5)
+    with pytest.raises(RemoteBackendError, match="model crashed"):
+        remote.run(prompt="fail")
+
+    async def scenario():
+        with pytest.raises(RemoteBackendError, match="model crashed"):
+            await remote.arun(prompt="fail")
+        # The connection stays usable after a failed request.
+        response = await remote.arun(prompt="ok")
+        await remote.aclose()
+        return response
+
+    assert asyncio.run(scenario())["message"] == "ok after 0 turns"
+
+def test_async_backend_is_served(serve):
+    remote = RemoteLLMBackend(serve(FakeLLMBackend()), connect_timeout_seconds=5)
+
+    async def scenario():
+        response = await remote.arun(prompt="hello")
+        await remote.aclose()
+        return response
+
+    assert asyncio.run(scenario()) == {"intent": "echo", "entities": {}, "message": "Received: hello"}
+
+def test_unreachable_server(tmp_path):
+    with pytest.raises(ConnectionError):
+        RemoteLLMBackend(str(tmp_path / "missing.sock"), connect_timeout_seconds=0)
+
+def test_a_live_server_socket_is_not_taken_over(serve, tmp_path):
+    socket_path = serve(StubRunner())
+    with pytest.raises(RuntimeError, match="Another model server"):
+        asyncio.run(ModelServer(StubRunner(), socket_path=socket_path).start())
+    assert RemoteLLMBackend(socket_path, connect_timeout_seconds=5).count_tokens("still served") == 2
+
+def test_stale_socket_files_are_replaced(tmp_path):
+    socket_path = str(tmp_path / "stale.sock")
+    open(socket_path, "w").close()
+
+    async def scenario():
+        server = ModelServer(StubRunner(), socket_path=socket_path)
+        await server.start()
+        await server.close()
+
+    asyncio.run(scenario())
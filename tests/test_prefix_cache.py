@@ -0,0 +1,48 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+from src.prefix_cache import PrefixKVCache
+
+
+@pytest.fixture
+def tiny_model():
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(vocab_size=64, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                                      num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=128)
+    return transformers.LlamaForCausalLM(config).eval()
+
+def test_generation_with_prefix_cache_matches_full_prefill(tiny_model):
+    prefix_ids = torch.tensor([[1, 5, 9, 13, 17, 21, 25]])
+    suffix_ids = torch.tensor([[30, 31, 32]])
+    cache = PrefixKVCache(tiny_model, prefix_ids)
+
+    expected = tiny_model.generate(torch.cat([prefix_ids, suffix_ids], dim=1), max_new_tokens=8,
+                                   do_sample=False, pad_token_id=0)
+    cached = tiny_model.generate(**cache.build_inputs(suffix_ids), max_new_tokens=8, do_sample=False, pad_token_id=0)
+    assert torch.equal(cached, expected)
+
+def test_prefix_cache_is_reusable(tiny_model):
+    prefix_ids = torch.tensor([[1, 5, 9, 13]])
+    cache = PrefixKVCache(tiny_model, prefix_ids)
+    before = [tensor.clone() for layer in cache.past_key_values for tensor in layer]
+
+    first = tiny_model.generate(**cache.build_inputs(torch.tensor([[40, 41]])), max_new_tokens=4, do_sample=False, pad_token_id=0)
+    tiny_model.generate(**cache.build_inputs(torch.tensor([[50]])), max_new_tokens=4, do_sample=False, pad_token_id=0)
+    again = tiny_model.generate(**cache.build_inputs(torch.tensor([[40, 41]])), max_new_tokens=4, do_sample=False, pad_token_id=0)
+
+    assert torch.equal(first, again)
+    after = [tensor for layer in cache.past_key_values for tensor in layer]
+    assert all(torch.equal(a, b) for a, b in zip(before, after))
+
+def test_batched_generation_matches_individual_generation(tiny_model):
+    prefix_ids = torch.tensor([[1, 5, 9, 13, 17]])
+    cache = PrefixKVCache(tiny_model, prefix_ids)
+    suffixes = [torch.tensor([[30, 31, 32, 33]]), torch.tensor([[40]]), torch.tensor([[50, 51]])]
+
+    batched = tiny_model.generate(**cache.build_batch_inputs(suffixes, pad_token_id=0), max_new_tokens=6,
+                                  do_sample=False, pad_token_id=0)
+    for row, suffix in zip(batched, suffixes):
+        single = tiny_model.generate(**cache.build_inputs(suffix), max_new_tokens=6, do_sample=False, pad_token_id=0)
+        assert torch.equal(row[-6:], single[0, -6:])
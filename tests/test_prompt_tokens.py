@@ -0,0 +1,61 @@
+from src.prompt_tokens import PromptTokenCache
+from src.prompts import build_prompt
+
+
+class CharTokenizer:
+    """One token per character, so ids decode back to the exact text."""
+
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, text):
+        self.encoded.append(text)
+        return [ord(c) for c in text]
+
+    @staticmethod
+    def decode(ids):
+        return ''.join(chr(i) for i in ids)
+
+
+MESSAGES = [{"nurse": "Add patient John Doe", "bot": "Added John Doe."},
+            {"nurse": "Assign Paracetamol to John Doe", "bot": "Assigned."}]
+
+
+def test_suffix_ids_decode_to_the_prompt_suffix():
+    tokenizer = CharTokenizer()
+    cache = PromptTokenCache(tokenizer.encode)
+    for messages, summary in [(MESSAGES, ''), (MESSAGES, 'John Doe was added.'), ([], ''), ([], 'Older turns.')]:
+        ids = cache.suffix_ids(messages, "Schedule a follow-up", summary)
+        assert tokenizer.decode(ids) == build_prompt(messages, "Schedule a follow-up", summary)[1]
+
+def test_only_the_new_input_is_encoded_on_later_turns():
+    tokenizer = CharTokenizer()
+    cache = PromptTokenCache(tokenizer.encode)
+    cache.suffix_ids(MESSAGES, "first")
+    tokenizer.encoded.clear()
+    cache.suffix_ids(MESSAGES, "second")
+    assert tokenizer.encoded == ["second"]
+
+def test_stored_ids_are_used_only_for_the_same_tokenizer():
+    tokenizer = CharTokenizer()
+    cache = PromptTokenCache(tokenizer.encode, tokenizer_id="llama")
+    stored = dict(MESSAGES[0], token_ids={"tokenizer": "llama", "ids": [1, 2, 3]})
+    assert cache.pair_ids(stored) == [1, 2, 3]
+    other = dict(MESSAGES[0], token_ids={"tokenizer": "gpt2", "ids": [1, 2, 3]})
+    assert tokenizer.decode(cache.pair_ids(other)) == "NURSE: Add patient John Doe\nBOT: Added John Doe."
+
+def test_stored_ids_round_trip():
+    tokenizer = CharTokenizer()
+    cache = PromptTokenCache(tokenizer.encode, tokenizer_id="llama")
+    message = {"nurse": "Hello", "bot": "Hi", "token_ids": cache.stored_ids("Hello", "Hi")}
+    tokenizer.encoded.clear()
+    fresh = PromptTokenCache(tokenizer.encode, tokenizer_id="llama")
+    tokenizer.encoded.clear()
+    assert tokenizer.decode(fresh.pair_ids(message)) == "NURSE: Hello\nBOT: Hi"
+    assert tokenizer.encoded == []
+
+def test_cache_is_bounded():
+    cache = PromptTokenCache(CharTokenizer().encode, cache_size=2)
+    for i in range(5):
+        cache.pair_ids({"nurse": f"message {i}", "bot": "ok"})
+    assert len(cache) == 2
@@ -0,0 +1,89 @@
+import json
+import pytest
+from src.response_cache import CachedLLMRunner, InMemoryCacheBackend, cache_key
+
+
+class FakeRunner:
+    history_token_budget = 128
+
+    def __init__(self):
+        self.calls = 0
+
+    def run(self, messages=None, prompt='', summary=''):
+        self.calls += 1
+        if prompt == 'invalid':
+            return None
+        return {"intent": "add_patient", "message": f"{prompt} ({len(messages)} turns)"}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+HISTORY = [{"nurse": "Add a new patient John Doe.", "bot": "Added John Doe.", "tokens": 12}]
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+@pytest.fixture
+def runner(clock):
+    return CachedLLMRunner(FakeRunner(), InMemoryCacheBackend(max_entries=2, ttl_seconds=60, clock=clock))
+
+def test_repeated_prompt_is_served_from_cache(runner):
+    first = runner.run(messages=HISTORY, prompt="Schedule a follow-up for John Doe.")
+    second = runner.run(messages=HISTORY, prompt="  Schedule a follow-up   for John Doe ")
+    assert first == second
+    assert runner.runner.calls == 1
+
+def test_cached_response_is_a_copy(runner):
+    runner.run(messages=HISTORY, prompt="hello")["message"] = "changed"
+    assert runner.run(messages=HISTORY, prompt="hello")["message"] == "hello (1 turns)"
+
+def test_key_depends_on_history_and_summary():
+    assert cache_key("hello", HISTORY) != cache_key("hello", [])
+    assert cache_key("hello", HISTORY) != cache_key("hello", HISTORY, summary="John Doe was admitted.")
+    assert cache_key("hello", HISTORY) == cache_key("hello.", [dict(HISTORY[0], tokens=99)])
+    assert cache_key("hello") != cache_key("Hello")
+
+def test_invalid_responses_are_not_cached(runner):
+    assert runner.run(messages=[], prompt="invalid") is None
+    assert runner.run(messages=[], prompt="invalid") is None
+    assert runner.runner.calls == 2
+
+def test_entries_expire(runner, clock):
+    runner.run(messages=[], prompt="hello")
+    clock.now = 61
+    runner.run(messages=[], prompt="hello")
+    assert runner.runner.calls == 2
+
+def test_least_recently_used_entry_is_evicted(runner):
+    runner.run(messages=[], prompt="a")
+    runner.run(messages=[], prompt="b")
+    runner.run(messages=[], prompt="a")
+    evictions = CachedLLMRunner.stats()["evictions"]
+    runner.run(messages=[], prompt="c")
+    assert CachedLLMRunner.stats()["evictions"] == evictions + 1
+    assert len(runner.backend) == 2
+    runner.run(messages=[], prompt="a")
+    assert runner.runner.calls == 3
+
+def test_other_attributes_are_forwarded(runner):
+    assert runner.history_token_budget == 128
+
+class StreamingRunner(FakeRunner):
+    def stream(self, messages=None, prompt='', summary=''):
+        self.calls += 1
+        yield '{"intent": "add_patient", '
+        yield f'"message": "{prompt}"}}'
+
+def test_streamed_response_is_cached():
+    runner = CachedLLMRunner(StreamingRunner())
+    first = ''.join(runner.stream(messages=[], prompt="stream me"))
+    second = ''.join(runner.stream(messages=[], prompt="stream me"))
+    assert json.loads(first) == json.loads(second) == {"intent": "add_patient", "message": "stream me"}
+    assert runner.runner.calls == 1
@@ -0,0 +1,63 @@
+import asyncio
+from src.context_builder import ContextBuilder
+from src.summarizer import ConversationSummarizer
+
+
+class InMemoryConversation:
+    """Stand-in for AsyncMessageCrudHandler holding a single conversation."""
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.summary = None
+
+    async def get_summary_state(self, conversation_id):
+        state = {'message_count': len(self.messages)}
+        if self.summary:
+            state['summary'] = self.summary
+        return state
+
+    async def get_messages(self, conversation_id, history_limit=None):
+        return self.messages[-history_limit:] if history_limit else self.messages
+
+    async def get_messages_page(self, conversation_id, start=0, limit=50):
+        return [dict(message, seq=start + i) for i, message in enumerate(self.messages[start:start + limit])]
+
+    async def update_summary(self, conversation_id, text, covered, expected_version, token_count=None):
+        if (self.summary or {}).get('version', 0) != expected_version:
+            return False
+        self.summary = {'text': text, 'version': expected_version + 1, 'covered': covered, 'tokens': token_count}
+        return True
+
+
+def make_summarizer(store, calls):
+    async def summarize(summary, turns):
+        calls.append((summary, [turn['nurse'] for turn in turns]))
+        return f"{summary}|{len(turns)}"
+
+    # Every pair costs 5 words + 1, so a 12-token budget keeps the last two turns verbatim.
+    builder = ContextBuilder(lambda text: len(text.split()), token_budget=12)
+    return ConversationSummarizer(store, builder, summarize, min_batch=2)
+
+
+def test_summarizes_turns_outside_window_incrementally():
+    store = InMemoryConversation([{"nurse": f"turn {i}", "bot": "ok"} for i in range(6)])
+    calls = []
+    summarizer = make_summarizer(store, calls)
+
+    assert asyncio.run(summarizer.summarize("conv")) is True
+    assert calls == [("", ["turn 0", "turn 1", "turn 2", "turn 3"])]
+    assert store.summary["covered"] == 4
+    assert store.summary["version"] == 1
+
+    # The one-token summary now shares the budget, leaving room for a single verbatim turn.
+    store.messages.extend({"nurse": f"turn {i}", "bot": "ok"} for i in range(6, 8))
+    assert asyncio.run(summarizer.summarize("conv")) is True
+    assert calls[-1] == ("|4", ["turn 4", "turn 5", "turn 6"])
+    assert store.summary["covered"] == 7
+    assert store.summary["version"] == 2
+
+def test_skips_when_too_few_turns_outside_window():
+    store = InMemoryConversation([{"nurse": f"turn {i}", "bot": "ok"} for i in range(3)])
+    calls = []
+    assert asyncio.run(make_summarizer(store, calls).summarize("conv")) is False
+    assert calls == []
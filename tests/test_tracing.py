@@ -0,0 +1,48 @@
+import asyncio
+from src.metrics import MetricsRegistry
+from src.tracing import TracingMiddleware, current_trace, stage
+
+
+def call(middleware, path="/conversation", headers=()):
+    """Send one HTTP request through `middleware` and return the response start message."""
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "path": path, "headers": list(headers)}
+    asyncio.run(middleware(scope, receive, send))
+    return dict(sent[0]["headers"])
+
+
+def app_with_stage(histogram):
+    async def app(scope, receive, send):
+        with stage("generate", histogram):
+            pass
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"{}"})
+    return app
+
+
+def test_responses_carry_the_trace_id_and_stage_durations():
+    registry = MetricsRegistry()
+    requests, generate = registry.histogram("requests", "."), registry.histogram("generate", ".")
+    middleware = TracingMiddleware(app_with_stage(generate), requests, response_headers=True)
+    headers = call(middleware, headers=[(b"x-trace-id", b"retry-7")])
+    assert headers[b"x-trace-id"] == b"retry-7"
+    assert headers[b"server-timing"].startswith(b"generate;dur=")
+    assert requests.count == generate.count == 1
+    assert current_trace() is None
+
+def test_invalid_trace_ids_are_replaced_and_headers_are_optional():
+    registry = MetricsRegistry()
+    requests, generate = registry.histogram("requests", "."), registry.histogram("generate", ".")
+    traced = TracingMiddleware(app_with_stage(generate), requests, response_headers=True)
+    assert call(traced, headers=[(b"x-trace-id", b"bad id\n")])[b"x-trace-id"] != b"bad id\n"
+    untraced = TracingMiddleware(app_with_stage(generate), requests)
+    assert b"x-trace-id" not in call(untraced)
+    call(untraced, path="/metrics")
+    assert requests.count == 2 and generate.count == 3